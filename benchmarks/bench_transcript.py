@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+合成 transcript 基准测试 - 离线测量 transcript 解析各阶段的性能
+
+生成接近真实 Claude Code 会话的 transcript（嵌套 message.content 列表、tool_result、
+超大工具输出、多种时间戳格式），对每个阶段分别在独立子进程中测量延迟、峰值 RSS 和
+records/sec（按文件总记录数计算的等效吞吐）。
+
+使用方法：
+  python3 benchmarks/bench_transcript.py
+  python3 benchmarks/bench_transcript.py --sizes 10K,1M,100M,1G --repeat 5
+  python3 benchmarks/bench_transcript.py --json > bench_output.json
+  python3 benchmarks/bench_transcript.py --sizes 1M --giant 100M   # 最后一轮含一条 100M 的工具输出
+
+生成的 transcript 缓存在 --workdir（默认系统临时目录下的 cc-hook-bench）中，重复运行不会重新生成。
+Linux 上子进程会继承父进程的峰值 RSS，生成超大 transcript 的那次运行中 RSS 偏高，以再次运行的结果为准。
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+CC_HOOK_PATH = Path(__file__).resolve().parent.parent / "cc-hook.py"
+
+DEFAULT_SIZES = "10K,100K,1M,10M,100M"
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# full-scan 是逐行解码整个文件的基线读取方式，用于和尾部优先读取对比
+STAGES = ("extract", "duration", "analyze-cold", "analyze-warm", "format", "full-scan")
+
+PROMPTS = [
+    "修复登录页的样式问题",
+    "运行测试",
+    "帮我重构 transcript 解析逻辑，把重复的 JSON 解码合并到一次遍历里",
+    "解释一下这个报错",
+    "继续",
+]
+TOOLS = ["Bash", "Read", "Edit", "Grep", "Glob", "Write"]
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= SIZE_UNITS[unit]:
+            return f"{size / SIZE_UNITS[unit]:g}{unit}"
+    return str(size)
+
+
+def format_timestamp(rng, moment):
+    """轮流使用 ISO 8601（Z / 带时区偏移）、秒级和毫秒级数字时间戳"""
+    style = rng.randrange(4)
+    if style == 0:
+        return moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03d}Z"
+    if style == 1:
+        return moment.astimezone(timezone(timedelta(hours=8))).isoformat()
+    if style == 2:
+        return moment.timestamp()
+    return int(moment.timestamp() * 1000)
+
+
+def tool_output(rng, huge):
+    if huge:
+        size = rng.randint(256 * 1024, 2 * 1024 * 1024)
+    else:
+        size = rng.randint(40, 4000)
+    line = "drwxr-xr-x  5 dev  staff   160 Jan 13 10:30 src/components/Button.tsx\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def generate_turn(rng, moment, session_id):
+    """生成一轮交互的所有记录：用户输入、若干次工具调用及结果、最终的 assistant 回复"""
+    records = []
+
+    def stamp(seconds):
+        nonlocal moment
+        moment += timedelta(seconds=seconds)
+        return format_timestamp(rng, moment)
+
+    prompt = rng.choice(PROMPTS)
+    if rng.random() < 0.5:
+        content = prompt
+    else:
+        content = [{"type": "text", "text": prompt}, {"type": "text", "text": "<system-reminder>context</system-reminder>"}]
+    records.append({"type": "user", "sessionId": session_id, "timestamp": stamp(rng.uniform(5, 120)),
+                    "message": {"role": "user", "content": content}})
+
+    for _ in range(rng.randint(0, 6)):
+        tool = rng.choice(TOOLS)
+        tool_id = f"toolu_{rng.getrandbits(64):016x}"
+        records.append({"type": "assistant", "sessionId": session_id, "timestamp": stamp(rng.uniform(0.5, 8)),
+                        "message": {"role": "assistant", "stop_reason": "tool_use", "content": [
+                            {"type": "text", "text": f"我先用 {tool} 看一下。"},
+                            {"type": "tool_use", "id": tool_id, "name": tool, "input": {"command": "ls -la"}},
+                        ]}})
+        output = tool_output(rng, huge=rng.random() < 0.03)
+        records.append({"type": "user", "sessionId": session_id, "timestamp": stamp(rng.uniform(0.1, 20)),
+                        "toolUseResult": {"stdout": output, "stderr": "", "interrupted": False},
+                        "message": {"role": "user", "content": [
+                            {"type": "tool_result", "tool_use_id": tool_id, "content": output},
+                        ]}})
+        if rng.random() < 0.2:
+            records.append({"type": "tool_result", "tool_name": tool, "timestamp": stamp(0.01),
+                            "tool_output": {"output": output[:2000]}})
+
+    records.append({"type": "assistant", "sessionId": session_id, "timestamp": stamp(rng.uniform(1, 30)),
+                    "message": {"role": "assistant", "stop_reason": "end_turn", "content": [
+                        {"type": "text", "text": "已完成修改，所有测试均已通过。" * rng.randint(1, 20)},
+                    ]}})
+    if rng.random() < 0.3:
+        records.append({"type": "system", "subtype": "stop_hook_summary", "timestamp": stamp(0.05)})
+    return records, moment
+
+
+def giant_turn(moment, session_id, size):
+    """最后一轮：一次工具调用返回 size 字节的输出（同时出现在 toolUseResult 和 tool_result 中）"""
+    output = ("FAILED tests/test_parser.py::test_case - AssertionError\n" * (size // 110 + 1))[:size // 2]
+    moment += timedelta(seconds=30)
+    stamp = moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    return [
+        {"type": "user", "sessionId": session_id, "timestamp": stamp,
+         "message": {"role": "user", "content": "跑一下全部测试"}},
+        {"type": "user", "sessionId": session_id, "timestamp": stamp,
+         "toolUseResult": {"stdout": output, "stderr": "", "interrupted": False},
+         "message": {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "toolu_giant", "content": output}]}},
+        {"type": "assistant", "sessionId": session_id, "timestamp": stamp,
+         "message": {"role": "assistant", "stop_reason": "end_turn", "content": [{"type": "text", "text": "有测试失败。"}]}},
+    ]
+
+
+def generate_transcript(path, size, seed=0, giant=0):
+    """生成至少 size 字节的 transcript，返回记录数；giant 大于 0 时最后一轮附带一条超大的工具输出"""
+    rng = random.Random(seed)
+    moment = datetime(2026, 1, 1, 9, 0, tzinfo=timezone.utc)
+    session_id = f"{rng.getrandbits(128):032x}"
+    written = count = 0
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        while written < size:
+            records, moment = generate_turn(rng, moment, session_id)
+            for record in records:
+                line = json.dumps(record, ensure_ascii=False) + "\n"
+                f.write(line)
+                written += len(line.encode("utf-8"))
+                count += 1
+        if giant:
+            for record in giant_turn(moment, session_id, giant):
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+    os.replace(tmp, path)
+    return count
+
+
+def prepare_transcript(workdir, size, giant=0):
+    suffix = f"-giant{format_size(giant)}" if giant else ""
+    path = workdir / f"transcript-{format_size(size)}{suffix}.jsonl"
+    meta_path = path.with_suffix(".meta.json")
+    if path.exists() and meta_path.exists():
+        return path, json.loads(meta_path.read_text())["records"]
+    print(f"⏳ 生成 {format_size(size)}{suffix} transcript...", file=sys.stderr)
+    records = generate_transcript(path, size, giant=giant)
+    meta_path.write_text(json.dumps({"records": records}))
+    return path, records
+
+
+def load_cc_hook():
+    spec = importlib.util.spec_from_file_location("cc_hook", CC_HOOK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def full_scan(path):
+    """基线：从头逐行 json.loads 整个文件"""
+    records = 0
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    json.loads(line)
+                except ValueError:
+                    continue
+                records += 1
+    return records
+
+
+def run_stage(stage, path, repeat):
+    """在当前（子）进程中执行一个阶段 repeat 次，返回每次耗时（秒）"""
+    hook = load_cc_hook()
+    timings = []
+    if stage == "format":
+        scan = hook.scan_transcript(path)
+        config = hook.DEFAULT_CONFIG
+        inner = 1000
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(inner):
+                hook.format_message(config, scan["prompt"], scan["response"], scan["duration"], "/home/dev/project")
+            timings.append((time.perf_counter() - start) / inner)
+        return timings
+
+    for _ in range(repeat):
+        if stage == "analyze-cold":
+            for index_file in hook.INDEX_DIR.glob("*.json"):
+                index_file.unlink()
+        elif stage == "analyze-warm":
+            hook.analyze_transcript(path)
+        start = time.perf_counter()
+        if stage == "extract":
+            hook.extract_from_transcript(path)
+        elif stage == "duration":
+            hook.calc_duration(path)
+        elif stage.startswith("analyze"):
+            hook.analyze_transcript(path)
+        elif stage == "full-scan":
+            full_scan(path)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def measure(stage, path, repeat, home):
+    """在独立子进程中测量，使峰值 RSS 只反映该阶段；HOME 指向临时目录以隔离索引文件"""
+    env = dict(os.environ, HOME=str(home))
+    output = subprocess.run(
+        [sys.executable, __file__, "--run-stage", stage, str(path), "--repeat", str(repeat)],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cc-hook transcript 解析基准测试")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"transcript 大小列表（默认 {DEFAULT_SIZES}，最大可到 1G）")
+    parser.add_argument("--stages", default=",".join(STAGES), help="要测量的阶段")
+    parser.add_argument("--repeat", type=int, default=3, help="每个阶段重复次数（取中位数）")
+    parser.add_argument("--giant", default="0", help="在最后一轮附加一条该大小的工具输出（如 100M），用于观察峰值 RSS")
+    parser.add_argument("--workdir", default=str(Path(tempfile.gettempdir()) / "cc-hook-bench"), help="生成 transcript 的缓存目录")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    parser.add_argument("--run-stage", nargs=2, metavar=("STAGE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        stage, path = args.run_stage
+        timings = run_stage(stage, path, args.repeat)
+        # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_bytes = peak if sys.platform == "darwin" else peak * 1024
+        print(json.dumps({"timings": timings, "peak_rss": peak_bytes}))
+        return
+
+    workdir = Path(args.workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    home = workdir / "home"
+    home.mkdir(exist_ok=True)
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"未知阶段: {', '.join(sorted(unknown))}")
+
+    results = []
+    for size in (parse_size(s) for s in args.sizes.split(",")):
+        path, records = prepare_transcript(workdir, size, parse_size(args.giant))
+        for stage in stages:
+            data = measure(stage, path, args.repeat, home)
+            timings = sorted(data["timings"])
+            median = timings[len(timings) // 2]
+            results.append({
+                "size": format_size(size),
+                "bytes": path.stat().st_size,
+                "records": records,
+                "stage": stage,
+                "median_ms": median * 1000,
+                "min_ms": timings[0] * 1000,
+                "peak_rss_mb": data["peak_rss"] / 1024 ** 2,
+                "records_per_sec": records / median if median > 0 and stage != "format" else None,
+            })
+            if not args.json:
+                r = results[-1]
+                rps = f"{r['records_per_sec']:>14,.0f}" if r["records_per_sec"] else f"{'-':>14}"
+                print(f"{r['size']:>6} {r['stage']:<13} {r['median_ms']:>10.3f} ms  "
+                      f"(min {r['min_ms']:.3f})  RSS {r['peak_rss_mb']:>7.1f} MB  {rps} rec/s")
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
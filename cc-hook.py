@@ -9,514 +9,3912 @@ Claude Code Hook Tool - 全局钉钉通知工具
   wget -qO- https://your-repo/cc-hook | python3 -
 
 配置文件位置：~/.cc-hook-config.json
+
+作为模块使用（仓库中的 cc_hook.py、install 安装到用户 site-packages 的副本或 zipapp 均可 import）：
+  import cc_hook
+  config = cc_hook.load_config()
+  title, content = cc_hook.format_message(config, "prompt", "response", 12.3, "/path/to/project")
+  cc_hook.send_many([(title, content)] * 100, config)
+  await cc_hook.send_async(title, content, config)
+
+稳定 API 见 __all__。
 """
 
 import json
+import mmap
 import os
+import re
+import socket
 import sys
 import time
-import subprocess
-import argparse
 from pathlib import Path
 from datetime import datetime
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
-from urllib.parse import urlencode
 import hashlib
-import hmac
-import base64
+from array import array
+
+__all__ = [
+    "DEFAULT_CONFIG",
+    "load_config",
+    "save_config",
+    "resolve_channels",
+    "format_message",
+    "format_digest",
+    "notify",
+    "deliver_message",
+    "send_notification",
+    "send_many",
+    "send_async",
+    "HTTPSConnectionPool",
+]
+
+# stop/prompt 热路径之外才需要的模块（argparse、subprocess、urllib、hmac、base64 等）
+# 在用到它们的函数内部导入，缩短每次 hook 调用的启动时间
 
 DEFAULT_CONFIG = {
     "access_token": "",
     "secret": "",
     "enabled": True,
+    "channels": [],
     "message_template": {
         "title": "Claude Code 执行完成",
         "include_duration": True,
         "include_exit_code": True,
-        "include_working_dir": True
+        "include_working_dir": True,
+        "include_timing": True
     },
     "notifications": {
         "on_success": True,
         "on_failure": True,
         "on_error": True
+    },
+    "digest": {
+        "window_seconds": 0
+    },
+    "delivery": {
+        "mode": "spool"
+    },
+    "metrics": {
+        "enabled": True
+    },
+    "rules": [],
+    "dedup": {
+        "window_seconds": 60
+    },
+    "history": {
+        "enabled": True
     }
 }
 
 CONFIG_PATH = Path.home() / ".cc-hook-config.json"
+INSTALL_PATH = Path.home() / ".local" / "bin" / "cc-hook"
+# install --zipapp 生成的预编译归档
+ZIPAPP_PATH = INSTALL_PATH.with_name("cc-hook.pyz")
+# startup-bench 启动的子进程收到该参数后加载完模块立即退出
+STARTUP_PROBE_ARG = "--startup-probe"
+
+# 旧版本 setup_hook() 生成的 bash hook 及辅助脚本
+LEGACY_HOOK_FILES = ("stop", "extract_messages.py", "calc_duration.py")
+
+# 运行状态目录（与 ~/.claude/hooks 同级）
+STATE_DIR = Path.home() / ".claude" / "cc-hook"
+# 合并默认值并校验后的配置快照（marshal 格式，按配置文件的 mtime/大小/inode 失效）及写配置时的文件锁；
+# 配置文件损坏时沿用快照中上一次的有效配置
+CONFIG_SNAPSHOT_PATH = STATE_DIR / "config-snapshot.bin"
+CONFIG_LOCK_PATH = STATE_DIR / "config.lock"
+CONFIG_SNAPSHOT_VERSION = 2
+# 不在 DEFAULT_CONFIG 中、但取值必须是非负数的可选配置项
+CONFIG_NUMBER_KEYS = (
+    ("delivery", "rate_limit_per_minute"),
+    ("delivery", "hook_budget_seconds"),
+    ("relay", "node_rate_limit_per_minute"),
+)
+DELIVERY_MODES = ("spool", "direct")
+# 长驻进程（daemon、relay、flusher、嵌入调用）内按文件状态缓存的快照
+CONFIG_CACHE = {}
+INDEX_DIR = STATE_DIR / "index"
+OUTBOX_DIR = STATE_DIR / "outbox"
+OUTBOX_FAILED_DIR = OUTBOX_DIR / "failed"
+# 单条消息最多尝试次数、最长退避间隔（秒）以及后台 flusher 最长运行时间（秒）
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 300
+OUTBOX_FLUSH_SECONDS = 900
+# 本地 daemon 的 Unix socket、内存队列容量以及客户端连接/应答超时（秒）
+DAEMON_SOCKET = STATE_DIR / "daemon.sock"
+DAEMON_QUEUE_SIZE = 256
+DAEMON_CLIENT_TIMEOUT = 2.0
+# UserPromptSubmit 记录的每会话状态、保存的 prompt 长度上限与过期时间（秒）
+SESSIONS_DIR = STATE_DIR / "sessions"
+SESSION_PROMPT_CHARS = 2000
+SESSION_MAX_AGE = 7 * 24 * 3600
+# transcript 中本轮起点晚于记录的提交时间超过该秒数时，认为会话状态属于更早的轮次
+SESSION_TURN_TOLERANCE = 2.0
+# 每次 hook/发送的分阶段耗时日志，超过大小上限时轮转（保留一个旧文件）
+METRICS_PATH = STATE_DIR / "metrics.jsonl"
+METRICS_MAX_BYTES = 2 * 1024 * 1024
+# 已完成轮次的历史库（SQLite，WAL 模式）。hook 只向 pending 日志追加一行，
+# 由后台 flusher 或 history 命令在单个事务中批量写入，hook 本身不需要导入 sqlite3
+HISTORY_DB_PATH = STATE_DIR / "history.db"
+HISTORY_PENDING_PATH = STATE_DIR / "history-pending.jsonl"
+HISTORY_TEXT_CHARS = 2000
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    project TEXT NOT NULL,
+    cwd TEXT NOT NULL,
+    session_id TEXT,
+    prompt TEXT,
+    response TEXT,
+    duration REAL,
+    status TEXT,
+    result TEXT,
+    turn_start REAL,
+    UNIQUE (ts, cwd)
+);
+CREATE INDEX IF NOT EXISTS turns_ts ON turns (ts);
+CREATE INDEX IF NOT EXISTS turns_project_ts ON turns (project, ts, duration);
+CREATE INDEX IF NOT EXISTS turns_duration ON turns (duration);
+CREATE TABLE IF NOT EXISTS transcript_turns (
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    project TEXT NOT NULL,
+    prompt TEXT,
+    response TEXT,
+    duration REAL,
+    PRIMARY KEY (path, offset)
+);
+CREATE INDEX IF NOT EXISTS transcript_turns_ts ON transcript_turns (ts, project);
+CREATE TABLE IF NOT EXISTS transcript_offsets (
+    path TEXT PRIMARY KEY,
+    inode INTEGER,
+    offset INTEGER NOT NULL,
+    scanned INTEGER NOT NULL,
+    pending INTEGER NOT NULL
+);
+"""
+HISTORY_SCHEMA_VERSION = 1
+HISTORY_COLUMNS = ("ts", "project", "cwd", "session_id", "prompt", "response", "duration", "status", "result",
+                   "turn_start")
+# report 扫描的 transcript 根目录；最后一轮在该时间（秒）内仍有写入时视为未结束，留到下次扫描
+CLAUDE_PROJECTS_DIR = Path.home() / ".claude" / "projects"
+REPORT_IDLE_SECONDS = 300
+# 每处理多少个 transcript 提交一次事务
+REPORT_COMMIT_EVERY = 64
+# 跨进程共享的投递状态（令牌桶与熔断器）
+DELIVERY_STATE_PATH = STATE_DIR / "delivery-state.json"
+# 同一 transcript 的 Stop hook 互斥锁与 pending 标记；持锁进程最多为后到的 hook 补做的轮数
+LOCK_DIR = STATE_DIR / "locks"
+SINGLE_FLIGHT_MAX_ROUNDS = 3
+# 最近发送过的通知内容哈希（LRU），用于在 dedup.window_seconds 内抑制重复通知
+DEDUP_PATH = STATE_DIR / "dedup.json"
+DEDUP_MAX_ENTRIES = 512
+# 钉钉机器人 API 地址；dingtalk_base_url（或渠道的 base_url）可以把它指向 cc-hook mock-server 等替身
+DINGTALK_BASE_URL = "https://oapi.dingtalk.com"
+# relay 默认端口、请求体大小上限、内存队列容量与发送线程数
+RELAY_PORT = 8090
+RELAY_MAX_BODY = 64 * 1024
+RELAY_QUEUE_SIZE = 1000
+RELAY_WORKERS = 4
+# relay 的 flusher 线程在仍有到期消息（例如 outbox 锁被其他 flusher 持有）时重新检查的间隔（秒）
+RELAY_FLUSH_RETRY_SECONDS = 1.0
+# mock-server 默认端口，以及钉钉允许的签名时间戳与服务器时间之差（毫秒）
+MOCK_SERVER_PORT = 8089
+DINGTALK_SIGN_TOLERANCE_MS = 3600 * 1000
+# 钉钉机器人每分钟最多 20 条消息；其他渠道类型的默认速率上限
+RATE_LIMIT_PER_MINUTE = 20
+CHANNEL_RATE_LIMITS = {"wecom": 20, "feishu": 100, "slack": 60, "webhook": 60, "relay": 600}
+# 各渠道表示被限流的错误码
+RATE_LIMIT_ERRCODES = {"dingtalk": (130101, 660026), "wecom": (45009,), "feishu": (11232,)}
+CHANNEL_LABELS = {"dingtalk": "钉钉", "wecom": "企业微信", "feishu": "飞书", "slack": "Slack", "webhook": "Webhook",
+                  "relay": "Relay"}
+NO_CHANNEL_MESSAGE = "未配置通知渠道（钉钉 access token、webhook_url 或 channels）"
+# 多渠道并发发送的最大线程数，以及等待所有渠道时在总期限之外额外容忍的秒数
+FANOUT_MAX_WORKERS = 8
+FANOUT_GRACE_SECONDS = 1.0
+# send_many / send_async 在进程内共享的 keep-alive 连接池（首次使用时创建）
+SHARED_POOL = None
+# 单次发送最多尝试次数、退避基数与上限（秒）以及等待与重试的总预算（秒）
+SEND_MAX_ATTEMPTS = 3
+SEND_BACKOFF_BASE = 0.5
+SEND_BACKOFF_MAX = 8
+SEND_BUDGET = 8
+# 连续临时故障多少次后熔断、熔断时长以及冷却后单个探测请求的独占时间（秒）
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+BREAKER_PROBE_SECONDS = 15
+# 规则可用的动作、未命中任何规则时的默认动作，以及 digest 动作未指定窗口时的默认窗口（秒）
+RULE_ACTIONS = ("notify", "drop", "digest")
+RULE_STATUSES = ("success", "failure", "error")
+DEFAULT_RULE_ACTION = {"action": "notify", "channels": None, "window_seconds": None, "rule": ""}
+DIGEST_DEFAULT_WINDOW = 60
+COMPILED_RULES_CACHE = {}
+# 一条汇总消息最多列出的事件数，以及每个事件的响应摘要长度
+DIGEST_MAX_EVENTS = 20
+DIGEST_SUMMARY_CHARS = 200
+INDEX_VERSION = 2
+# 每个 transcript 索引保留的最近记录数
+INDEX_MAX_RECORDS = 2000
+
+# Stop hook 的超时（写入 settings.json，超时后 Claude Code 直接结束 hook 进程），以及整个 hook
+# 默认可用的时间预算（为解释器启动、退出和写 metrics 留出余量，可用 delivery.hook_budget_seconds 覆盖）
+HOOK_TIMEOUT = 10
+HOOK_BUDGET = 8.5
+# 等待 transcript 时至少要为提取和投递留出的时间、提取时至少要为投递留出的时间，
+# 以及 direct 模式下同步发送所需的最短时间（秒）；不足时依次跳过等待、跳过响应摘要、改由后台发送
+EXTRACT_RESERVE = 2.0
+DELIVER_RESERVE = 0.5
+DIRECT_SEND_MIN_SECONDS = 1.0
+# 等待 transcript 写完的最长时间、判定"不再变化"的静默时间、轮询间隔（秒），
+# 以及判断轮次是否结束时最多向前查看的记录数
+TRANSCRIPT_WAIT_SECONDS = 7.5
+TRANSCRIPT_STABLE_SECONDS = 0.3
+TRANSCRIPT_POLL_INTERVAL = 0.05
+TURN_END_LOOKBACK = 8
+# inotify 事件掩码（见 <sys/inotify.h>）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+
+# peek_record 使用的字节特征（兼容紧凑与带空格的 JSON 分隔符）
+ASSISTANT_MARKER = re.compile(rb'"type"\s*:\s*"(?:assistant|response)"')
+USER_MARKER = re.compile(rb'"type"\s*:\s*"user"')
+TYPE_MARKER = re.compile(rb'"type"\s*:')
+TIMESTAMP_MARKER = re.compile(rb'"timestamp"\s*:\s*("[^"]*"|-?[0-9][0-9.eE+-]*)')
+# tool_result 引用的 tool_use id（与 peek_record 一样，带引号的键只会匹配到真正的 JSON 键）
+# tool_result 记录的字节特征：顶层的 toolUseResult/tool_result 键，或 content 中的 "type": "tool_result"
+TOOL_RESULT_MARKER = re.compile(rb'"(?:toolUseResult|tool_result)"\s*:|"type"\s*:\s*"tool_result"')
+TOOL_USE_ID_MARKER = re.compile(rb'"tool_use_id"\s*:\s*"([^"\\]{1,200})"')
+# stream_record 使用的空白与非字符串标量
+JSON_WHITESPACE = re.compile(rb'[ \t\r\n]*')
+JSON_SCALAR = re.compile(rb'-?[0-9][0-9.eE+-]*|true|false|null')
+
+# 超过该大小（字节）的记录不整体解码，改为 stream_record 流式提取：每个字符串只保留前
+# RECORD_STRING_BYTES 字节，每个列表/对象只保留前 RECORD_MAX_ITEMS 个元素。
+# 查找换行和字符串结尾时按 SCAN_CHUNK 分块进行，并把扫过的 mmap 页交还给内核，
+# 使 hook 的峰值 RSS 与单条记录（如几十 MB 的工具输出）的大小无关
+RECORD_DECODE_LIMIT = 1024 * 1024
+RECORD_STRING_BYTES = 8192
+RECORD_MAX_ITEMS = 256
+RECORD_MAX_DEPTH = 64
+SCAN_CHUNK = 1024 * 1024
+
+# 估算耗时时使用的最近时间戳数量（代表最近的一次交互）
+RECENT_TIMESTAMPS = 20
+# 通知中列出的最慢工具数，以及在 tool_result 记录开头查找 tool_use id 的字节数
+# （同一条记录中排在超长输出之后的并行结果找不到，对应工具的时间计入模型时间）
+TIMING_TOP_TOOLS = 3
+TOOL_ID_SCAN_BYTES = 64 * 1024
+
+
+def merge_config(defaults, config):
+    """
+    把用户配置深度合并到默认值上：两边都是对象的键递归合并，其余取用户的值。
+    取自默认值的对象和列表都是副本，修改合并结果不会改动 DEFAULT_CONFIG。
+    """
+    merged = {key: merge_config(value, {}) if isinstance(value, dict) else list(value) if isinstance(value, list)
+              else value for key, value in defaults.items()}
+    for key, value in config.items():
+        if isinstance(value, dict) and isinstance(defaults.get(key), dict):
+            merged[key] = merge_config(defaults[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def same_kind(value, default):
+    """value 与默认值是否同一种 JSON 类型（整数与小数视为同类，布尔不算数字）"""
+    if isinstance(default, bool) or isinstance(value, bool):
+        return isinstance(value, bool) and isinstance(default, bool)
+    if isinstance(default, (int, float)):
+        return isinstance(value, (int, float))
+    return isinstance(value, type(default))
+
+
+def validate_config(config, defaults=DEFAULT_CONFIG, prefix=""):
+    """就地把类型或取值无效的配置项换成默认值，返回问题描述列表"""
+    problems = []
+    for key, default in defaults.items():
+        if key not in config:
+            continue
+        name = prefix + key
+        if isinstance(default, dict) and isinstance(config[key], dict):
+            problems.extend(validate_config(config[key], default, name + "."))
+        elif not same_kind(config[key], default):
+            config[key] = merge_config(default, {}) if isinstance(default, dict) else default
+            problems.append(f"{name} 类型无效，已使用默认值 {json.dumps(default, ensure_ascii=False)}")
+
+    if prefix:
+        return problems
+    for section, key in CONFIG_NUMBER_KEYS:
+        value = config.get(section)
+        if not isinstance(value, dict) or key not in value:
+            continue
+        if isinstance(value[key], bool) or not isinstance(value[key], (int, float)) or value[key] < 0:
+            del value[key]
+            problems.append(f"{section}.{key} 应为非负数，已忽略")
+    if config["delivery"].get("mode", "spool") not in DELIVERY_MODES:
+        problems.append(f"delivery.mode 应为 {' 或 '.join(DELIVERY_MODES)}，已使用 spool")
+        config["delivery"]["mode"] = "spool"
+    for name in ("channels", "rules"):
+        if any(not isinstance(item, dict) for item in config[name]):
+            config[name] = [item for item in config[name] if isinstance(item, dict)]
+            problems.append(f"{name} 中的非对象项已忽略")
+    return problems
+
+
+def config_file_key(st):
+    """
+    快照的失效键：配置文件的 mtime/大小/inode，加上默认配置的哈希与脚本自身的 mtime/大小，
+    升级 cc-hook（默认值或校验规则变化）后即使配置文件未改动也会重新合并
+    """
+    key = [st.st_mtime_ns, st.st_size, st.st_ino]
+    if "code" not in CONFIG_CACHE:
+        defaults = hashlib.sha1(json.dumps(DEFAULT_CONFIG, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        try:
+            # 从 zipapp 运行时 __file__ 位于归档内部，改用归档本身
+            script = os.stat(__file__ if os.path.isfile(__file__) else sys.argv[0])
+            CONFIG_CACHE["code"] = [defaults, script.st_mtime_ns, script.st_size]
+        except OSError:
+            CONFIG_CACHE["code"] = [defaults]
+    return key + CONFIG_CACHE["code"]
+
+
+def read_config_snapshot():
+    """读取磁盘上的配置快照；不存在、损坏或由其他 Python 版本写入时返回 None"""
+    import marshal
+
+    try:
+        with open(CONFIG_SNAPSHOT_PATH, 'rb') as f:
+            snapshot = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if (not isinstance(snapshot, dict) or snapshot.get("version") != CONFIG_SNAPSHOT_VERSION
+            or snapshot.get("python") != list(sys.version_info[:2])):
+        return None
+    return snapshot
+
+
+def write_config_snapshot(key, config, specs):
+    """原子写入配置快照（合并后的配置和规范化的规则）；状态目录不可写时只保留进程内缓存"""
+    import marshal
+
+    snapshot = {"version": CONFIG_SNAPSHOT_VERSION, "python": list(sys.version_info[:2]), "key": key,
+                "config": config, "rules": specs}
+    try:
+        CONFIG_SNAPSHOT_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp = CONFIG_SNAPSHOT_PATH.with_name(f".{CONFIG_SNAPSHOT_PATH.name}.{os.getpid()}.tmp")
+        # 快照里有 token 和密钥，与配置文件一样只允许当前用户读取
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(marshal.dumps(snapshot))
+        os.replace(tmp, CONFIG_SNAPSHOT_PATH)
+    except OSError:
+        pass
 
 
 def load_config():
-    if CONFIG_PATH.exists():
+    """
+    返回合并了默认值并校验过的配置（每次调用都是独立的副本，可以随意修改）。
+
+    配置文件未变化时（mtime、大小和 inode 相同）直接使用快照：长驻进程内存中的副本，
+    或 hook 等短命进程共享的磁盘快照，不再解析 JSON。配置文件损坏（例如被其他编辑器写了一半）时
+    沿用快照中上一次的有效配置并在 stderr 提示，而不是退回到没有任何渠道的默认配置。
+    """
+    import marshal
+
+    try:
+        st = os.stat(CONFIG_PATH)
+    except FileNotFoundError:
+        save_config(DEFAULT_CONFIG, only_if_missing=True)
+        return merge_config(DEFAULT_CONFIG, {})
+    except OSError as e:
+        print(f"配置文件读取失败: {e}", file=sys.stderr)
+        return merge_config(DEFAULT_CONFIG, {})
+
+    key = config_file_key(st)
+    if CONFIG_CACHE.get("key") == key:
+        return marshal.loads(CONFIG_CACHE["blob"])
+    snapshot = read_config_snapshot()
+    if snapshot is not None and snapshot["key"] == key:
+        blob = marshal.dumps(snapshot["config"])
+        CONFIG_CACHE.update(key=key, blob=blob)
+        remember_rule_specs(marshal.loads(blob).get("rules") or [], snapshot["rules"])
+        return snapshot["config"]
+
+    try:
+        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("顶层应为 JSON 对象")
+    except (OSError, ValueError) as e:
+        if snapshot is not None:
+            print(f"配置文件读取失败: {e}，沿用上一次的有效配置", file=sys.stderr)
+            return snapshot["config"]
+        print(f"配置文件读取失败: {e}，使用默认配置", file=sys.stderr)
+        return merge_config(DEFAULT_CONFIG, {})
+
+    config = merge_config(DEFAULT_CONFIG, config)
+    for problem in validate_config(config):
+        print(f"⚠️  配置: {problem}", file=sys.stderr)
+    specs = rule_specs(config.get("rules") or [])
+    blob = marshal.dumps(config)
+    CONFIG_CACHE.update(key=key, blob=blob)
+    remember_rule_specs(marshal.loads(blob).get("rules") or [], specs)
+    write_config_snapshot(key, config, specs)
+    return marshal.loads(blob)
+
+
+def remember_rule_specs(rules, specs):
+    """把随配置一起规范化的规则放进规则缓存，compiled_rules 遇到相同的规则时直接使用"""
+    if COMPILED_RULES_CACHE.get("rules") != rules:
+        COMPILED_RULES_CACHE.clear()
+        COMPILED_RULES_CACHE.update(rules=rules, specs=specs)
+
+
+def save_config(config, only_if_missing=False):
+    """
+    在文件锁内原子写入配置（同目录临时文件 + fsync + rename），并发会话不会读到写了一半的文件。
+    保留原文件的权限，新建的配置文件只允许当前用户读写；配置文件是符号链接时写入其指向的文件。
+    only_if_missing 为 True 时仅在配置文件尚不存在时写入。
+    """
+    import fcntl
+
+    path = Path(os.path.realpath(CONFIG_PATH))
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        CONFIG_LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(CONFIG_LOCK_PATH, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o600
+            else:
+                if only_if_missing:
+                    return True
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+            with open(fd, 'w', encoding='utf-8') as f:
+                json.dump(config, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        return True
+    except Exception as e:
         try:
-            with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-            merged_config = DEFAULT_CONFIG.copy()
-            merged_config.update(config)
-            return merged_config
-        except Exception as e:
-            print(f"配置文件读取失败: {e}")
-            return DEFAULT_CONFIG
+            tmp.unlink()
+        except OSError:
+            pass
+        print(f"配置文件保存失败: {e}")
+        return False
+
+
+def generate_sign(timestamp, secret):
+    import base64
+    import hmac
+
+    secret_enc = secret.encode('utf-8')
+    string_to_sign = f'{timestamp}\n{secret}'
+    string_to_sign_enc = string_to_sign.encode('utf-8')
+    hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
+    sign = base64.b64encode(hmac_code).decode('utf-8')
+    return sign
+
+
+def resolve_access_token(config):
+    access_token = config.get("access_token", "")
+
+    # 向后兼容：如果没有 access_token，尝试从 webhook_url 中提取
+    if not access_token:
+        webhook_url = config.get("webhook_url", "")
+        if webhook_url and "access_token=" in webhook_url:
+            access_token = webhook_url.split("access_token=")[1].split("&")[0]
+
+    return access_token
+
+
+def resolve_channels(config):
+    """
+    返回启用的通知渠道列表（每个渠道带唯一的 name 和 type）。
+    未配置 channels 时使用顶层的钉钉 access_token/secret 作为唯一渠道。
+    """
+    channels, names = [], set()
+    for i, channel in enumerate(config.get("channels") or []):
+        if not isinstance(channel, dict) or not channel.get("enabled", True):
+            continue
+        channel = dict(channel)
+        channel.setdefault("type", "dingtalk")
+        name = str(channel.get("name") or f"{channel['type']}-{i + 1}")
+        if name in names:
+            name = f"{name}-{i + 1}"
+        channel["name"] = name
+        if channel["type"] == "dingtalk" and config.get("dingtalk_base_url"):
+            channel.setdefault("base_url", config["dingtalk_base_url"])
+        names.add(name)
+        channels.append(channel)
+
+    if not config.get("channels"):
+        access_token = resolve_access_token(config)
+        if access_token:
+            channels.append({
+                "name": "dingtalk",
+                "type": "dingtalk",
+                "access_token": access_token,
+                "secret": config.get("secret", ""),
+                "base_url": config.get("dingtalk_base_url") or DINGTALK_BASE_URL,
+            })
+    return channels
+
+
+class HTTPSConnectionPool:
+    """按主机复用 keep-alive HTTP(S) 连接，省去每条消息的 DNS 解析、TCP 与 TLS 握手（线程安全）"""
+
+    def __init__(self, timeout=10, max_idle=4):
+        import threading
+
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, host):
+        import http.client
+
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        connection_class = http.client.HTTPConnection if scheme == "http" else http.client.HTTPSConnection
+        return connection_class(host, timeout=self.timeout), False
+
+    def _release(self, scheme, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def post(self, url, data, headers, timeout=None):
+        """POST 并返回响应体；复用的空闲连接若已被服务端关闭，换新连接重试一次"""
+        import http.client
+        from urllib.error import HTTPError
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        for attempt in range(2):
+            conn, reused = self._acquire(parts.scheme, parts.netloc)
+            conn.timeout = self.timeout if timeout is None else timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                conn.request("POST", path, body=data, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(parts.scheme, parts.netloc, conn)
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def add_stage(stages, name, ms):
+    stages[name] = stages.get(name, 0.0) + ms
+
+
+def record_metrics(config, record):
+    """
+    向 metrics 日志追加一行紧凑的 JSON 记录（单次 O_APPEND 写入，多进程并发安全）。
+    日志超过 METRICS_MAX_BYTES 时轮转为 metrics.jsonl.1。
+    """
+    if not config.get("metrics", {}).get("enabled", True):
+        return
+    record = dict(record, ts=round(time.time(), 3))
+    record["stages"] = {name: round(ms, 3) for name, ms in record.get("stages", {}).items()}
+    line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+    try:
+        METRICS_PATH.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            if os.path.getsize(METRICS_PATH) >= METRICS_MAX_BYTES:
+                os.replace(METRICS_PATH, METRICS_PATH.with_name(METRICS_PATH.name + ".1"))
+        except FileNotFoundError:
+            pass
+        fd = os.open(METRICS_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def record_turn(config, turn):
+    """
+    向历史 pending 日志追加一轮交互。写入时持有文件锁，与 ingest_history 的“读取后清空”互斥，
+    不会丢失在两者之间追加的记录。
+    """
+    if not config.get("history", {}).get("enabled", True):
+        return
+    import fcntl
+
+    turn = {column: turn.get(column) for column in HISTORY_COLUMNS}
+    for column in ("prompt", "response"):
+        if isinstance(turn[column], str):
+            turn[column] = turn[column][:HISTORY_TEXT_CHARS]
+    line = (json.dumps(turn, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+    try:
+        HISTORY_PENDING_PATH.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(HISTORY_PENDING_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def build_channel_request(channel, title, content, stages):
+    """按渠道类型构造 (url, 请求体)；配置不完整时抛出 ValueError"""
+    channel_type = channel.get("type")
+    url = channel.get("url", "")
+    secret = channel.get("secret")
+    sign_start = time.perf_counter()
+
+    if channel_type == "dingtalk":
+        access_token = channel.get("access_token")
+        if access_token:
+            base_url = (channel.get("base_url") or DINGTALK_BASE_URL).rstrip('/')
+            url = f"{base_url}/robot/send?access_token={access_token}"
+        payload = {"msgtype": "markdown", "markdown": {"title": title, "text": content}}
+        if url and secret:
+            from urllib.parse import quote_plus
+
+            # 签名是 base64，其中的 + / = 必须 URL 编码，否则服务端解码后校验失败
+            timestamp = str(round(time.time() * 1000))
+            url += f"&timestamp={timestamp}&sign={quote_plus(generate_sign(timestamp, secret))}"
+            add_stage(stages, "sign", (time.perf_counter() - sign_start) * 1000)
+    elif channel_type == "wecom":
+        payload = {"msgtype": "markdown", "markdown": {"content": content}}
+    elif channel_type == "feishu":
+        payload = {
+            "msg_type": "interactive",
+            "card": {
+                "header": {"title": {"tag": "plain_text", "content": title}},
+                "elements": [{"tag": "div", "text": {"tag": "lark_md", "content": content}}],
+            },
+        }
+        if secret:
+            import base64
+            import hmac
+
+            # 飞书签名：以 "timestamp\nsecret" 为密钥对空串做 HMAC-SHA256
+            timestamp = str(int(time.time()))
+            key = f"{timestamp}\n{secret}".encode('utf-8')
+            payload["timestamp"] = timestamp
+            payload["sign"] = base64.b64encode(hmac.new(key, b"", digestmod=hashlib.sha256).digest()).decode('utf-8')
+            add_stage(stages, "sign", (time.perf_counter() - sign_start) * 1000)
+    elif channel_type == "slack":
+        payload = {"text": f"*{title}*\n{content}"}
+    elif channel_type == "webhook":
+        payload = {"title": title, "content": content}
+    elif channel_type == "relay":
+        if url:
+            url = url.rstrip('/') + "/notify"
+        payload = {"title": title, "content": content, "node": channel.get("node") or socket.gethostname()}
+    else:
+        raise ValueError(f"未知的渠道类型: {channel_type}")
+
+    if not url:
+        raise ValueError("未配置 access_token 或 url")
+    return url, payload
+
+
+def channel_headers(channel):
+    """渠道请求的 HTTP 头；relay 渠道用 Bearer token 认证"""
+    headers = {'Content-Type': 'application/json'}
+    if channel.get("type") == "relay" and channel.get("token"):
+        headers['Authorization'] = f"Bearer {channel['token']}"
+    return headers
+
+
+def interpret_channel_response(channel_type, body):
+    """根据渠道类型解析响应体，返回 (是否成功, 描述, 失败类别)"""
+    if channel_type == "webhook":
+        return True, "消息发送成功", None
+    if channel_type == "relay":
+        result = json.loads(body.decode('utf-8'))
+        if result.get("ok"):
+            return True, result.get("message", "已交给 relay 发送"), None
+        return False, f"Relay 错误: {result.get('message', '未知错误')}", result.get("kind", 'fatal')
+    if channel_type == "slack":
+        text = body.decode('utf-8', 'replace').strip()
+        if text == "ok":
+            return True, "消息发送成功", None
+        return False, f"Slack 错误: {text[:100]}", 'fatal'
+
+    result = json.loads(body.decode('utf-8'))
+    if channel_type == "feishu":
+        code = result.get('code', result.get('StatusCode'))
+        errmsg = result.get('msg', result.get('StatusMessage', '未知错误'))
+    else:
+        code = result.get('errcode')
+        errmsg = result.get('errmsg', '未知错误')
+    if code == 0:
+        return True, "消息发送成功", None
+    kind = 'ratelimit' if code in RATE_LIMIT_ERRCODES.get(channel_type, ()) else 'fatal'
+    return False, f"{CHANNEL_LABELS.get(channel_type, channel_type)} API 错误: {errmsg}", kind
+
+
+def post_channel_message(channel, title, content, pool=None, stages=None, timeout=10):
+    """
+    向一个渠道发送一次请求，返回 (是否成功, 描述, 失败类别)。
+    失败类别：ratelimit=被限流，transient=网络或服务端临时故障，fatal=重试无意义（如 token 无效）
+    传入 stages 时累计签名与 HTTP 请求耗时（毫秒）。
+    """
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    stages = {} if stages is None else stages
+    try:
+        url, payload = build_channel_request(channel, title, content, stages)
+    except ValueError as e:
+        return False, str(e), 'fatal'
+
+    start = time.perf_counter()
+    try:
+        data = json.dumps(payload).encode('utf-8')
+        headers = channel_headers(channel)
+        if pool is not None:
+            body = pool.post(url, data, headers, timeout=timeout)
+        else:
+            req = Request(url, data=data, headers=headers)
+            with urlopen(req, timeout=timeout) as response:
+                body = response.read()
+        add_stage(stages, "http", (time.perf_counter() - start) * 1000)
+        return interpret_channel_response(channel.get("type"), body)
+
+    except HTTPError as e:
+        add_stage(stages, "http", (time.perf_counter() - start) * 1000)
+        kind = 'ratelimit' if e.code == 429 else 'transient' if e.code >= 500 else 'fatal'
+        return False, f"发送失败: {e}", kind
+    except ValueError as e:
+        add_stage(stages, "http", (time.perf_counter() - start) * 1000)
+        return False, f"发送失败: {e}", 'fatal'
+    except Exception as e:
+        add_stage(stages, "http", (time.perf_counter() - start) * 1000)
+        return False, f"发送失败: {e}", 'transient'
+
+
+def update_json_locked(path, update):
+    """
+    在文件锁内读取、修改并写回跨进程共享的 JSON 状态文件，返回 update(状态) 的结果。
+    状态文件无法访问时以空状态调用 update，不做持久化。
+    """
+    import fcntl
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(path, 'a+', encoding='utf-8')
+    except OSError:
+        return update({})
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            state = json.loads(f.read() or '{}')
+        except ValueError:
+            state = {}
+        if not isinstance(state, dict):
+            state = {}
+        result = update(state)
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state, separators=(',', ':')))
+    return result
+
+
+def update_delivery_state(key, update):
+    """读取、修改并写回渠道 key 跨进程共享的投递状态（令牌桶与熔断器），返回 update(渠道状态) 的结果"""
+    def update_channel(state):
+        if not isinstance(state.get(key), dict):
+            state[key] = {}
+        return update(state[key])
+
+    return update_json_locked(DELIVERY_STATE_PATH, update_channel)
+
+
+def acquire_send_slot(key, rate_per_minute):
+    """
+    检查渠道 key 的熔断器并从其共享令牌桶取一个令牌。
+    返回 ('open', 熔断结束时间)、('wait', 需等待的秒数) 或 ('ok', 0)。
+    熔断冷却结束后只放行一个探测请求，其余进程继续等待探测结果。
+    """
+    def update(state):
+        now = time.time()
+        if state.get("open_until", 0) > now:
+            return 'open', state["open_until"]
+
+        tokens = state.get("tokens", float(rate_per_minute))
+        elapsed = max(0.0, now - state.get("updated", now))
+        tokens = min(float(rate_per_minute), tokens + elapsed * rate_per_minute / 60.0)
+        state["updated"] = now
+        if tokens < 1:
+            state["tokens"] = tokens
+            return 'wait', (1 - tokens) * 60.0 / rate_per_minute
+
+        state["tokens"] = tokens - 1
+        if state.get("failures", 0) >= BREAKER_THRESHOLD:
+            state["open_until"] = now + BREAKER_PROBE_SECONDS
+        return 'ok', 0
+
+    return update_delivery_state(key, update)
+
+
+def record_send_result(key, kind):
+    """记录一次发送结果：成功或 fatal 说明端点可用，关闭熔断；连续临时故障达到阈值后打开熔断"""
+    def update(state):
+        now = time.time()
+        if kind == 'ratelimit':
+            # 被服务端限流时清空令牌，让所有进程一起放慢
+            state["tokens"] = 0.0
+            state["updated"] = now
+        elif kind == 'transient':
+            state["failures"] = state.get("failures", 0) + 1
+            if state["failures"] >= BREAKER_THRESHOLD:
+                state["open_until"] = now + BREAKER_COOLDOWN
+        else:
+            state["failures"] = 0
+            state["open_until"] = 0
+
+    update_delivery_state(key, update)
+
+
+def breaker_open_until(key):
+    """渠道 key 的熔断器打开时返回预计恢复时间，否则返回 None"""
+    try:
+        with open(DELIVERY_STATE_PATH, 'r', encoding='utf-8') as f:
+            state = json.loads(f.read() or '{}').get(key)
+    except (OSError, ValueError):
+        return None
+    open_until = state.get("open_until", 0) if isinstance(state, dict) else 0
+    return open_until if open_until > time.time() else None
+
+
+def channel_rate_limit(config, channel):
+    """渠道的速率上限：渠道自身配置 > 钉钉沿用 delivery.rate_limit_per_minute > 渠道类型默认值"""
+    if channel.get("rate_limit_per_minute"):
+        return channel["rate_limit_per_minute"]
+    if channel.get("type") == "dingtalk":
+        return config.get("delivery", {}).get("rate_limit_per_minute", RATE_LIMIT_PER_MINUTE)
+    return CHANNEL_RATE_LIMITS.get(channel.get("type"), RATE_LIMIT_PER_MINUTE)
+
+
+def send_with_retry(config, channel, title, content, pool, budget, stages):
+    """
+    send_channel_message 的重试循环，返回 (是否成功, 描述, 结果类别)。
+    stages 中累计限流等待、签名和 HTTP 请求的耗时（毫秒）。
+    """
+    import random
+
+    key = channel["name"]
+    rate = channel_rate_limit(config, channel)
+    deadline = time.monotonic() + budget
+    message = "发送失败"
+    attempt = 0
+    while True:
+        state, value = acquire_send_slot(key, rate)
+        if state == 'open':
+            return False, f"接口暂不可用（熔断至 {datetime.fromtimestamp(value).strftime('%H:%M:%S')}）", 'open'
+        remaining = deadline - time.monotonic()
+        if state == 'wait':
+            if value > remaining:
+                return False, "超过发送频率限制，稍后重试", 'ratelimit'
+            add_stage(stages, "wait", value * 1000)
+            time.sleep(value)
+            continue
+
+        timeout = max(0.5, min(10.0, remaining))
+        success, message, kind = post_channel_message(channel, title, content, pool, stages, timeout)
+        record_send_result(key, kind)
+        attempt += 1
+        stages["attempts"] = attempt
+        if success or kind == 'fatal' or attempt >= SEND_MAX_ATTEMPTS:
+            return success, message, kind or 'ok'
+
+        delay = random.uniform(0, min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * 2 ** attempt))
+        if delay > deadline - time.monotonic():
+            return False, message, kind
+        add_stage(stages, "wait", delay * 1000)
+        time.sleep(delay)
+
+
+def send_channel_message(config, channel, title, content, pool=None, budget=SEND_BUDGET):
+    """
+    向单个渠道发送消息：按该渠道的共享令牌桶限速，被限流或遇到临时故障时带抖动地指数退避重试，
+    所有等待与请求总计不超过 budget 秒；熔断器打开期间直接失败，不再访问网络。
+    每次调用向 metrics 日志追加一条 send 记录。
+    """
+    stages = {}
+    start = time.perf_counter()
+    success, message, outcome = send_with_retry(config, channel, title, content, pool, budget, stages)
+    stages["total"] = (time.perf_counter() - start) * 1000
+    attempts = stages.pop("attempts", 0)
+    record_metrics(config, {"kind": "send", "channel": channel["name"], "result": outcome, "attempts": attempts,
+                            "via": "pool" if pool is not None else "urllib", "stages": stages})
+    return success, message
+
+
+def send_notification(config, title, content, pool=None, budget=SEND_BUDGET, only=None):
+    """
+    把消息并发发送到所有渠道（或 only 中列出的渠道），所有渠道共用 budget 秒的总期限。
+    返回 (是否全部成功, 汇总描述, {渠道名: (是否成功, 描述)})。
+    """
+    if not config.get("enabled", True):
+        return False, "通知已禁用", {}
+    channels = resolve_channels(config)
+    if only is not None:
+        channels = [channel for channel in channels if channel["name"] in only]
+    if not channels:
+        return False, NO_CHANNEL_MESSAGE, {}
+
+    if len(channels) == 1:
+        channel = channels[0]
+        results = {channel["name"]: send_channel_message(config, channel, title, content, pool, budget)}
     else:
-        save_config(DEFAULT_CONFIG)
-        return DEFAULT_CONFIG
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        executor = ThreadPoolExecutor(max_workers=min(len(channels), FANOUT_MAX_WORKERS))
+        futures = {
+            executor.submit(send_channel_message, config, channel, title, content, pool, budget): channel["name"]
+            for channel in channels
+        }
+        done, _ = wait(futures, timeout=budget + FANOUT_GRACE_SECONDS)
+        executor.shutdown(wait=False, cancel_futures=True)
+        results = {
+            name: future.result() if future in done else (False, "超过发送期限")
+            for future, name in futures.items()
+        }
+
+    failures = [f"{name}: {message}" for name, (success, message) in results.items() if not success]
+    if not failures:
+        message = "消息发送成功" if len(results) == 1 else f"已发送到 {len(results)} 个渠道"
+        return True, message, results
+    if len(results) == 1:
+        return False, failures[0].split(": ", 1)[1], results
+    return False, f"{len(failures)}/{len(results)} 个渠道失败（{'；'.join(failures)}）", results
+
+
+def write_json_atomic(path, data):
+    """先写同目录临时文件再 rename，保证读者不会看到写了一半的文件"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def enqueue_message(title, content, channels=None):
+    """把渲染好的消息原子地写入 outbox，返回队列文件路径；channels 为 None 表示发送到所有渠道"""
+    now = time.time()
+    item = {
+        "created": now,
+        "attempts": 0,
+        "next_attempt": now,
+        "title": title,
+        "content": content,
+    }
+    if channels is not None:
+        item["channels"] = list(channels)
+    path = OUTBOX_DIR / f"{time.time_ns()}-{os.getpid()}.json"
+    write_json_atomic(path, item)
+    return path
+
+
+def enqueue_event(event, window, channels=None):
+    """把一次 Stop 事件写入 outbox，等待 window 秒后与窗口内的其他事件合并为一条汇总消息"""
+    now = time.time()
+    item = {
+        "kind": "event",
+        "created": now,
+        "attempts": 0,
+        "next_attempt": now + window,
+        "event": event,
+    }
+    if channels is not None:
+        item["channels"] = list(channels)
+    path = OUTBOX_DIR / f"{time.time_ns()}-{os.getpid()}.json"
+    write_json_atomic(path, item)
+    return path
+
+
+def script_path():
+    """返回可以用 python 直接执行的 cc-hook 路径（脚本或 zipapp 归档），无法定位时返回 None"""
+    path = os.path.abspath(__file__)
+    if os.path.isfile(path):
+        return path
+    # 从 zipapp 运行时 __file__ 位于归档内部
+    archive = os.path.dirname(path)
+    if os.path.isfile(archive):
+        return archive
+    return None
+
+
+def spawn_flusher():
+    """启动与当前会话分离的后台进程清空 outbox；无法定位脚本时返回 False"""
+    import subprocess
+
+    script = script_path()
+    if script is None:
+        return False
+    try:
+        subprocess.Popen(
+            [sys.executable, script, "flush"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True,
+        )
+        return True
+    except OSError:
+        return False
+
+
+def outbox_items():
+    """按入队顺序返回 outbox 中所有的 (路径, 内容)"""
+    items = []
+    try:
+        names = sorted(n for n in os.listdir(OUTBOX_DIR) if n.endswith('.json') and not n.startswith('.'))
+    except FileNotFoundError:
+        return items
+    for name in names:
+        path = OUTBOX_DIR / name
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                item = json.load(f)
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError):
+            # 损坏的队列文件移到 failed/，避免反复读取
+            move_to_failed(path)
+            continue
+        items.append((path, item))
+    return items
+
+
+def due_outbox_items(now=None):
+    """返回已到重试时间的 outbox 文件（按入队顺序）及最早的下次重试时间"""
+    now = time.time() if now is None else now
+    due, next_wakeup = [], None
+    for path, item in outbox_items():
+        if item.get("next_attempt", 0) <= now:
+            due.append((path, item))
+        elif next_wakeup is None or item["next_attempt"] < next_wakeup:
+            next_wakeup = item["next_attempt"]
+    return due, next_wakeup
+
+
+def move_to_failed(path):
+    try:
+        OUTBOX_FAILED_DIR.mkdir(parents=True, exist_ok=True)
+        os.replace(path, OUTBOX_FAILED_DIR / Path(path).name)
+    except OSError:
+        pass
+
+
+def coalesce_events(config):
+    """
+    把 outbox 中所有待汇总的 Stop 事件合并为一条普通消息重新入队。
+    只在最早的事件已到期时调用，此时其余事件都落在它的汇总窗口内。
+    """
+    events = [(path, item) for path, item in outbox_items() if item.get("kind") == "event"]
+    # 被规则路由到不同渠道的事件分别汇总
+    groups = {}
+    for path, item in events:
+        channels = item.get("channels")
+        groups.setdefault(None if channels is None else tuple(channels), []).append((path, item))
+    for channels, group in groups.items():
+        title, content = format_digest(config, [item["event"] for _, item in group])
+        enqueue_message(title, content, channels)
+        for path, _ in group:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def drain_outbox(config):
+    """发送所有已到期的消息，失败的按指数退避重新排期；返回 (成功数, 失败数)"""
+    sent = failed = 0
+    due, _ = due_outbox_items()
+    if any(item.get("kind") == "event" for _, item in due):
+        coalesce_events(config)
+        due, _ = due_outbox_items()
+    all_channels = [channel["name"] for channel in resolve_channels(config)]
+    for path, item in due:
+        targets = item.get("channels")
+        opens = [breaker_open_until(name) for name in (all_channels if targets is None else targets)]
+        if opens and None not in opens:
+            # 目标渠道全部熔断时不消耗重试次数，推迟到最早恢复的时间
+            item["next_attempt"] = max(item.get("next_attempt", 0), min(opens))
+            write_json_atomic(path, item)
+            continue
+        success, message, results = send_notification(config, item["title"], item["content"], only=targets)
+        if results and not success:
+            # 只重试失败的渠道，已成功的渠道不会重复收到
+            item["channels"] = [name for name, (ok, _) in results.items() if not ok]
+        if success:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            sent += 1
+            continue
+        failed += 1
+        item["attempts"] = item.get("attempts", 0) + 1
+        item["last_error"] = message
+        if item["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            write_json_atomic(path, item)
+            move_to_failed(path)
+        else:
+            item["next_attempt"] = time.time() + min(2 ** item["attempts"], OUTBOX_MAX_BACKOFF)
+            write_json_atomic(path, item)
+    return sent, failed
+
+
+def flush_outbox(max_seconds=None):
+    """
+    后台清空 outbox：同一时间只有一个 flusher 持有锁，其余直接退出。
+    有待重试的消息时会等待到下次重试时间，最多运行 max_seconds 秒。
+    """
+    import fcntl
+
+    max_seconds = OUTBOX_FLUSH_SECONDS if max_seconds is None else max_seconds
+    deadline = time.monotonic() + max_seconds
+    OUTBOX_DIR.mkdir(parents=True, exist_ok=True)
+    sent = failed = 0
+    # 顺带把 hook 追加的历史记录批量写入 SQLite（flusher 在后台运行，不占用 hook 的时间）
+    if max_seconds > 0:
+        try:
+            ingest_history()
+        except Exception:
+            pass
+
+    while True:
+        with open(OUTBOX_DIR / ".flush.lock", 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return sent, failed
+            while True:
+                config = load_config()
+                s, f = drain_outbox(config)
+                sent, failed = sent + s, failed + f
+                due, next_wakeup = due_outbox_items()
+                if due:
+                    continue
+                if next_wakeup is None:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return sent, failed
+                time.sleep(max(0.0, min(next_wakeup - time.time(), remaining)))
+        # 释放锁后再检查一次，避免错过释放期间入队（其 flusher 因拿不到锁已退出）的消息
+        due, _ = due_outbox_items()
+        if not due or time.monotonic() >= deadline:
+            return sent, failed
+
+
+def send_via_daemon(title, content, channels=None, timeout=DAEMON_CLIENT_TIMEOUT):
+    """把渲染好的消息交给本地 daemon；daemon 未运行或未确认接收时返回 None"""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    request = json.dumps({"title": title, "content": content, "channels": channels}, ensure_ascii=False)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(DAEMON_SOCKET))
+            sock.sendall(request.encode('utf-8') + b'\n')
+            with sock.makefile('rb') as reader:
+                reply = json.loads(reader.readline())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(reply, dict) or not reply.get("ok"):
+        return None
+    return True, reply.get("message", "已交给 daemon 发送")
+
+
+def daemon_running():
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DAEMON_CLIENT_TIMEOUT)
+            sock.connect(str(DAEMON_SOCKET))
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+def run_daemon():
+    """
+    前台运行本地投递 daemon：在 Unix socket 上接收 hook 渲染好的消息，立即应答，
+    由后台线程通过 keep-alive 连接池发送。发送失败或退出时未发送的消息写入 outbox。
+    """
+    import queue
+    import signal
+    import socketserver
+    import threading
+
+    if not hasattr(socket, "AF_UNIX"):
+        print("❌ 当前平台不支持 Unix socket")
+        return False
+    if daemon_running():
+        print(f"⚠️  daemon 已在运行: {DAEMON_SOCKET}")
+        return False
+
+    DAEMON_SOCKET.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        DAEMON_SOCKET.unlink()
+    except FileNotFoundError:
+        pass
+
+    pool = HTTPSConnectionPool()
+    pending = queue.Queue(maxsize=DAEMON_QUEUE_SIZE)
+
+    def spool(title, content, channels=None):
+        try:
+            enqueue_message(title, content, channels)
+        except OSError:
+            return False
+        return True
+
+    def worker():
+        while True:
+            title, content, channels = pending.get()
+            success, _, results = send_notification(load_config(), title, content, pool=pool, only=channels)
+            failed = [name for name, (ok, _) in results.items() if not ok] or channels
+            if not success and spool(title, content, failed):
+                spawn_flusher()
+            pending.task_done()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                item = json.loads(self.rfile.readline())
+                channels = item.get("channels")
+                if channels is not None:
+                    channels = [str(name) for name in channels]
+                entry = (str(item["title"]), str(item["content"]), channels)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                reply = {"ok": False, "message": "无效请求"}
+            else:
+                try:
+                    pending.put_nowait(entry)
+                    reply = {"ok": True, "message": "已交给 daemon 发送"}
+                except queue.Full:
+                    reply = {"ok": False, "message": "daemon 队列已满"}
+            self.wfile.write(json.dumps(reply, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    # socket 只允许当前用户访问
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(str(DAEMON_SOCKET), Handler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    threading.Thread(target=worker, daemon=True).start()
+    signal.signal(signal.SIGTERM, terminate)
+
+    print(f"📡 daemon 已启动: {DAEMON_SOCKET}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            DAEMON_SOCKET.unlink()
+        except FileNotFoundError:
+            pass
+        while True:
+            try:
+                title, content, channels = pending.get_nowait()
+            except queue.Empty:
+                break
+            spool(title, content, channels)
+        pool.close()
+        print("👋 daemon 已退出")
+    return True
+
+
+def has_channels(config, channels=None):
+    """是否至少有一个可用的目标渠道（channels 为 None 表示全部渠道）"""
+    return any(channels is None or channel["name"] in channels for channel in resolve_channels(config))
+
+
+def direct_send_budget(config, budget):
+    """
+    hook 剩余 budget 秒时同步发送可用的期限；spool 模式或剩余时间不足以同步发送时返回 None。
+    budget 为 None 表示调用方没有期限，使用默认的 SEND_BUDGET。
+    """
+    if config.get("delivery", {}).get("mode", "spool") == "spool":
+        return None
+    if budget is None:
+        return SEND_BUDGET
+    # 多渠道并发发送时，等待所有渠道会在期限之外再容忍 FANOUT_GRACE_SECONDS
+    budget = min(SEND_BUDGET, budget - FANOUT_GRACE_SECONDS)
+    return budget if budget >= DIRECT_SEND_MIN_SECONDS else None
+
+
+def deliver_message(config, title, content, channels=None, budget=None):
+    """
+    投递渲染好的消息。本地 daemon 在运行时交给它发送；否则 spool 模式下写入 outbox
+    并交给后台 flusher，立即返回；direct 模式或无法写入 outbox 时直接同步发送。
+    channels 为 None 时发送到所有渠道，否则只发送到列出的渠道。
+
+    budget 为调用方（Stop hook）剩余的秒数：同步发送不会超过它，剩余时间不足以同步发送时
+    即使是 direct 模式也改为写入 outbox，发送失败的渠道同样交给后台 flusher 重试。
+    """
+    if not config.get("enabled", True):
+        return False, "通知已禁用"
+    if not has_channels(config, channels):
+        return False, NO_CHANNEL_MESSAGE
+
+    daemon_timeout = DAEMON_CLIENT_TIMEOUT if budget is None else max(0.1, min(DAEMON_CLIENT_TIMEOUT, budget / 4))
+    via_daemon = send_via_daemon(title, content, channels, daemon_timeout)
+    if via_daemon is not None:
+        return via_daemon
+
+    send_budget = direct_send_budget(config, budget)
+    if send_budget is None:
+        try:
+            enqueue_message(title, content, channels)
+        except OSError:
+            fallback = SEND_BUDGET if budget is None else max(0.5, min(SEND_BUDGET, budget - FANOUT_GRACE_SECONDS))
+            return send_notification(config, title, content, budget=fallback, only=channels)[:2]
+        if not spawn_flusher():
+            flush_outbox(max_seconds=0)
+        return True, "已加入发送队列"
+
+    if budget is None:
+        return send_notification(config, title, content, only=channels)[:2]
+    success, message, spooled = send_rendered(config, title, content, channels, budget=send_budget)
+    if spooled:
+        spawn_flusher()
+    return success, message
+
+
+def shared_pool():
+    """嵌入使用时进程内共享的 keep-alive 连接池，批量和异步发送都复用它"""
+    global SHARED_POOL
+    if SHARED_POOL is None:
+        SHARED_POOL = HTTPSConnectionPool(max_idle=FANOUT_MAX_WORKERS)
+    return SHARED_POOL
+
+
+def send_rendered(config, title, content, channels=None, pool=None, spool=True, budget=SEND_BUDGET):
+    """
+    在当前进程内同步发送一条渲染好的消息，返回 (是否成功, 描述, 是否写入了 outbox)。
+    spool 为 True 时，发送失败的渠道写入 outbox，由后台 flusher 继续重试。
+    """
+    success, message, results = send_notification(config, title, content, pool=pool, budget=budget, only=channels)
+    if success or not spool or not results:
+        return success, message, False
+    failed = [name for name, (ok, _) in results.items() if not ok]
+    try:
+        enqueue_message(title, content, failed)
+    except OSError:
+        return success, message, False
+    return success, f"{message}（已加入发送队列重试）", True
+
+
+def normalize_message(message):
+    """send_many 接受 (title, content) 二元组或带 title/content 的 dict"""
+    if isinstance(message, dict):
+        return str(message["title"]), str(message["content"])
+    title, content = message
+    return str(title), str(content)
+
+
+def send_many(messages, config=None, channels=None, max_workers=FANOUT_MAX_WORKERS, spool=True):
+    """
+    在当前进程内批量发送渲染好的消息，返回与 messages 顺序一致的 [(是否成功, 描述), ...]。
+
+    所有消息共用一个 keep-alive 连接池，最多 max_workers 条并发；令牌桶限速、重试和熔断
+    与 hook 发送相同，因此批量发送同样遵守各渠道的速率上限。spool 为 True 时，
+    失败的渠道写入 outbox 并启动后台 flusher 重试，不会丢失消息。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    config = load_config() if config is None else config
+    items = [normalize_message(message) for message in messages]
+    if not items:
+        return []
+    if not config.get("enabled", True):
+        return [(False, "通知已禁用")] * len(items)
+    if not has_channels(config, channels):
+        return [(False, NO_CHANNEL_MESSAGE)] * len(items)
+
+    pool = shared_pool()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        results = list(executor.map(
+            lambda item: send_rendered(config, item[0], item[1], channels, pool, spool), items))
+    if any(spooled for _, _, spooled in results):
+        spawn_flusher()
+    return [(success, message) for success, message, _ in results]
+
+
+async def send_async(title, content, config=None, channels=None, spool=True):
+    """
+    asyncio 版本的单条发送，返回 (是否成功, 描述)。
+    标准库没有异步 HTTP 客户端，实际请求在默认线程池中执行，并复用进程内共享的 keep-alive 连接，
+    多个并发的 send_async 不会各自建立 TCP/TLS 连接，也不会阻塞事件循环。
+    """
+    import asyncio
+
+    config = load_config() if config is None else config
+    if not config.get("enabled", True):
+        return False, "通知已禁用"
+    if not has_channels(config, channels):
+        return False, NO_CHANNEL_MESSAGE
+    loop = asyncio.get_running_loop()
+    success, message, spooled = await loop.run_in_executor(
+        None, send_rendered, config, str(title), str(content), channels, shared_pool(), spool)
+    if spooled:
+        spawn_flusher()
+    return success, message
+
+
+def project_name_of(working_dir):
+    """从工作目录提取项目名称"""
+    return working_dir.split('/')[-1] if working_dir and '/' in working_dir else working_dir
+
+
+def format_timing(timing, top=TIMING_TOP_TOOLS):
+    """把轮次耗时拆分渲染为一行：模型时间和最慢的几个工具（总耗时及调用次数）"""
+    parts = [f"模型 {timing['model']:.1f}秒"]
+    for name, seconds, count in timing["tools"][:top]:
+        parts.append(f"{name} {seconds:.1f}秒" + (f" ×{count}" if count > 1 else ""))
+    return " · ".join(parts)
+
+
+def format_message(config, command="", response="", duration=0.0, working_dir="", timing=None):
+    """渲染单条通知；timing 为 transcript 扫描得到的耗时拆分（见 timing_result），有工具调用时列出最慢的工具"""
+    template = config.get("message_template", {})
+
+    # 提取项目名称（从工作目录）
+    project_name = project_name_of(working_dir)
+
+    status_icon = "✅"
+    title = template.get('title', 'Claude Code 响应完成')
+
+    lines = [
+        f"# {title}",
+        "",
+        f"{status_icon} **项目**: `{project_name}`",
+    ]
+
+    # 显示 AI 响应摘要（最多 500 字符）
+    if response and response != "AI 任务已完成":
+        response_display = response[:500] + '...' if len(response) > 500 else response
+        lines.append(f"")
+        lines.append(f"🤖 **AI 响应摘要**:")
+        lines.append(f"> {response_display}")
+
+    # 可选：显示额外信息
+    if template.get("include_duration", True) and duration > 0:
+        lines.append(f"")
+        lines.append(f"⏱️ 耗时: {duration:.1f}秒")
+        if template.get("include_timing", True) and timing and timing["tools"]:
+            lines.append(f"🧩 构成: {format_timing(timing)}")
+
+    if template.get("include_working_dir", True) and working_dir:
+        lines.append(f"📁 路径: `{working_dir}`")
+
+    lines.extend([
+        "",
+        f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+    ])
+
+    content = "\n".join(lines)
+    return title, content
+
+
+def format_digest(config, events):
+    """把汇总窗口内的多个 Stop 事件渲染为一条按项目分节的 Markdown 消息"""
+    template = config.get("message_template", {})
+    title = f"{template.get('title', 'Claude Code 响应完成')}（{len(events)} 条）"
+
+    shown = events[-DIGEST_MAX_EVENTS:]
+    projects = {}
+    for event in shown:
+        projects.setdefault(event.get("working_dir", ""), []).append(event)
+
+    lines = [f"# {title}"]
+    for working_dir, project_events in projects.items():
+        project_name = project_name_of(working_dir)
+        lines.append("")
+        lines.append(f"### ✅ {project_name or '未知项目'}（{len(project_events)} 条）")
+        if template.get("include_working_dir", True) and working_dir:
+            lines.append(f"📁 路径: `{working_dir}`")
+        for event in project_events:
+            finished = datetime.fromtimestamp(event.get("time", time.time())).strftime('%H:%M:%S')
+            header = f"- 🕐 {finished}"
+            duration = event.get("duration", 0.0)
+            if template.get("include_duration", True) and duration > 0:
+                header += f" ⏱️ {duration:.1f}秒"
+            lines.append(header)
+            response = event.get("response", "")
+            if response and response != "AI 任务已完成":
+                summary = response[:DIGEST_SUMMARY_CHARS] + '...' if len(response) > DIGEST_SUMMARY_CHARS else response
+                lines.append(f"  > {summary}")
+
+    if len(events) > len(shown):
+        lines.append("")
+        lines.append(f"…另有 {len(events) - len(shown)} 条较早的事件未列出")
+
+    lines.extend([
+        "",
+        f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+    ])
+    return title, "\n".join(lines)
+
+
+def get_content(msg, first_only=False):
+    """从消息中提取 content，支持多种格式
+
+    Args:
+        msg: 消息对象
+        first_only: 是否只返回第一个文本块（用于用户输入）
+    """
+    # 1. 直接的 content 字段
+    if 'content' in msg:
+        content = msg.get('content', '')
+    # 2. 嵌套在 message 对象中（Claude Code 实际格式）
+    elif 'message' in msg and isinstance(msg['message'], dict):
+        message = msg['message']
+        if 'content' in message:
+            content = message.get('content', '')
+        else:
+            return None
+    else:
+        return None
+
+    if isinstance(content, str):
+        return content
+    elif isinstance(content, list):
+        # 处理 content 为列表的情况（如 text 块）
+        texts = []
+        for item in content:
+            if isinstance(item, dict):
+                if item.get('type') == 'text':
+                    texts.append(item.get('text', ''))
+                elif 'text' in item:
+                    texts.append(item.get('text', ''))
+            elif isinstance(item, str):
+                texts.append(item)
+            # 如果只需要第一个，找到后立即返回
+            if first_only and texts:
+                return texts[0]
+        return ' '.join(texts) if texts else None
+    return None
+
+
+def release_pages(mm, start, end):
+    """
+    把 mm[start:end] 完整覆盖的页交还给内核。映射是只读的，之后再访问这些页时
+    会重新从页缓存读入，只影响 RSS，不影响内容。不支持 madvise 的平台上不做任何事。
+    """
+    advice = getattr(mmap, "MADV_DONTNEED", None)
+    if advice is None or not hasattr(mm, "madvise"):
+        return
+    start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+    end = end // mmap.PAGESIZE * mmap.PAGESIZE
+    if end > start:
+        try:
+            mm.madvise(advice, start, end - start)
+        except (OSError, ValueError):
+            pass
+
+
+def find_newline_before(mm, end, start=0):
+    """在 mm[start:end] 中查找最后一个换行的位置（没有时返回 -1），按块查找并释放扫过的页"""
+    pos = end
+    while pos > start:
+        low = max(start, pos - SCAN_CHUNK)
+        nl = mm.rfind(b'\n', low, pos)
+        if nl != -1:
+            return nl
+        release_pages(mm, low, pos)
+        pos = low
+    return -1
+
+
+def find_newline_after(mm, start, end=None):
+    """在 mm[start:end] 中查找第一个换行的位置（没有时返回 -1），按块查找并释放扫过的页"""
+    end = len(mm) if end is None else end
+    pos = start
+    while pos < end:
+        high = min(end, pos + SCAN_CHUNK)
+        nl = mm.find(b'\n', pos, high)
+        if nl != -1:
+            return nl
+        release_pages(mm, pos, high)
+        pos = high
+    return -1
+
+
+def iter_line_spans_reversed(mm, end=None):
+    """从 mmap 末尾向前逐行返回 (start, end) 偏移，不复制行内容"""
+    if end is None:
+        end = len(mm)
+    while end > 0:
+        start = find_newline_before(mm, end) + 1
+        if start < end:
+            yield start, end
+        end = start - 1
+
+
+def decode_json_prefix(raw, complete):
+    """解码 JSON 字符串的内容（不含引号）；截断的前缀会先去掉末尾不完整的转义序列或 UTF-8 字符"""
+    for cut in range(1 if complete else 12):
+        try:
+            return json.loads(b'"' + raw[:len(raw) - cut] + b'"', strict=False)
+        except ValueError:
+            continue
+    return raw.decode('utf-8', 'replace')
+
+
+def stream_record(buf, start, end):
+    """
+    流式解码 buf[start:end] 中的一条 JSON 记录，内存占用与记录大小无关：
+    字符串只保留前 RECORD_STRING_BYTES 字节，列表/对象只保留前 RECORD_MAX_ITEMS 个元素，
+    扫过的页随即释放。摘要最多只用到几百个字符，截断不影响提取结果。格式错误时抛出 ValueError。
+    """
+    pos = start
+    released = start
+
+    def skip_whitespace():
+        nonlocal pos
+        pos = JSON_WHITESPACE.match(buf, pos, end).end()
+
+    def expect(token):
+        nonlocal pos
+        skip_whitespace()
+        if buf[pos:pos + 1] != token:
+            raise ValueError(f"expected {token!r} at offset {pos}")
+        pos += 1
+
+    def parse_string():
+        nonlocal pos, released
+        begin = scan = pos + 1
+        while True:
+            high = min(end, scan + SCAN_CHUNK)
+            quote = buf.find(b'"', scan, high)
+            if quote == -1:
+                if high >= end:
+                    raise ValueError("unterminated string")
+                release_pages(buf, released, high)
+                released = scan = high
+                continue
+            slash = quote
+            while slash > begin and buf[slash - 1] == 0x5c:
+                slash -= 1
+            if (quote - slash) % 2 == 0:
+                break
+            scan = quote + 1
+        pos = quote + 1
+        length = quote - begin
+        value = decode_json_prefix(buf[begin:begin + min(length, RECORD_STRING_BYTES)],
+                                   complete=length <= RECORD_STRING_BYTES)
+        if pos - released >= SCAN_CHUNK:
+            release_pages(buf, released, pos)
+            released = pos
+        return value
+
+    def parse_value(depth):
+        nonlocal pos
+        if depth > RECORD_MAX_DEPTH:
+            raise ValueError("record nested too deeply")
+        skip_whitespace()
+        token = buf[pos:pos + 1]
+        if token == b'"':
+            return parse_string()
+        if token in (b'{', b'['):
+            pos += 1
+            closing = b'}' if token == b'{' else b']'
+            container = {} if token == b'{' else []
+            skip_whitespace()
+            if buf[pos:pos + 1] == closing:
+                pos += 1
+                return container
+            while True:
+                if token == b'{':
+                    skip_whitespace()
+                    if buf[pos:pos + 1] != b'"':
+                        raise ValueError(f"expected key at offset {pos}")
+                    key = parse_string()
+                    expect(b':')
+                    item = parse_value(depth + 1)
+                    if len(container) < RECORD_MAX_ITEMS:
+                        container[key] = item
+                else:
+                    item = parse_value(depth + 1)
+                    if len(container) < RECORD_MAX_ITEMS:
+                        container.append(item)
+                skip_whitespace()
+                token_end = buf[pos:pos + 1]
+                pos += 1
+                if token_end == closing:
+                    return container
+                if token_end != b',':
+                    raise ValueError(f"expected ',' or {closing!r} at offset {pos - 1}")
+        match = JSON_SCALAR.match(buf, pos, end)
+        if match is None:
+            raise ValueError(f"unexpected token at offset {pos}")
+        pos = match.end()
+        return json.loads(match.group())
+
+    try:
+        record = parse_value(0)
+        skip_whitespace()
+        if pos != end:
+            raise ValueError(f"extra data at offset {pos}")
+        return record
+    finally:
+        release_pages(buf, start, end)
+
+
+def decode_record(buf, start, end):
+    """解码 buf[start:end] 中的一条记录；超过 RECORD_DECODE_LIMIT 的记录用 stream_record 流式提取"""
+    if end - start > RECORD_DECODE_LIMIT:
+        return stream_record(buf, start, end)
+    return json.loads(buf[start:end])
+
+
+def parse_timestamp(ts):
+    """解析 ISO 8601 或数字（秒/毫秒）时间戳，失败返回 None"""
+    if not ts:
+        return None
+    if isinstance(ts, str):
+        try:
+            return datetime.fromisoformat(ts.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    try:
+        ts_float = float(ts)
+    except (TypeError, ValueError):
+        return None
+    # 如果是毫秒级时间戳（大于 100 亿），转换为秒
+    if ts_float > 10000000000:
+        ts_float = ts_float / 1000.0
+    return ts_float
+
+
+def user_prompt_text(msg):
+    """如果记录是真正的用户输入（不是 tool_result），返回第一个文本块"""
+    # 跳过 tool_result 类型的消息
+    if 'toolUseResult' in msg or 'tool_result' in msg:
+        return None
+    # 支持多种用户消息类型
+    if msg.get('type') == 'user':
+        message = msg.get('message', {})
+        content = message.get('content', '') if isinstance(message, dict) else ''
+        # 如果 content 是列表且包含 tool_result，跳过
+        if isinstance(content, list):
+            if any(item.get('type') == 'tool_result' for item in content if isinstance(item, dict)):
+                return None
+        # 只提取第一个文本块，避免合并多个内容
+        content = get_content(msg, first_only=True)
+    # 也尝试直接从 content 字段提取（如果没有 type）
+    elif 'type' not in msg:
+        content = get_content(msg, first_only=True)
+    else:
+        return None
+    if content and isinstance(content, str) and content.strip():
+        return content
+    return None
+
+
+def select_prompt(user_messages):
+    """从最近几条用户消息中挑选真正的用户输入"""
+    # 优先选择最短且不含通知标记的消息
+    # 真正的用户输入通常都是最短的
+    filtered_messages = []
+    for msg in user_messages:
+        # 跳过包含通知特征的消息（不限于开头）
+        if 'Claude Code 执行完成' in msg or '🤖 AI 响应摘要' in msg or '✅ 项目:' in msg or '⏱️ 耗时:' in msg:
+            continue
+        # 跳过包含问号的消息（通常是用户在告诉我通知内容）
+        if '？' in msg or '?' in msg or '是否' in msg:
+            continue
+        # 跳过过长的消息（真正的用户输入通常很短）
+        if len(msg) > 50:
+            continue
+        filtered_messages.append(msg)
+
+    # 从过滤后的消息中选择最短的
+    if filtered_messages:
+        return min(filtered_messages, key=len)
+    if user_messages:
+        # 如果过滤后没有消息，使用最短的原始消息（最多 50 字符）
+        return min(user_messages, key=len)[:50]
+    return "无"
+
+
+def tool_result_summary(msg):
+    """将 tool_result 记录压缩为一行摘要（最多 200 字符）"""
+    tool_name = msg.get('tool_name', 'Unknown')
+    # tool_output 可能在不同位置
+    tool_output = msg.get('tool_output', {})
+    output_text = ''
+    if isinstance(tool_output, dict):
+        output_text = tool_output.get('output', '')
+    elif isinstance(tool_output, str):
+        output_text = tool_output
+    output_text = str(output_text) if output_text else ''
+    if not output_text.strip():
+        return None
+    summary = output_text[:200] + '...' if len(output_text) > 200 else output_text
+    return f"[{tool_name}] {summary}"
+
+
+def assistant_summary(msg):
+    """提取 assistant/response 记录的文本（最多 500 字符）"""
+    if msg.get('type') not in ('assistant', 'response'):
+        return None
+    content = get_content(msg)
+    if content:
+        text = str(content)[:500]
+        if text:
+            return f"[AI] {text}"
+    return None
+
+
+def duration_from_timestamps(recent):
+    """根据最近的时间戳（按从新到旧排列）估算最近一次交互的耗时"""
+    if len(recent) >= 2:
+        first_time = recent[-1]
+        last_time = recent[0]
+        if first_time < last_time:
+            duration = last_time - first_time
+            # 如果计算出的时长超过 5 分钟，可能是整个会话时长，使用最后两个时间戳
+            if duration > 300:
+                duration = recent[0] - recent[1]
+            return duration
+    return 5.0
+
+
+def peek_record(buf, start, end):
+    """
+    不解码 JSON，只凭字节特征判断 buf[start:end] 这一行是否可能是用户输入、工具结果或 AI 回复。
+    确定都不是时返回 ('', 时间戳)；可能是（或无法判断）时返回 None，由调用方完整解码。
+
+    带引号的标记仍可能出现在字符串值里（例如 prompt 的文本恰好以 "tool_result 结尾，被转义的引号
+    加上字符串的结束引号），所以只有后面紧跟冒号的键、或 "type": "tool_result" 这样的键值对才算
+    tool_result 特征：字符串内部的引号总是被转义，冒号前未转义的引号只能属于真正的键。
+    误判为“可能”只会多解码一次，不会影响结果。所有检查都直接在 buf 上按偏移查找，不复制整行。
+    """
+    if buf[start:start + 1] != b'{' or buf[end - 1:end] != b'}':
+        return None
+    if buf.find(b'"tool_output"', start, end) != -1 or ASSISTANT_MARKER.search(buf, start, end):
+        return None
+    if TOOL_RESULT_MARKER.search(buf, start, end) is None:
+        if USER_MARKER.search(buf, start, end) or TYPE_MARKER.search(buf, start, end) is None:
+            return None
+    # 只有一个 "timestamp" 键时才能确定它就是顶层时间戳
+    first = buf.find(b'"timestamp"', start, end)
+    if first == -1 or buf.find(b'"timestamp"', first + 1, end) != -1:
+        return None
+    match = TIMESTAMP_MARKER.match(buf, first, end)
+    if match is None:
+        return None
+    raw = match.group(1)
+    if raw.startswith(b'"'):
+        if b'\\' in raw:
+            return None
+        raw = raw[1:-1]
+    return '', parse_timestamp(raw.decode('ascii', 'replace'))
+
+
+def parse_line(buf, start=0, end=None):
+    """
+    返回 buf[start:end] 这一行记录的 (类别, 时间戳, 解码后的记录)；
+    peek_record 能排除的行不解码（也不复制），记录为 None。空行或无法解析的行返回 None。
+    """
+    if end is None:
+        end = len(buf)
+    while start < end and buf[start:start + 1].isspace():
+        start += 1
+    while end > start and buf[end - 1:end].isspace():
+        end -= 1
+    if start >= end:
+        return None
+    # 超大的行直接流式提取：peek_record 的多次整行查找反而会让整行驻留内存
+    if end - start <= RECORD_DECODE_LIMIT:
+        peeked = peek_record(buf, start, end)
+        if peeked is not None:
+            return peeked[0], peeked[1], None
+    try:
+        msg = decode_record(buf, start, end)
+    except ValueError:
+        return None
+    if not isinstance(msg, dict):
+        return None
+    return classify_record(msg), parse_timestamp(msg.get('timestamp')), msg
+
+
+def classify_record(msg):
+    """返回记录在索引中的类别：u=用户输入, t=tool_result, a=assistant/response, 空串=其他"""
+    if user_prompt_text(msg):
+        return 'u'
+    msg_type = msg.get('type')
+    if msg_type == 'tool_result':
+        return 't'
+    if msg_type in ('assistant', 'response'):
+        return 'a'
+    return ''
+
+
+def new_window():
+    """最近一次交互的累积状态（按从新到旧的顺序喂入记录）"""
+    return {"users": [], "tools": [], "ai": None, "timestamps": array('d')}
+
+
+def record_text(kind, msg):
+    """记录在窗口中用到的文本：用户输入原文、tool_result 摘要或 AI 回复摘要"""
+    if kind == 'u':
+        return user_prompt_text(msg)
+    if kind == 't':
+        return tool_result_summary(msg)
+    if kind == 'a':
+        return assistant_summary(msg)
+    return None
+
+
+def window_feed(window, kind, ts, text):
+    """向窗口喂入一条记录，text() 按需返回 record_text 的结果；窗口已满时返回 True"""
+    if ts is not None and len(window["timestamps"]) < RECENT_TIMESTAMPS:
+        window["timestamps"].append(ts)
+
+    if kind == 'u' and len(window["users"]) < 3:
+        prompt = text()
+        if prompt:
+            window["users"].append(prompt)
+
+    if kind == 't' and len(window["tools"]) < 2:
+        summary = text()
+        if summary:
+            window["tools"].append(summary)
+    elif kind == 'a' and window["ai"] is None:
+        window["ai"] = text()
+
+    return (len(window["users"]) >= 3 and len(window["timestamps"]) >= RECENT_TIMESTAMPS
+            and (len(window["tools"]) >= 2 or window["ai"] is not None))
+
+
+def window_result(window, result):
+    result["prompt"] = select_prompt(window["users"])
+    if window["tools"]:
+        result["response"] = "\n".join(window["tools"])
+    elif window["ai"]:
+        result["response"] = window["ai"]
+    result["duration"] = duration_from_timestamps(window["timestamps"])
+    return result
+
+
+def tool_calls(msg):
+    """assistant 记录中发起的工具调用 [[tool_use id, 工具名], ...]"""
+    message = msg.get('message') if isinstance(msg, dict) else None
+    content = message.get('content') if isinstance(message, dict) else None
+    if not isinstance(content, list):
+        return []
+    return [[str(item['id']), str(item.get('name') or '?')] for item in content
+            if isinstance(item, dict) and item.get('type') == 'tool_use' and item.get('id')]
+
+
+def record_links(buf, start, end, kind, msg):
+    """
+    返回记录在工具计时中的 (类别, 关联)：发起工具调用的 assistant 记录为 ('a', [[id, 工具名], ...])，
+    携带 tool_result 的记录为 ('r', [id, ...])，其余为 (kind, None)。
+    tool_result 记录通常是巨大的工具输出，不解码，只在前 TOOL_ID_SCAN_BYTES 字节内按字节查找 id。
+    """
+    if kind == 'a':
+        return kind, tool_calls(msg) or None
+    if kind:
+        return kind, None
+    limit = min(end, start + TOOL_ID_SCAN_BYTES)
+    ids = []
+    pos = buf.find(b'"tool_use_id"', start, limit)
+    while pos != -1:
+        match = TOOL_USE_ID_MARKER.match(buf, pos, limit)
+        if match:
+            ids.append(match.group(1).decode('utf-8', 'replace'))
+        pos = buf.find(b'"tool_use_id"', pos + 1, limit)
+    return ('r', ids) if ids else (kind, None)
+
+
+def new_timing():
+    """
+    当前轮次耗时拆分的累积状态（与 window 一样按从新到旧的顺序喂入）。
+    已配对的工具区间存放在 array 中，未配对的 tool_result 按 id 记录结束时间。
+    """
+    return {"end": None, "start": None, "done": False, "results": {},
+            "starts": array('d'), "ends": array('d'), "names": []}
+
+
+def timing_feed(timing, kind, ts, links):
+    """喂入一条记录；遇到本轮的用户输入（轮次起点）后不再接收"""
+    if timing["done"]:
+        return
+    if ts is not None and timing["end"] is None:
+        timing["end"] = ts
+    if kind == 'u':
+        timing["start"], timing["done"] = ts, True
+    elif ts is None:
+        return
+    elif kind == 'r' and links:
+        for tool_id in links:
+            timing["results"].setdefault(tool_id, ts)
+    elif kind == 'a' and links:
+        for tool_id, name in links:
+            end = timing["results"].pop(tool_id, None)
+            if end is not None and end >= ts:
+                timing["starts"].append(ts)
+                timing["ends"].append(end)
+                timing["names"].append(name)
+
+
+def timing_result(timing):
+    """
+    返回 {"start": 本轮起点时间戳, "wall": 轮次总耗时, "model": 模型时间, "tools": [[工具名, 总耗时, 次数], ...]}（按耗时降序）；
+    没有找到轮次起点时返回 None。并行的工具调用按时间区间的并集计入，模型时间为其余部分。
+    """
+    if timing["start"] is None or timing["end"] is None or timing["end"] < timing["start"]:
+        return None
+    starts, ends, names = timing["starts"], timing["ends"], timing["names"]
+    busy = 0.0
+    covered = timing["start"]
+    per_tool = {}
+    for i in sorted(range(len(starts)), key=starts.__getitem__):
+        start, end = max(starts[i], timing["start"]), min(ends[i], timing["end"])
+        if end > covered:
+            busy += end - max(start, covered)
+            covered = end
+        total = per_tool.setdefault(names[i], [names[i], 0.0, 0])
+        total[1] += ends[i] - starts[i]
+        total[2] += 1
+    wall = timing["end"] - timing["start"]
+    tools = sorted(per_tool.values(), key=lambda item: -item[1])
+    return {"start": timing["start"], "wall": wall, "model": max(0.0, wall - busy),
+            "tools": [[n, round(t, 3), c] for n, t, c in tools]}
+
+
+def apply_timing(timing, result):
+    """找到轮次起点时用其总耗时代替按最近时间戳估算的耗时，并附上拆分"""
+    breakdown = timing_result(timing)
+    if breakdown is not None:
+        result["duration"] = breakdown["wall"]
+        result["timing"] = breakdown
+    return result
+
+
+def scan_transcript(transcript_path, records=None):
+    """
+    从 transcript 末尾反向扫描一次，同时得到用户 prompt、AI 响应摘要、耗时及其拆分
+    （模型时间与各工具时间，由 tool_use/tool_result 的时间戳配对得到）。
+
+    文件通过 mmap 映射，只解码实际访问到的尾部记录；当 3 条用户消息、20 个时间戳
+    和响应摘要都已收集到时立即停止，比当前轮次更早的记录不会被读取。
+    传入 records 列表时，会把扫描到的完整行的 [类别, 时间戳, 偏移] 追加进去，
+    并在结果中以 "offset" 返回已完整写入的字节数，供索引播种使用。
+    """
+    result = {"prompt": "无", "response": "无", "duration": 5.0, "bytes_parsed": 0}
+    try:
+        with open(transcript_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                result["prompt"] = "无 (空文件)"
+                return result
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                complete_end = find_newline_before(mm, len(mm)) + 1
+                result["offset"] = complete_end
+                window = new_window()
+                timing = new_timing()
+                lowest = len(mm)
+
+                for offset, line_end in iter_line_spans_reversed(mm):
+                    lowest = offset
+                    parsed = parse_line(mm, offset, line_end)
+                    if parsed is None:
+                        continue
+                    kind, ts, msg = parsed
+                    kind, links = record_links(mm, offset, line_end, kind, msg)
+                    if records is not None and offset < complete_end and (kind or ts is not None):
+                        records.append([kind, ts, offset, links] if links else [kind, ts, offset])
+                    timing_feed(timing, kind, ts, links)
+                    if window_feed(window, kind, ts, lambda: record_text(kind, msg)):
+                        break
+
+                result["bytes_parsed"] = len(mm) - lowest
+
+        if records is not None:
+            records.reverse()
+        return apply_timing(timing, window_result(window, result))
+
+    except FileNotFoundError:
+        result["prompt"] = "无 (文件不存在)"
+        return result
+    except Exception as e:
+        result["prompt"] = f"无 (错误: {str(e)[:50]})"
+        return result
+
+
+def transcript_key(transcript_path):
+    return hashlib.sha1(os.path.abspath(transcript_path).encode('utf-8')).hexdigest()[:20]
+
+
+def index_path_for(transcript_path):
+    return INDEX_DIR / f"{transcript_key(transcript_path)}.json"
+
+
+def load_index(transcript_path, st):
+    """读取 transcript 的 sidecar 索引；文件被替换或截断时返回 None"""
+    try:
+        with open(index_path_for(transcript_path), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (index.get("version") != INDEX_VERSION
+            or index.get("path") != os.path.abspath(transcript_path)
+            or index.get("inode") != st.st_ino
+            or index.get("offset", 0) > st.st_size):
+        return None
+    return index
+
+
+def save_index(transcript_path, index):
+    """原子写入索引（先写临时文件再 rename），只保留最近 INDEX_MAX_RECORDS 条记录"""
+    index["records"] = index["records"][-INDEX_MAX_RECORDS:]
+    dest = index_path_for(transcript_path)
+    try:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        # 被放弃的提取线程可能与下一轮同时保存索引，临时文件名按索引对象区分
+        tmp = dest.with_name(f".{dest.name}.{os.getpid()}.{id(index)}.tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp, dest)
+        return True
+    except OSError:
+        return False
+
+
+def analyze_transcript(transcript_path):
+    """
+    增量分析 transcript：只解析上次处理位置之后新追加的字节，
+    更早的轮次从 sidecar 索引中查找，必要的记录按偏移单独读取。
+    首次遇到的 transcript 用反向扫描的结果播种索引。
+    """
+    try:
+        st = os.stat(transcript_path)
+    except FileNotFoundError:
+        return {"prompt": "无 (文件不存在)", "response": "无", "duration": 5.0, "bytes_parsed": 0}
+    except OSError:
+        return scan_transcript(transcript_path)
+
+    index = load_index(transcript_path, st)
+    if index is None:
+        records = []
+        result = scan_transcript(transcript_path, records)
+        if "offset" in result:
+            save_index(transcript_path, {
+                "version": INDEX_VERSION,
+                "path": os.path.abspath(transcript_path),
+                "inode": st.st_ino,
+                "offset": result.pop("offset"),
+                "records": records,
+            })
+        return result
+
+    result = {"prompt": "无", "response": "无", "duration": 5.0, "bytes_parsed": 0}
+    try:
+        with open(transcript_path, 'rb') as f:
+            if st.st_size == 0:
+                result["prompt"] = "无 (空文件)"
+                return result
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # 只解析新追加的完整行
+                start = index["offset"]
+                complete_end = find_newline_before(mm, len(mm), start) + 1
+                if complete_end > start:
+                    records = index["records"]
+                    pos = start
+                    while pos < complete_end:
+                        nl = find_newline_after(mm, pos, complete_end)
+                        parsed = parse_line(mm, pos, nl)
+                        if parsed is not None:
+                            kind, ts, msg = parsed
+                            kind, links = record_links(mm, pos, nl, kind, msg)
+                            if kind or ts is not None:
+                                records.append([kind, ts, pos, links] if links else [kind, ts, pos])
+                        pos = nl + 1
+                    result["bytes_parsed"] = complete_end - start
+                    index["offset"] = complete_end
+                    save_index(transcript_path, index)
+
+                def read_record(offset):
+                    end = find_newline_after(mm, offset)
+                    return decode_record(mm, offset, end if end != -1 else len(mm))
+
+                window = new_window()
+                timing = new_timing()
+                for record in reversed(index["records"]):
+                    kind, ts, offset = record[:3]
+                    timing_feed(timing, kind, ts, record[3] if len(record) > 3 else None)
+                    if window_feed(window, kind, ts, lambda: record_text(kind, read_record(offset))):
+                        break
+                return apply_timing(timing, window_result(window, result))
+
+    except Exception as e:
+        result["prompt"] = f"无 (错误: {str(e)[:50]})"
+        return result
+
+
+def extract_from_transcript(transcript_path: str):
+    """
+    Extract last user message and AI response summary from transcript
+    """
+    result = scan_transcript(transcript_path)
+    return result["prompt"], result["response"]
+
+
+def calc_duration(transcript_path: str):
+    """
+    Calculate duration from transcript file (only last interaction)
+    """
+    return scan_transcript(transcript_path)["duration"]
+
+
+def turn_complete(transcript_path):
+    """
+    transcript 是否已写完当前轮次：文件以换行结尾，且最后一条 user/assistant 记录
+    是不再调用工具的 assistant 回复（跳过其后的 system 等记录）
+    """
+    try:
+        with open(transcript_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[-1:] != b'\n':
+                    return False
+                for checked, (start, end) in enumerate(iter_line_spans_reversed(mm)):
+                    if checked >= TURN_END_LOOKBACK:
+                        return False
+                    if JSON_WHITESPACE.match(mm, start, end).end() == end:
+                        continue
+                    try:
+                        msg = decode_record(mm, start, end)
+                    except ValueError:
+                        return False
+                    if not isinstance(msg, dict) or msg.get('type') not in ('user', 'assistant'):
+                        continue
+                    if msg['type'] != 'assistant':
+                        return False
+                    message = msg.get('message')
+                    if not isinstance(message, dict):
+                        return True
+                    if message.get('stop_reason') == 'tool_use':
+                        return False
+                    content = message.get('content')
+                    if isinstance(content, list):
+                        return not any(isinstance(item, dict) and item.get('type') == 'tool_use' for item in content)
+                    return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+
+def inotify_watch(path):
+    """返回监视 path 写入事件的非阻塞 inotify fd；非 Linux 或调用失败时返回 None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY | IN_CLOSE_WRITE) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def wait_for_transcript(transcript_path, timeout=TRANSCRIPT_WAIT_SECONDS):
+    """
+    等待 transcript 写完当前轮次。最后一条 assistant 回复落盘后立即返回；
+    否则在文件大小 TRANSCRIPT_STABLE_SECONDS 内不再变化时返回。
+    Linux 上通过 inotify 等待写入事件，其他平台退回到 stat 轮询。
+    """
+    import select
+
+    deadline = time.monotonic() + timeout
+    fd = inotify_watch(transcript_path)
+    last_size, last_change = None, time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            try:
+                size = os.path.getsize(transcript_path)
+            except OSError:
+                size = None
+            if size != last_size:
+                last_size, last_change = size, now
+                if size and turn_complete(transcript_path):
+                    return True
+            elif size and now - last_change >= TRANSCRIPT_STABLE_SECONDS:
+                return True
+
+            remaining = deadline - now
+            if remaining <= 0:
+                return False
+            wait = min(remaining, TRANSCRIPT_STABLE_SECONDS - (now - last_change) if size else TRANSCRIPT_STABLE_SECONDS)
+            if fd is None:
+                time.sleep(min(wait, TRANSCRIPT_POLL_INTERVAL))
+                continue
+            if select.select([fd], [], [], wait)[0]:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def session_state_path(session_id):
+    """每个会话的状态文件；session_id 含有文件名不安全的字符时使用其哈希"""
+    if not re.fullmatch(r'[\w.-]{1,128}', session_id) or session_id.startswith('.'):
+        session_id = hashlib.sha1(session_id.encode('utf-8')).hexdigest()
+    return SESSIONS_DIR / f"{session_id}.json"
+
+
+def prompt_command():
+    """Claude Code UserPromptSubmit hook 入口：记录本轮 prompt 原文和提交时间，不做其他工作"""
+    try:
+        input_data = json.load(sys.stdin)
+    except Exception:
+        return
+    if not isinstance(input_data, dict) or not input_data.get('session_id'):
+        return
+    session_id = str(input_data['session_id'])
+    state = {
+        "prompt": str(input_data.get('prompt', ''))[:SESSION_PROMPT_CHARS],
+        "submitted": time.time(),
+        "transcript_path": input_data.get('transcript_path', ''),
+    }
+    try:
+        write_json_atomic(session_state_path(session_id), state)
+    except OSError:
+        return
+    # 顺带清理很久没有活动的会话状态和 transcript 锁文件
+    cutoff = time.time() - SESSION_MAX_AGE
+    for directory, suffixes in ((SESSIONS_DIR, ('.json',)), (LOCK_DIR, ('.lock', '.pending'))):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(suffixes) and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def load_session_state(session_id, transcript_path):
+    """读取 UserPromptSubmit 记录的本轮状态；不存在、不属于该 transcript 或已被 Stop 用过时返回 None"""
+    if not session_id:
+        return None
+    try:
+        with open(session_state_path(session_id), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or not isinstance(state.get("submitted"), (int, float)):
+        return None
+    if transcript_path and state.get("transcript_path") and state["transcript_path"] != transcript_path:
+        return None
+    if state.get("consumed"):
+        return None
+    return state
+
+
+def consume_session_state(session_id, state, stopped):
+    """
+    标记会话状态已被本轮 Stop 使用。没有新的 UserPromptSubmit 时再次触发的 Stop（或延续的轮次）
+    不再沿用旧的 prompt 与提交时间，改用 transcript 中的内容。
+    """
+    try:
+        write_json_atomic(session_state_path(session_id), dict(state, consumed=stopped))
+    except OSError:
+        pass
+
+
+def rule_spec(rule):
+    """
+    把一条规则规范化为可 marshal 的 (条件列表, 动作)。每个条件是 (所需事实, 判定方式, 参数)，
+    glob 在这里展开为正则源码并校验一次；格式不正确的规则返回 None（被忽略）。
+    规范化结果随配置快照一起保存，hook 进程无需再次解析和翻译规则。
+    """
+    import fnmatch
+
+    if not isinstance(rule, dict) or not rule.get("enabled", True):
+        return None
+    match = rule.get("match") or {}
+    conditions = []
+    try:
+        for fact in ("project", "path"):
+            if fact in match:
+                patterns = match[fact] if isinstance(match[fact], list) else [match[fact]]
+                source = "|".join(fnmatch.translate(str(p)) for p in patterns)
+                re.compile(source)
+                conditions.append((fact, "match", source))
+        for fact in ("prompt", "response"):
+            if fact in match:
+                source = str(match[fact])
+                re.compile(source)
+                conditions.append((fact, "search", source))
+        if "min_duration" in match:
+            conditions.append(("duration", "ge", float(match["min_duration"])))
+        if "max_duration" in match:
+            conditions.append(("duration", "lt", float(match["max_duration"])))
+        if "status" in match:
+            statuses = match["status"] if isinstance(match["status"], list) else [match["status"]]
+            conditions.append(("status", "in", [str(s) for s in statuses]))
+    except (re.error, TypeError, ValueError):
+        return None
+
+    action = rule.get("action", "notify")
+    if action not in RULE_ACTIONS:
+        return None
+    # channels 只能是渠道名列表（缺省为全部渠道），window_seconds 只能是非负数；
+    # 其他取值（例如字符串 "ops" 或 "30"）视为格式错误，整条规则被忽略，而不是在 Stop hook 中出错
+    channels = rule.get("channels")
+    if channels is not None and (not isinstance(channels, list)
+                                 or not all(isinstance(name, str) for name in channels)):
+        return None
+    window = rule.get("window_seconds")
+    if window is not None and (isinstance(window, bool) or not isinstance(window, (int, float)) or window < 0):
+        return None
+    return conditions, {
+        "action": action,
+        "channels": channels,
+        "window_seconds": window,
+        "rule": rule.get("name", ""),
+    }
+
+
+def rule_specs(rules):
+    return [spec for spec in (rule_spec(rule) for rule in rules) if spec is not None]
+
+
+def compile_rule(spec):
+    """把规范化的规则编译为 (条件列表, 动作)。每个条件是 (所需事实, 判定函数)"""
+    conditions, action = spec
+    predicates = []
+    for fact, op, arg in conditions:
+        if op == "match":
+            regex = re.compile(arg)
+            predicates.append((fact, lambda value, regex=regex: bool(regex.match(value or ""))))
+        elif op == "search":
+            regex = re.compile(arg)
+            predicates.append((fact, lambda value, regex=regex: bool(regex.search(value or ""))))
+        elif op == "ge":
+            predicates.append((fact, lambda value, low=arg: value >= low))
+        elif op == "lt":
+            predicates.append((fact, lambda value, high=arg: value < high))
+        else:
+            predicates.append((fact, lambda value, statuses=set(arg): value in statuses))
+    return predicates, action
+
+
+def compiled_rules(config):
+    """
+    返回编译好的规则列表。load_config 已把快照中的规范化规则放进缓存，这里只做一次列表比较，
+    配置未变化时不再序列化或翻译规则；传入的规则与缓存不同（例如嵌入调用自行构造的配置）时重新规范化。
+    """
+    rules = config.get("rules") or []
+    if COMPILED_RULES_CACHE.get("rules") != rules:
+        COMPILED_RULES_CACHE.clear()
+        COMPILED_RULES_CACHE.update(rules=rules, specs=rule_specs(rules))
+    if "compiled" not in COMPILED_RULES_CACHE:
+        COMPILED_RULES_CACHE["compiled"] = [compile_rule(spec) for spec in COMPILED_RULES_CACHE["specs"]]
+    return COMPILED_RULES_CACHE["compiled"]
+
+
+def evaluate_rules(config, facts):
+    """
+    按顺序匹配规则，返回第一条命中规则的动作；没有规则命中时返回默认动作（notify 到全部渠道）。
+    facts 中缺失的事实视为未知：在确定的命中之前遇到依赖未知事实的规则时返回 None，
+    调用方补充事实（如解析 transcript）后再次求值。这样只依赖项目路径或耗时的规则
+    可以在解析 transcript 和任何网络 I/O 之前就作出决定。
+    """
+    for conditions, action in compiled_rules(config):
+        unknown = False
+        for fact, predicate in conditions:
+            if fact not in facts:
+                unknown = True
+            elif not predicate(facts[fact]):
+                break
+        else:
+            if unknown:
+                return None
+            return action
+    return DEFAULT_RULE_ACTION
+
+
+def status_allowed(config, status):
+    """notifications.on_success/on_failure/on_error 过滤"""
+    return config.get("notifications", {}).get(f"on_{status}", True)
+
+
+def notification_digest(parts):
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def is_duplicate(config, parts):
+    """
+    按内容哈希判断 dedup.window_seconds 内是否已发送过相同的通知，未发送过时记录下来
+    （投递失败时调用方需用 forget_notification 撤销记录，否则重试会被当成重复）。
+    哈希只覆盖工作目录、prompt、响应摘要和目标渠道，不含耗时与完成时间，
+    因此几乎同时触发的多个 Stop hook 产生的同一条通知只会发送一次。
+    记录保存在有上限的 LRU 中，超出 DEDUP_MAX_ENTRIES 时淘汰最久未出现的哈希。
+    """
+    window = config.get("dedup", {}).get("window_seconds", 0)
+    if not window or window <= 0:
+        return False
+    digest = notification_digest(parts)
+    now = time.time()
+
+    def check(state):
+        seen = state.get(digest)
+        duplicate = isinstance(seen, (int, float)) and now - seen < window
+        # 重新插入使该哈希成为最新；重复时保留首次发送的时间，窗口不会被持续的重复延长
+        state.pop(digest, None)
+        state[digest] = seen if duplicate else now
+        for key in list(state)[:max(0, len(state) - DEDUP_MAX_ENTRIES)]:
+            del state[key]
+        return duplicate
+
+    return update_json_locked(DEDUP_PATH, check)
+
+
+def forget_notification(config, parts):
+    """撤销 is_duplicate 记录的哈希，使投递失败的通知可以重试"""
+    window = config.get("dedup", {}).get("window_seconds", 0)
+    if not window or window <= 0:
+        return
+    digest = notification_digest(parts)
+    update_json_locked(DEDUP_PATH, lambda state: state.pop(digest, None))
+
+
+def notify(config, command="", response="", duration=0.0, working_dir="", action=None, budget=None, timing=None):
+    """
+    通知一次完成的交互。action 为规则求值结果：drop 时不发送，channels 限定发送渠道，
+    digest 或配置了汇总窗口时事件先写入 outbox，窗口内的事件由后台 flusher 合并为一条汇总消息；
+    否则立即渲染并投递。budget 为调用方剩余的秒数（见 deliver_message），timing 为耗时拆分。
+    """
+    action = action or DEFAULT_RULE_ACTION
+    if action["action"] == "drop":
+        return True, f"已按规则忽略{'（' + action['rule'] + '）' if action['rule'] else ''}"
+    channels = action["channels"]
+    # 先确认能够投递再做重复判断：未启用或没有渠道时不记录哈希，配置好后重试不会被当成重复
+    if not config.get("enabled", True):
+        return False, "通知已禁用"
+    if not has_channels(config, channels):
+        return False, NO_CHANNEL_MESSAGE
+    parts = [working_dir, command, response, channels]
+    if is_duplicate(config, parts):
+        return True, "与最近的通知重复，已忽略"
+    try:
+        success, message = notify_unique(config, command, response, duration, working_dir, action, budget, timing)
+    except BaseException:
+        # 哈希已经记录，发送过程中出错时撤销，重试不会被当成重复而丢失
+        forget_notification(config, parts)
+        raise
+    if not success:
+        forget_notification(config, parts)
+    return success, message
+
+
+def notify_unique(config, command, response, duration, working_dir, action, budget, timing):
+    """notify 通过重复判断之后的部分：加入汇总队列或立即渲染并投递"""
+    channels = action["channels"]
+    window = config.get("digest", {}).get("window_seconds", 0)
+    if action["action"] == "digest":
+        window = action["window_seconds"] or window or DIGEST_DEFAULT_WINDOW
+    if window and window > 0:
+        event = {
+            "command": command,
+            "response": response,
+            "duration": duration,
+            "working_dir": working_dir,
+            "time": time.time(),
+        }
+        try:
+            enqueue_event(event, window, channels)
+        except OSError:
+            pass
+        else:
+            if not spawn_flusher():
+                flush_outbox(max_seconds=0)
+            return True, f"已加入汇总队列（{window} 秒内的通知将合并发送）"
+
+    title, content = format_message(config, command, response, duration, working_dir, timing)
+    return deliver_message(config, title, content, channels, budget)
+
+
+def try_lock(path):
+    """以非阻塞方式获取文件锁；成功时返回持有锁的文件对象，锁已被其他进程持有时返回 None"""
+    import fcntl
+
+    f = open(path, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def pending_mtime(path):
+    """pending 标记的写入时间；标记不存在时返回 None"""
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return None
+
+
+def follow_up_pending(pending_path, transcript_path, consumed):
+    """
+    single-flight 是否需要为 pending 标记再处理一轮：返回标记的写入时间，不需要时返回 None。
+    上一轮处理到 consumed 字节后 transcript 没有新追加的内容时，再来一轮只会重复分析同一段尾部、
+    重复发送同一条消息，这时直接清除标记。consumed 为 None（上一轮未读取 transcript）时照常处理。
+    """
+    pending_at = pending_mtime(pending_path)
+    if pending_at is None or consumed is None:
+        return pending_at
+    try:
+        size = os.path.getsize(transcript_path)
+    except OSError:
+        size = 0
+    if size > consumed:
+        return pending_at
+    pending_path.unlink(missing_ok=True)
+    return None
+
+
+def call_with_timeout(func, timeout, *args):
+    """
+    在守护线程中调用 func(*args)，timeout 秒内返回时得到其结果，否则放弃等待并返回 None。
+    被放弃的线程不会阻塞进程退出（守护线程随进程结束）。
+    """
+    import threading
+
+    result = []
+
+    def run():
+        try:
+            result.append(func(*args))
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(max(0.0, timeout))
+    return result[0] if result else None
+
+
+def cached_duration(transcript_path):
+    """不解析 transcript，只用 sidecar 索引中已缓存的时间戳估算耗时；没有可用索引时返回 None"""
+    try:
+        index = load_index(transcript_path, os.stat(transcript_path))
+    except OSError:
+        return None
+    if index is None:
+        return None
+    recent = [record[1] for record in reversed(index["records"][-RECENT_TIMESTAMPS * 4:]) if record[1] is not None]
+    if len(recent) < 2:
+        return None
+    return duration_from_timestamps(recent[:RECENT_TIMESTAMPS])
+
+
+def stop_round(config, input_data, stopped, lap, deadline):
+    """
+    处理一次 Stop 事件：求值规则、等待 transcript 写完、提取内容并发送，
+    返回写入 metrics 的结果字段。
+
+    各阶段共用截止到 deadline（time.monotonic()）的时间预算，时间不够时依次降级而不是被超时杀掉：
+    跳过等待 transcript、跳过响应摘要（prompt 和耗时改用 UserPromptSubmit 记录或索引缓存）、
+    改为写入 outbox 由后台发送。降级的阶段记录在结果的 degraded 字段中。
+    """
+    def remaining():
+        return deadline - time.monotonic()
+
+    degraded = []
+    cwd = input_data.get('cwd', '')
+    transcript_path = input_data.get('transcript_path', '')
+    # UserPromptSubmit hook 记录了本轮 prompt 与提交时间时，直接得到准确的 prompt 和耗时
+    session = load_session_state(input_data.get('session_id'), transcript_path)
+    if session is not None:
+        consume_session_state(input_data.get('session_id'), session, stopped)
+
+    # 先用无需解析 transcript 就能得到的事实求值规则，能直接决定时跳过等待、解析和发送
+    facts = {"project": project_name_of(cwd), "path": cwd}
+    if session is not None:
+        facts["duration"] = max(0.0, stopped - session["submitted"])
+        if session.get("prompt"):
+            facts["prompt"] = session["prompt"]
+    action = evaluate_rules(config, facts)
+    lap("rules")
+    if action is not None and action["action"] == "drop":
+        return {"result": "dropped", "detail": action["rule"][:60], "success": True,
+                "message": f"已按规则忽略{'（' + action['rule'] + '）' if action['rule'] else ''}"}
+
+    if transcript_path:
+        wait_budget = min(TRANSCRIPT_WAIT_SECONDS, remaining() - EXTRACT_RESERVE)
+        if wait_budget > 0:
+            wait_for_transcript(transcript_path, wait_budget)
+        else:
+            degraded.append("wait")
+        lap("wait")
+
+    # 提取用户 prompt、AI 响应摘要和耗时（同一次扫描完成）
+    transcript_bytes = bytes_parsed = 0
+    timing = None
+    status = "success"
+    if transcript_path and os.path.isfile(transcript_path):
+        # 扫描前的大小：本轮处理到这里，single-flight 据此判断后续轮次是否有新追加的内容
+        try:
+            transcript_bytes = os.path.getsize(transcript_path)
+        except OSError:
+            pass
+        scan = None
+        if remaining() > DELIVER_RESERVE:
+            scan = call_with_timeout(analyze_transcript, remaining() - DELIVER_RESERVE, transcript_path)
+        if scan is not None:
+            prompt_text, response_text, duration = scan["prompt"], scan["response"], scan["duration"]
+            timing = scan.get("timing")
+            if prompt_text.startswith("无 (错误"):
+                status = "error"
+            bytes_parsed = scan.get("bytes_parsed", 0)
+        else:
+            degraded.append("summary")
+            prompt_text = "Claude Code 响应完成"
+            response_text = "（hook 时间不足，未提取响应摘要）"
+            duration = cached_duration(transcript_path) or 5.0
+        lap("extract")
+    else:
+        prompt_text = "Claude Code 响应完成"
+        response_text = "AI 任务已完成"
+        duration = 5.0
+
+    # transcript 中的本轮起点晚于记录的提交时间：状态属于更早的轮次（例如该轮的 Stop 没有触发）
+    if session is not None and timing is not None and timing["start"] > session["submitted"] + SESSION_TURN_TOLERANCE:
+        session = None
+    if session is not None:
+        if session.get("prompt"):
+            prompt_text = session["prompt"]
+        duration = max(0.0, stopped - session["submitted"])
+
+    if action is None:
+        facts.update(prompt=prompt_text, response=response_text, duration=duration, status=status)
+        action = evaluate_rules(config, facts)
+    if status_allowed(config, status):
+        if config.get("delivery", {}).get("mode", "spool") != "spool" and direct_send_budget(config, remaining()) is None:
+            degraded.append("spool")
+        success, message = notify(config, prompt_text, response_text, duration, cwd, action, remaining(), timing)
+    else:
+        success, message = True, f"已按 notifications.on_{status} 设置忽略"
+    lap("deliver")
+
+    result = ("dropped" if action["action"] == "drop" else "ok") if success else "fail"
+    # 本轮起点（transcript 中的用户输入时间，或 UserPromptSubmit 记录的提交时间）标识这一轮，
+    # 同一轮多次触发的 Stop 在历史库中只占一行
+    turn_start = timing["start"] if timing is not None else session["submitted"] if session is not None else None
+    record_turn(config, {
+        "turn_start": round(turn_start, 3) if turn_start is not None else None,
+        "ts": round(stopped, 3),
+        "project": facts["project"],
+        "cwd": cwd,
+        "session_id": input_data.get('session_id'),
+        "prompt": prompt_text,
+        "response": response_text,
+        "duration": round(duration, 3),
+        "status": status,
+        "result": result,
+    })
+
+    outcome = {
+        "result": result,
+        "detail": message[:60],
+        "transcript_bytes": transcript_bytes,
+        "bytes_parsed": bytes_parsed,
+        "success": success,
+        "message": message,
+    }
+    if degraded:
+        outcome["degraded"] = degraded
+    return outcome
+
+
+def stop_command():
+    """
+    Claude Code Stop hook 入口：从标准输入读取 hook JSON，在同一进程内完成提取、计时与发送。
+
+    子代理和连续的轮次会在一秒内为同一个 transcript 触发多个 Stop hook。同一 transcript
+    同时只有一个 hook 进程工作：拿不到锁的进程留下 pending 标记后立即退出，
+    持锁进程完成本轮后发现标记且 transcript 有新追加的内容时，再为新追加的尾部处理一轮。
+    """
+    stages = {}
+    start = last = time.perf_counter()
+    started = time.monotonic()
+
+    def lap(name):
+        nonlocal last
+        now = time.perf_counter()
+        add_stage(stages, name, (now - last) * 1000)
+        last = now
+
+    try:
+        input_data = json.load(sys.stdin)
+    except Exception:
+        input_data = {}
+    if not isinstance(input_data, dict):
+        input_data = {}
+
+    stopped = time.time()
+    transcript_path = input_data.get('transcript_path', '')
+    lap("input")
+
+    config = load_config()
+    lap("config")
+    # 整个 hook（包括 single-flight 的后续轮次）共用一个截止时间，保证在 Claude Code 的超时前完成投递
+    deadline = started + config.get("delivery", {}).get("hook_budget_seconds", HOOK_BUDGET)
+
+    lock = pending_path = None
+    if transcript_path:
+        lock_path = LOCK_DIR / f"{transcript_key(transcript_path)}.lock"
+        pending_path = lock_path.with_suffix(".pending")
+        try:
+            LOCK_DIR.mkdir(parents=True, exist_ok=True)
+            lock = try_lock(lock_path)
+            if lock is None:
+                pending_path.touch()
+                # 持锁进程可能恰好在标记写入前结束，再尝试一次
+                lock = try_lock(lock_path)
+                if lock is None:
+                    stages["total"] = (time.perf_counter() - start) * 1000
+                    record_metrics(config, {"kind": "stop", "project": project_name_of(input_data.get('cwd', '')),
+                                            "result": "coalesced", "stages": stages})
+                    print("✅ 同一会话的另一个 hook 正在处理，已合并")
+                    return
+        except OSError:
+            lock = None
+
+    rounds = 0
+    round_start = start
+    results = []
+    consumed = None
+
+    def finish_round(outcome):
+        """每轮写一条 metrics 记录（第一轮包含读取输入与配置的耗时），避免后续轮次覆盖前面的结果"""
+        nonlocal stages, round_start
+        stages["total"] = (last - round_start) * 1000
+        results.append((outcome.pop("success"), outcome.pop("message")))
+        record_metrics(config, {
+            "kind": "stop",
+            "project": project_name_of(input_data.get('cwd', '')),
+            **outcome,
+            "round": rounds,
+            "stages": stages,
+        })
+        stages, round_start = {}, last
+
+    while True:
+        try:
+            while True:
+                if lock is not None:
+                    pending_path.unlink(missing_ok=True)
+                outcome = stop_round(config, input_data, stopped, lap, deadline)
+                rounds += 1
+                consumed = outcome.get("transcript_bytes") if outcome["result"] != "dropped" else None
+                finish_round(outcome)
+                pending_at = follow_up_pending(pending_path, transcript_path, consumed) if lock is not None else None
+                if pending_at is None or rounds >= SINGLE_FLIGHT_MAX_ROUNDS or time.monotonic() >= deadline:
+                    break
+                # 后到的 hook 对应更晚的轮次，耗时按它的结束时间计算
+                stopped = pending_at
+        finally:
+            if lock is not None:
+                lock.close()
+        # 释放锁后再检查一次，避免错过释放期间写入的标记（其进程因拿不到锁已退出）
+        pending_at = follow_up_pending(pending_path, transcript_path, consumed) if lock is not None else None
+        if pending_at is None or rounds >= SINGLE_FLIGHT_MAX_ROUNDS or time.monotonic() >= deadline:
+            break
+        try:
+            lock = try_lock(lock_path)
+        except OSError:
+            lock = None
+        if lock is None:
+            break
+        stopped = pending_at
+
+    # 任一轮失败都要报告出来，否则报告最后一轮的结果
+    failed = [message for success, message in results if not success]
+    if failed:
+        print(f"❌ 通知发送失败: {failed[-1]}")
+    else:
+        print(f"✅ {results[-1][1]}")
+
+
+def read_metrics():
+    """按时间顺序读取 metrics 日志（含轮转出的旧文件），跳过损坏的行"""
+    records = []
+    for path in (METRICS_PATH.with_name(METRICS_PATH.name + ".1"), METRICS_PATH):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict):
+                        records.append(record)
+        except FileNotFoundError:
+            continue
+    return records
+
+
+def percentile(sorted_values, pct):
+    """最近秩法求百分位数，sorted_values 需已排序且非空"""
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def print_percentiles(label, samples):
+    if not samples:
+        return
+    values = sorted(samples)
+    print(f"  {label:<16}{len(values):>6}{percentile(values, 50):>11.1f}{percentile(values, 95):>11.1f}"
+          f"{percentile(values, 99):>11.1f}{values[-1]:>11.1f}")
+
+
+def stats_command(args):
+    """打印 metrics 日志中各阶段、各项目耗时的 p50/p95/p99（毫秒）"""
+    records = read_metrics()
+    if args.hours:
+        since = time.time() - args.hours * 3600
+        records = [r for r in records if r.get("ts", 0) >= since]
+    if args.project:
+        records = [r for r in records if r.get("kind") != "stop" or r.get("project") == args.project]
+    if not records:
+        print(f"📭 暂无 metrics 记录: {METRICS_PATH}")
+        return
+
+    header = f"  {'':<16}{'次数':>5}{'p50':>11}{'p95':>11}{'p99':>11}{'max':>11}"
+    for kind, title in (("stop", "Stop hook 各阶段耗时 (ms)"), ("send", "发送各阶段耗时 (ms)")):
+        subset = [r for r in records if r.get("kind") == kind]
+        if not subset:
+            continue
+        results = {}
+        for r in subset:
+            results[r.get("result", "?")] = results.get(r.get("result", "?"), 0) + 1
+        summary = "，".join(f"{name} {count}" for name, count in sorted(results.items()))
+        print(f"📊 {title}（{len(subset)} 次：{summary}）")
+        degraded = {}
+        for r in subset:
+            for step in r.get("degraded", ()):
+                degraded[step] = degraded.get(step, 0) + 1
+        if degraded:
+            print("  ⏱️ 时间不足而降级: " + "，".join(f"{name} {count}" for name, count in sorted(degraded.items())))
+        print(header)
+        stage_names = []
+        for r in subset:
+            for name in r.get("stages", {}):
+                if name not in stage_names:
+                    stage_names.append(name)
+        for name in stage_names:
+            print_percentiles(name, [r["stages"][name] for r in subset if name in r.get("stages", {})])
+        print()
+
+    stops = [r for r in records if r.get("kind") == "stop"]
+    if stops:
+        projects = {}
+        for r in stops:
+            projects.setdefault(r.get("project") or "(未知)", []).append(r)
+        print("📁 按项目统计 Stop hook 总耗时 (ms)")
+        print(header)
+        for name, project_records in sorted(projects.items(), key=lambda item: -len(item[1])):
+            print_percentiles(name, [r["stages"].get("total", 0.0) for r in project_records])
+        largest = max(stops, key=lambda r: r.get("transcript_bytes", 0))
+        if largest.get("transcript_bytes"):
+            print(f"\n📄 最大 transcript: {largest['transcript_bytes'] / 1024 / 1024:.1f} MB"
+                  f"（{largest.get('project') or '(未知)'}，本次解析 {largest.get('bytes_parsed', 0) / 1024:.1f} KB）")
+
+
+def open_history():
+    """打开历史库（WAL 模式），必要时建表；返回 sqlite3 连接"""
+    import sqlite3
+
+    HISTORY_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(HISTORY_DB_PATH), timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(HISTORY_SCHEMA)
+    # 旧版本建的表没有 turn_start 列；同一会话同一轮（起点相同）只保留一行
+    if "turn_start" not in {row[1] for row in conn.execute("PRAGMA table_info(turns)")}:
+        conn.execute("ALTER TABLE turns ADD COLUMN turn_start REAL")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS turns_session_turn ON turns (session_id, turn_start)")
+    # 旧版本 report 回填的轮次只写入了 transcript_turns；清除扫描位置，下次 report 全部重新扫描并写入 turns
+    if conn.execute("PRAGMA user_version").fetchone()[0] < HISTORY_SCHEMA_VERSION:
+        with conn:
+            conn.execute("DELETE FROM transcript_offsets")
+            conn.execute(f"PRAGMA user_version = {HISTORY_SCHEMA_VERSION}")
+    return conn
+
+
+def ingest_history(conn=None):
+    """
+    把 pending 日志中的所有记录在一个事务中批量写入历史库，成功后清空日志，返回写入的行数。
+    按 (ts, cwd) 去重，写入后、清空前中断也不会产生重复行；同一轮再次触发的 Stop
+    （session_id 与 turn_start 相同）替换该轮已有的行，不会重复计入耗时统计。
+    """
+    import fcntl
+
+    try:
+        f = open(HISTORY_PENDING_PATH, 'r+b')
+    except FileNotFoundError:
+        return 0
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        rows = []
+        for line in f:
+            try:
+                turn = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(turn, dict) and turn.get("ts") is not None:
+                rows.append(tuple(turn.get(column) for column in HISTORY_COLUMNS))
+        if rows:
+            own = conn is None
+            conn = open_history() if own else conn
+            try:
+                with conn:
+                    conn.executemany(
+                        f"INSERT OR REPLACE INTO turns ({', '.join(HISTORY_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(HISTORY_COLUMNS))})", rows)
+            finally:
+                if own:
+                    conn.close()
+        f.truncate(0)
+    return len(rows)
+
+
+def history_command(args):
+    """查询历史库：最近的轮次、耗时最长的轮次，或按项目统计耗时分布"""
+    conn = open_history()
+    try:
+        ingest_history(conn)
+        where, params = ["ts >= ?"], [time.time() - args.days * 86400]
+        if args.project:
+            where.append("project = ?")
+            params.append(args.project)
+        clause = " AND ".join(where)
+
+        if args.projects:
+            rows = conn.execute(f"SELECT project, duration FROM turns WHERE {clause} AND duration IS NOT NULL "
+                                f"ORDER BY project, duration", params).fetchall()
+            projects = {}
+            for project, duration in rows:
+                projects.setdefault(project, []).append(duration)
+            report = [{"project": project, "turns": len(values), "total": sum(values),
+                       "p50": percentile(values, 50), "p95": percentile(values, 95), "max": values[-1]}
+                      for project, values in projects.items()]
+            report.sort(key=lambda item: -item[args.sort])
+            if args.json:
+                print(json.dumps(report, ensure_ascii=False, indent=2))
+                return
+            if not report:
+                print(f"📭 最近 {args.days:g} 天没有记录")
+                return
+            print(f"📁 最近 {args.days:g} 天各项目轮次耗时（秒）")
+            # 表头的中文字符占两列宽度，填充宽度相应减小
+            print(f"  {'项目':<22}{'轮次':>4}{'合计':>9}{'p50':>9}{'p95':>9}{'max':>9}")
+            for item in report[:args.limit]:
+                print(f"  {item['project'][:24]:<24}{item['turns']:>6}{item['total']:>11.1f}"
+                      f"{item['p50']:>9.1f}{item['p95']:>9.1f}{item['max']:>9.1f}")
+            return
+
+        order = "duration DESC" if args.longest else "ts DESC"
+        rows = conn.execute(f"SELECT ts, project, duration, status, prompt FROM turns WHERE {clause} "
+                            f"ORDER BY {order} LIMIT ?", params + [args.limit]).fetchall()
+        if args.json:
+            print(json.dumps([dict(zip(("ts", "project", "duration", "status", "prompt"), row)) for row in rows],
+                             ensure_ascii=False, indent=2))
+            return
+        if not rows:
+            print(f"📭 最近 {args.days:g} 天没有记录")
+            return
+        durations = sorted(d for (d,) in conn.execute(
+            f"SELECT duration FROM turns WHERE {clause} AND duration IS NOT NULL", params))
+        if durations:
+            print(f"📊 最近 {args.days:g} 天共 {len(durations)} 轮，耗时 p50 {percentile(durations, 50):.1f}s，"
+                  f"p95 {percentile(durations, 95):.1f}s，p99 {percentile(durations, 99):.1f}s")
+        print(f"{'⏱️ 耗时最长的轮次' if args.longest else '🕘 最近的轮次'}")
+        for ts, project, duration, status, prompt in rows:
+            when = datetime.fromtimestamp(ts).strftime('%m-%d %H:%M')
+            flag = "" if status in (None, "success") else f" [{status}]"
+            prompt = " ".join((prompt or "").split())
+            print(f"  {when}  {project[:20]:<20}{duration or 0:>9.1f}s  {prompt[:40]}{flag}")
+    finally:
+        conn.close()
+
+
+def backfill_transcript(path, offset=0, idle_seconds=REPORT_IDLE_SECONDS):
+    """
+    从 offset 开始顺序扫描一个 transcript，按真实用户输入切分轮次，每轮用与 Stop hook 相同的
+    窗口与计时逻辑（window_feed / timing_feed）得到 prompt、响应摘要和耗时。
+
+    文件在 idle_seconds 内仍有写入时，最后一轮视为未结束：不输出，offset 停在该轮开头，
+    下次从这里继续。在进程池的工作进程中运行，返回可序列化的 dict。
+    """
+    result = {"path": path, "inode": None, "offset": offset, "scanned": offset, "pending": False, "turns": []}
+    fallback_project = os.path.basename(os.path.dirname(path))
+    # transcript 文件名就是会话 ID（记录中的 sessionId 优先）
+    fallback_session = os.path.splitext(os.path.basename(path))[0]
+
+    def finish(turn):
+        window = new_window()
+        for kind, ts, text, _ in reversed(turn["records"]):
+            if window_feed(window, kind, ts, lambda: text):
+                break
+        timing = new_timing()
+        for kind, ts, _, links in reversed(turn["records"]):
+            timing_feed(timing, kind, ts, links)
+        times = [record[1] for record in turn["records"] if record[1] is not None]
+        if not times:
+            return
+        summary = apply_timing(timing, window_result(window, {"prompt": "无", "response": "无", "duration": 5.0}))
+        turn_start = summary["timing"]["start"] if "timing" in summary else min(times)
+        result["turns"].append({
+            "offset": turn["offset"],
+            "ts": max(times),
+            "turn_start": round(turn_start, 3),
+            "session_id": turn["session_id"],
+            "cwd": turn["cwd"],
+            "project": project_name_of(turn["cwd"]) or fallback_project,
+            "prompt": summary["prompt"],
+            "response": summary["response"],
+            "duration": summary["duration"],
+        })
+
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            result["inode"] = st.st_ino
+            if st.st_size <= offset:
+                return result
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                complete_end = find_newline_before(mm, len(mm), offset) + 1
+                turn = None
+                pos = offset
+                while pos < complete_end:
+                    nl = find_newline_after(mm, pos, complete_end)
+                    parsed = parse_line(mm, pos, nl)
+                    if parsed is not None:
+                        kind, ts, msg = parsed
+                        kind, links = record_links(mm, pos, nl, kind, msg)
+                        if kind == 'u':
+                            if turn is not None:
+                                finish(turn)
+                            cwd, session_id = msg.get('cwd'), msg.get('sessionId')
+                            turn = {"offset": pos, "cwd": cwd if isinstance(cwd, str) else "",
+                                    "session_id": session_id if isinstance(session_id, str) else fallback_session,
+                                    "records": []}
+                        if turn is not None and (kind or ts is not None):
+                            text = record_text(kind, msg) if kind in ('u', 't', 'a') else None
+                            if kind == 'u' and text:
+                                text = text[:HISTORY_TEXT_CHARS]
+                            turn["records"].append((kind, ts, text, links))
+                    pos = nl + 1
+                result["scanned"] = max(offset, complete_end)
+                if turn is not None and time.time() - st.st_mtime < idle_seconds:
+                    result["offset"], result["pending"] = turn["offset"], True
+                else:
+                    if turn is not None:
+                        finish(turn)
+                    result["offset"] = result["scanned"]
+    except (OSError, ValueError) as e:
+        result["error"] = str(e)[:100]
+    return result
+
+
+def store_backfill(conn, result, rescan):
+    """
+    把一个 transcript 的扫描结果写入历史库；rescan 为 True 时先删除该文件已有的轮次。
+    轮次同时写入 history 查询的 turns 表，按 (session_id, turn_start) 与 Stop hook 记录的同一轮去重：
+    已有 hook 记录时保留它（带有发送结果），之后才写入的 hook 记录会替换回填的行。
+    """
+    path = result["path"]
+    if rescan:
+        conn.execute("DELETE FROM transcript_turns WHERE path = ?", (path,))
+    conn.executemany(
+        "INSERT OR REPLACE INTO transcript_turns (path, offset, ts, project, prompt, response, duration) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(path, t["offset"], t["ts"], t["project"], t["prompt"], t["response"], t["duration"]) for t in result["turns"]])
+    conn.executemany(
+        "INSERT OR IGNORE INTO turns (ts, project, cwd, session_id, prompt, response, duration, result, turn_start) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, 'backfill', ?)",
+        [(t["ts"], t["project"], t["cwd"], t["session_id"], t["prompt"][:HISTORY_TEXT_CHARS],
+          t["response"][:HISTORY_TEXT_CHARS], t["duration"], t["turn_start"]) for t in result["turns"]])
+    conn.execute(
+        "INSERT OR REPLACE INTO transcript_offsets (path, inode, offset, scanned, pending) VALUES (?, ?, ?, ?, ?)",
+        (path, result["inode"], result["offset"], result["scanned"], int(result["pending"])))
+
+
+def backfill_transcripts(conn, root, workers=None, rebuild=False):
+    """
+    增量扫描 root 下的所有 transcript，把新完成的轮次写入历史库。
+    未变化的文件直接跳过，其余文件按待扫描字节数从大到小分配给进程池。
+    返回 (扫描的文件数, 新增轮次数)。
+    """
+    known = {} if rebuild else {
+        path: (inode, offset, scanned, pending)
+        for path, inode, offset, scanned, pending in conn.execute(
+            "SELECT path, inode, offset, scanned, pending FROM transcript_offsets")}
+    now = time.time()
+    jobs = []
+    for path in root.rglob("*.jsonl"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        path = str(path)
+        state = known.get(path)
+        offset, rescan = 0, True
+        if state is not None and state[0] == st.st_ino and st.st_size >= state[2]:
+            inode, offset, scanned, pending = state
+            idle = now - st.st_mtime >= REPORT_IDLE_SECONDS
+            if st.st_size == scanned and not (pending and idle):
+                continue
+            rescan = False
+        jobs.append((st.st_size - offset, path, offset, rescan))
+    jobs.sort(reverse=True)
+
+    rescans = {path: rescan for _, path, _, rescan in jobs}
+    added = 0
 
+    def store(results):
+        nonlocal added
+        for done, result in enumerate(results, 1):
+            store_backfill(conn, result, rescans[result["path"]])
+            added += len(result["turns"])
+            if done % REPORT_COMMIT_EVERY == 0:
+                conn.commit()
+        conn.commit()
 
-def save_config(config):
-    try:
-        with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
-        return True
-    except Exception as e:
-        print(f"配置文件保存失败: {e}")
-        return False
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(jobs) <= 1:
+        store(backfill_transcript(path, offset) for _, path, offset, _ in jobs)
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
 
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            futures = [executor.submit(backfill_transcript, path, offset) for _, path, offset, _ in jobs]
+            store(future.result() for future in as_completed(futures))
+    return len(jobs), added
 
-def generate_sign(timestamp, secret):
-    secret_enc = secret.encode('utf-8')
-    string_to_sign = f'{timestamp}\n{secret}'
-    string_to_sign_enc = string_to_sign.encode('utf-8')
-    hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
-    sign = base64.b64encode(hmac_code).decode('utf-8')
-    return sign
 
+def format_report(days, projects, daily, total_turns, total_seconds):
+    """把 report 的按项目/按天统计渲染为一条 Markdown 消息"""
+    title = f"Claude Code 使用报告（最近 {days:g} 天）"
+    lines = [f"# {title}", "", f"共 {total_turns} 轮，累计 {total_seconds / 3600:.1f} 小时，涉及 {len(projects)} 个项目", ""]
+    lines.append("### 📁 按项目")
+    for item in projects[:DIGEST_MAX_EVENTS]:
+        lines.append(f"- **{item['project']}**：{item['turns']} 轮，{item['total'] / 3600:.1f} 小时，"
+                     f"p50 {item['p50']:.0f}秒，p95 {item['p95']:.0f}秒")
+    if len(projects) > DIGEST_MAX_EVENTS:
+        lines.append(f"- …另有 {len(projects) - DIGEST_MAX_EVENTS} 个项目未列出")
+    lines.extend(["", "### 📅 按天"])
+    for item in daily:
+        lines.append(f"- {item['date']}：{item['turns']} 轮，{item['total'] / 3600:.1f} 小时，{item['projects']} 个项目")
+    lines.extend(["", f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"])
+    return title, "\n".join(lines)
 
-def send_dingtalk_message(config, title, content):
-    if not config.get("enabled", True):
-        return False, "通知已禁用"
-    
-    access_token = config.get("access_token", "")
-    
-    # 向后兼容：如果没有 access_token，尝试从 webhook_url 中提取
-    if not access_token:
-        webhook_url = config.get("webhook_url", "")
-        if webhook_url and "access_token=" in webhook_url:
-            access_token = webhook_url.split("access_token=")[1].split("&")[0]
-    
-    if not access_token:
-        return False, "未配置钉钉 access token 或 webhook_url"
-    
-    webhook_url = f"https://oapi.dingtalk.com/robot/send?access_token={access_token}"
-    
-    message = {
-        "msgtype": "markdown",
-        "markdown": {
-            "title": title,
-            "text": content
-        }
-    }
-    
-    if config.get("secret"):
-        timestamp = str(round(time.time() * 1000))
-        sign = generate_sign(timestamp, config["secret"])
-        webhook_url += f"&timestamp={timestamp}&sign={sign}"
-    
+
+def report_command(args):
+    """用进程池增量扫描 ~/.claude/projects 下的 transcript，输出按项目、按天的汇总，可选发送为一条消息"""
+    root = Path(args.root).expanduser() if args.root else CLAUDE_PROJECTS_DIR
+    conn = open_history()
     try:
-        data = json.dumps(message).encode('utf-8')
-        req = Request(
-            webhook_url,
-            data=data,
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        with urlopen(req, timeout=10) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            
-        if result.get('errcode') == 0:
-            return True, "消息发送成功"
-        else:
-            return False, f"钉钉API错误: {result.get('errmsg', '未知错误')}"
-            
-    except Exception as e:
-        return False, f"发送失败: {e}"
+        started = time.perf_counter()
+        scanned, added = backfill_transcripts(conn, root, args.workers, args.rebuild)
+        elapsed = time.perf_counter() - started
 
+        rows = conn.execute("SELECT ts, project, duration FROM transcript_turns WHERE ts >= ? ORDER BY ts",
+                            (time.time() - args.days * 86400,)).fetchall()
+    finally:
+        conn.close()
 
-def format_message(config, command="", response="", duration=0.0, working_dir=""):
-    template = config.get("message_template", {})
+    by_project, by_day = {}, {}
+    for ts, project, duration in rows:
+        duration = duration or 0.0
+        by_project.setdefault(project, []).append(duration)
+        day = by_day.setdefault(datetime.fromtimestamp(ts).strftime('%Y-%m-%d'), {"turns": 0, "total": 0.0, "projects": set()})
+        day["turns"] += 1
+        day["total"] += duration
+        day["projects"].add(project)
+    projects = []
+    for project, values in by_project.items():
+        values.sort()
+        projects.append({"project": project, "turns": len(values), "total": sum(values),
+                         "p50": percentile(values, 50), "p95": percentile(values, 95)})
+    projects.sort(key=lambda item: -item["total"])
+    daily = [{"date": date, "turns": day["turns"], "total": day["total"], "projects": len(day["projects"])}
+             for date, day in sorted(by_day.items(), reverse=True)]
+    total_seconds = sum(item["total"] for item in projects)
 
-    # 提取项目名称（从工作目录）
-    project_name = working_dir.split('/')[-1] if working_dir and '/' in working_dir else working_dir
+    if args.json:
+        print(json.dumps({"scanned": scanned, "added": added, "projects": projects, "daily": daily},
+                         ensure_ascii=False, indent=2))
+    else:
+        print(f"🔎 扫描 {scanned} 个有更新的 transcript，新增 {added} 轮，用时 {elapsed:.2f} 秒")
+        if not rows:
+            print(f"📭 最近 {args.days:g} 天没有记录")
+            return
+        print(f"📊 最近 {args.days:g} 天共 {len(rows)} 轮，累计 {total_seconds / 3600:.1f} 小时")
+        print(f"  {'项目':<22}{'轮次':>4}{'小时':>6}{'p50':>9}{'p95':>9}")
+        for item in projects:
+            print(f"  {item['project'][:24]:<24}{item['turns']:>6}{item['total'] / 3600:>8.1f}"
+                  f"{item['p50']:>9.1f}{item['p95']:>9.1f}")
+        print(f"  {'日期':<10}{'轮次':>4}{'小时':>6}{'项目数':>5}")
+        for item in daily:
+            print(f"  {item['date']:<12}{item['turns']:>6}{item['total'] / 3600:>8.1f}{item['projects']:>8}")
 
-    status_icon = "✅"
-    title = template.get('title', 'Claude Code 响应完成')
+    if args.send and rows:
+        config = load_config()
+        title, content = format_report(args.days, projects, daily, len(rows), total_seconds)
+        success, message = deliver_message(config, title, content)
+        print(f"✅ {message}" if success else f"❌ 报告发送失败: {message}")
 
-    lines = [
-        f"# {title}",
-        "",
-        f"{status_icon} **项目**: `{project_name}`",
-    ]
 
-    # 显示 AI 响应摘要（最多 500 字符）
-    if response and response != "AI 任务已完成":
-        response_display = response[:500] + '...' if len(response) > 500 else response
-        lines.append(f"")
-        lines.append(f"🤖 **AI 响应摘要**:")
-        lines.append(f"> {response_display}")
+def make_mock_server(host, port, secret="", rate_limit=RATE_LIMIT_PER_MINUTE, latency_ms=0.0, jitter_ms=0.0,
+                     error_rate=0.0, verbose=False):
+    """
+    创建钉钉机器人 API 的本地替身（尚未开始服务），返回 (server, stats)。
 
-    # 可选：显示额外信息
-    if template.get("include_duration", True) and duration > 0:
-        lines.append(f"")
-        lines.append(f"⏱️ 耗时: {duration:.1f}秒")
+    POST /robot/send 与真实接口一样校验 access_token、配置了 secret 时校验 timestamp/sign
+    （与 generate_sign 相同的算法，时间戳须在 1 小时内）以及 markdown/text 消息体；
+    每个 access_token 每分钟超过 rate_limit 条（0 表示不限）时返回 130101 限流错误。
+    每个请求可注入 latency_ms 加上 0~jitter_ms 的随机延迟，并按 error_rate 的比例返回 HTTP 500。
+    """
+    import collections
+    import random
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlsplit
 
-    if template.get("include_working_dir", True) and working_dir:
-        lines.append(f"📁 路径: `{working_dir}`")
+    lock = threading.Lock()
+    recent = {}
+    stats = {"requests": 0, "ok": 0, "ratelimited": 0, "bad_sign": 0, "bad_request": 0, "injected_errors": 0}
 
-    lines.extend([
-        "",
-        f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-    ])
+    def count(key):
+        with lock:
+            stats[key] += 1
 
-    content = "\n".join(lines)
-    return title, content
+    def check(parts, body):
+        """返回 (errcode, errmsg, 统计项)"""
+        query = parse_qs(parts.query)
+        token = query.get("access_token", [""])[0]
+        if not token:
+            return 300001, "token is not exist", "bad_request"
+        if secret:
+            timestamp, sign = query.get("timestamp", [""])[0], query.get("sign", [""])[0]
+            try:
+                skew = abs(time.time() * 1000 - int(timestamp))
+            except ValueError:
+                return 310000, "sign not match, timestamp is invalid", "bad_sign"
+            if skew > DINGTALK_SIGN_TOLERANCE_MS:
+                return 310000, "sign not match, timestamp is expired", "bad_sign"
+            if sign != generate_sign(timestamp, secret):
+                return 310000, "sign not match", "bad_sign"
+        try:
+            payload = json.loads(body)
+            msgtype = payload["msgtype"]
+            if msgtype == "markdown":
+                valid = bool(payload["markdown"]["title"]) and bool(payload["markdown"]["text"])
+            else:
+                valid = msgtype == "text" and bool(payload["text"]["content"])
+        except (ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            return 40035, "missing parameter json", "bad_request"
+        if rate_limit > 0:
+            now = time.monotonic()
+            with lock:
+                window = recent.setdefault(token, collections.deque())
+                while window and window[0] <= now - 60:
+                    window.popleft()
+                if len(window) >= rate_limit:
+                    return 130101, f"send too fast, exceed {rate_limit} times per minute", "ratelimited"
+                window.append(now)
+        return 0, "ok", "ok"
 
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 keep-alive，连接池复用连接的效果才能体现在测量结果中；响应头和响应体分两次写出，
+        # 关闭 Nagle 算法以免与客户端的延迟 ACK 叠加出约 40ms 的额外延迟
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
 
-def setup_hook():
-    # 复制脚本到用户目录
-    hooks_dir = Path.home() / ".claude" / "hooks"
-    hooks_dir.mkdir(parents=True, exist_ok=True)
+        def reply(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
 
-    # 辅助脚本内容（直接嵌入，避免依赖外部文件）
-    extract_messages_script = '''#!/usr/bin/env python3
-"""
-Extract user prompt and AI response summary from transcript
-"""
-import json
-import sys
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            count("requests")
+            delay = latency_ms + (random.uniform(0, jitter_ms) if jitter_ms > 0 else 0)
+            if delay > 0:
+                time.sleep(delay / 1000)
+            if error_rate > 0 and random.random() < error_rate:
+                count("injected_errors")
+                self.reply(500, {"errcode": -1, "errmsg": "injected server error"})
+                return
+            parts = urlsplit(self.path)
+            if parts.path != "/robot/send":
+                count("bad_request")
+                self.reply(404, {"errcode": 404, "errmsg": "not found"})
+                return
+            errcode, errmsg, outcome = check(parts, body)
+            count(outcome)
+            self.reply(200, {"errcode": errcode, "errmsg": errmsg})
 
-def get_content(msg, first_only=False):
-    """从消息中提取 content，支持多种格式
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
 
-    Args:
-        msg: 消息对象
-        first_only: 是否只返回第一个文本块（用于用户输入）
-    """
-    # 1. 直接的 content 字段
-    if 'content' in msg:
-        content = msg.get('content', '')
-    # 2. 嵌套在 message 对象中（Claude Code 实际格式）
-    elif 'message' in msg and isinstance(msg['message'], dict):
-        message = msg['message']
-        if 'content' in message:
-            content = message.get('content', '')
-        else:
-            return None
-    else:
-        return None
+    class Server(ThreadingHTTPServer):
+        # 默认的 listen 队列只有 5，并发会话多时连接会被丢弃并等待 1 秒后重传 SYN
+        request_queue_size = 128
+        daemon_threads = True
 
-    if isinstance(content, str):
-        return content
-    elif isinstance(content, list):
-        # 处理 content 为列表的情况（如 text 块）
-        texts = []
-        for item in content:
-            if isinstance(item, dict):
-                if item.get('type') == 'text':
-                    texts.append(item.get('text', ''))
-                elif 'text' in item:
-                    texts.append(item.get('text', ''))
-            elif isinstance(item, str):
-                texts.append(item)
-            # 如果只需要第一个，找到后立即返回
-            if first_only and texts:
-                return texts[0]
-        return ' '.join(texts) if texts else None
-    return None
+    return Server((host, port), Handler), stats
 
-def extract_from_transcript(transcript_path: str):
+
+def make_relay_server(host, port, certfile=None, keyfile=None):
     """
-    Extract last user message and AI response summary from transcript
+    创建 relay 服务器（尚未开始服务），返回 (server, stats)。
+
+    各开发机上的 hook 通过 relay 渠道把渲染好的消息 POST 到 /notify（Bearer token 认证，
+    token 在 relay.tokens 中按节点名配置）。relay 立即应答，由后台线程用自己配置中的渠道
+    （钉钉 token/secret 只保存在 relay 上）通过 keep-alive 连接池签名发送，
+    所有节点共享 relay 上的令牌桶与熔断器。配置了 digest.window_seconds 时，
+    窗口内各节点的消息合并为一条按节点分节的团队汇总。单个节点每分钟超过
+    relay.node_rate_limit_per_minute 条时返回 429，由节点的 outbox 稍后重试。
     """
-    try:
-        with open(transcript_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+    import collections
+    import hmac
+    import queue
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-        if not lines:
-            return "无 (空文件)", "无"
+    pool = HTTPSConnectionPool(max_idle=RELAY_WORKERS)
+    pending = queue.Queue(maxsize=RELAY_QUEUE_SIZE)
+    wake = threading.Event()
+    lock = threading.Lock()
+    recent = {}
+    stats = {"accepted": 0, "sent": 0, "spooled": 0, "digested": 0, "rejected": 0}
 
-        # Extract last user message (max 300 chars)
-        # 优先提取短消息，避免包含通知内容的长消息
-        last_user = "无"
-        user_messages = []
+    def count(key):
+        with lock:
+            stats[key] += 1
 
-        for line in reversed(lines):
-            line = line.strip()
-            if not line:
-                continue
+    def targets(config):
+        # relay 自己的配置中若也有 relay 渠道，不再转发给它，避免环路
+        return [channel["name"] for channel in resolve_channels(config) if channel["type"] != "relay"]
+
+    def worker():
+        while True:
+            node, title, content = pending.get()
             try:
-                msg = json.loads(line)
-                # 跳过 tool_result 类型的消息
-                if 'toolUseResult' in msg or 'tool_result' in msg:
+                config = load_config()
+                window = config.get("digest", {}).get("window_seconds", 0)
+                if window and window > 0:
+                    lines = [line.strip() for line in content.splitlines() if line.strip() and not line.startswith('#')]
+                    event = {"command": title, "response": " ".join(lines), "duration": 0.0,
+                             "working_dir": node, "time": time.time()}
+                    enqueue_event(event, window, targets(config))
+                    wake.set()
+                    count("digested")
                     continue
-                # 支持多种用户消息类型
-                if msg.get('type') == 'user':
-                    # 检查是否是真正的用户消息（不是 tool_result）
-                    message = msg.get('message', {})
-                    # 如果 content 是列表且包含 tool_result，跳过
-                    content = message.get('content', '')
-                    if isinstance(content, list):
-                        # 检查列表中是否都是 tool_result
-                        has_tool_result = any(item.get('type') == 'tool_result' for item in content if isinstance(item, dict))
-                        if has_tool_result:
-                            continue
-                    # 只提取第一个文本块，避免合并多个内容
-                    content = get_content(msg, first_only=True)
-                    if content and content.strip():
-                        user_messages.append(content)
-                        # 收集到 3 条后停止
-                        if len(user_messages) >= 3:
-                            break
-                # 也尝试直接从 content 字段提取（如果没有 type）
-                elif 'type' not in msg:
-                    content = get_content(msg, first_only=True)
-                    if content and isinstance(content, str) and content.strip():
-                        user_messages.append(content)
-                        if len(user_messages) >= 3:
-                            break
-            except json.JSONDecodeError:
-                continue
+                success, _, spooled = send_rendered(config, title, content, targets(config), pool)
+                if spooled:
+                    wake.set()
+                count("sent" if success else "spooled")
             except Exception:
-                continue
+                count("spooled")
+            finally:
+                pending.task_done()
 
-        # 优先选择最短且不含通知标记的消息
-        # 真正的用户输入通常都是最短的
-        filtered_messages = []
-        for msg in user_messages:
-            # 跳过包含通知特征的消息（不限于开头）
-            if 'Claude Code 执行完成' in msg or '🤖 AI 响应摘要' in msg or '✅ 项目:' in msg or '⏱️ 耗时:' in msg:
-                continue
-            # 跳过包含问号的消息（通常是用户在告诉我通知内容）
-            if '？' in msg or '?' in msg or '是否' in msg:
-                continue
-            # 跳过过长的消息（真正的用户输入通常很短）
-            if len(msg) > 50:
-                continue
-            filtered_messages.append(msg)
-
-        # 从过滤后的消息中选择最短的
-        if filtered_messages:
-            last_user = min(filtered_messages, key=len)
-        elif user_messages:
-            # 如果过滤后没有消息，使用最短的原始消息（但限制长度）
-            shortest = min(user_messages, key=len)
-            # 如果最短的也超过 50 字符，只取前 50 字符
-            if len(shortest) > 50:
-                last_user = shortest[:50]
+    def flusher():
+        """
+        relay 自己的 flusher 线程，代替每条消息启动一个 cc-hook flush 进程：
+        有消息入队时被唤醒，否则睡到 outbox 中最早的汇总窗口或重试时间，每次只清空已到期的消息
+        """
+        while True:
+            try:
+                due, next_wakeup = due_outbox_items()
+            except OSError:
+                due, next_wakeup = [], None
+            if due:
+                timeout = RELAY_FLUSH_RETRY_SECONDS
             else:
-                last_user = shortest
-
-        # Extract last 2 tool outputs as AI response summary (max 200 chars each)
-        tool_summaries = []
-        for line in reversed(lines):
-            line = line.strip()
-            if not line:
-                continue
+                timeout = None if next_wakeup is None else max(0.0, next_wakeup - time.time())
+            wake.wait(timeout)
+            wake.clear()
             try:
-                msg = json.loads(line)
-                if msg.get('type') == 'tool_result':
-                    tool_name = msg.get('tool_name', 'Unknown')
-                    # tool_output 可能在不同位置
-                    tool_output = msg.get('tool_output', {})
-                    output_text = ''
-
-                    if isinstance(tool_output, dict):
-                        output_text = tool_output.get('output', '')
-                    elif isinstance(tool_output, str):
-                        output_text = tool_output
-
-                    if output_text and str(output_text).strip():
-                        summary = str(output_text)[:200] + '...' if len(str(output_text)) > 200 else str(output_text)
-                        tool_summaries.append(f"[{tool_name}] {summary}")
-                        if len(tool_summaries) >= 2:
-                            break
-            except json.JSONDecodeError:
-                continue
+                flush_outbox(max_seconds=0)
             except Exception:
-                continue
+                pass
 
-        # 如果没有找到 tool_result，尝试找其他类型的响应
-        if not tool_summaries:
-            for line in reversed(lines):
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    msg = json.loads(line)
-                    # 尝试提取 assistant 类型的消息
-                    if msg.get('type') in ['assistant', 'response']:
-                        content = get_content(msg)
-                        if content:
-                            text = str(content)[:500]
-                            if text:
-                                tool_summaries.append(f"[AI] {text}")
-                                break
-                except:
-                    continue
+    def authenticate(header):
+        """返回 token 对应的节点名；未配置 relay.tokens 时拒绝所有请求"""
+        tokens = load_config().get("relay", {}).get("tokens") or {}
+        supplied = header[7:] if header.startswith("Bearer ") else ""
+        for node, token in tokens.items():
+            if supplied and hmac.compare_digest(str(token).encode('utf-8'), supplied.encode('utf-8')):
+                return node
+        return None
 
-        # 使用 chr(10) 代表换行符
-        last_assistant = chr(10).join(tool_summaries) if tool_summaries else "无"
+    def allow(node):
+        limit = load_config().get("relay", {}).get("node_rate_limit_per_minute", 0)
+        if not limit or limit <= 0:
+            return True
+        now = time.monotonic()
+        with lock:
+            window = recent.setdefault(node, collections.deque())
+            while window and window[0] <= now - 60:
+                window.popleft()
+            if len(window) >= limit:
+                return False
+            window.append(now)
+        return True
 
-        return last_user, last_assistant
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
 
-    except FileNotFoundError:
-        return "无 (文件不存在)", "无"
-    except Exception as e:
-        return f"无 (错误: {str(e)[:50]})", "无"
+        def reply(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
 
+        def do_GET(self):
+            if self.path != "/health":
+                self.reply(404, {"ok": False, "message": "not found"})
+                return
+            with lock:
+                snapshot = dict(stats)
+            self.reply(200, {"ok": True, "queue": pending.qsize(), **snapshot})
 
-if __name__ == '__main__':
-    if len(sys.argv) >= 2:
-        transcript_path = sys.argv[1]
-        prompt, assistant = extract_from_transcript(transcript_path)
-        print(f"{prompt}|{assistant}")
-    else:
-        print("无|无")
-'''
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > RELAY_MAX_BODY:
+                self.close_connection = True
+                self.reply(413, {"ok": False, "message": "请求体过大", "kind": "fatal"})
+                return
+            body = self.rfile.read(length)
+            if self.path != "/notify":
+                self.reply(404, {"ok": False, "message": "not found", "kind": "fatal"})
+                return
+            node = authenticate(self.headers.get("Authorization", ""))
+            if node is None:
+                count("rejected")
+                self.reply(401, {"ok": False, "message": "relay token 无效", "kind": "fatal"})
+                return
+            try:
+                item = json.loads(body)
+                entry = (node, str(item["title"]), str(item["content"]))
+            except (ValueError, KeyError, TypeError):
+                self.reply(400, {"ok": False, "message": "无效请求", "kind": "fatal"})
+                return
+            if not allow(node):
+                count("rejected")
+                self.reply(429, {"ok": False, "message": f"节点 {node} 发送过快", "kind": "ratelimit"})
+                return
+            try:
+                pending.put_nowait(entry)
+            except queue.Full:
+                count("rejected")
+                self.reply(503, {"ok": False, "message": "relay 队列已满", "kind": "transient"})
+                return
+            count("accepted")
+            self.reply(202, {"ok": True, "message": "已交给 relay 发送"})
 
-    calc_duration_script = '''#!/usr/bin/env python3
-"""
-Calculate duration from transcript timestamps
-"""
-import json
-import sys
-from datetime import datetime
+        def log_message(self, format, *args):
+            pass
 
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 128
+        daemon_threads = True
 
-def calc_duration(transcript_path: str):
+    server = Server((host, port), Handler)
+    if certfile:
+        import ssl
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    for _ in range(RELAY_WORKERS):
+        threading.Thread(target=worker, daemon=True).start()
+    threading.Thread(target=flusher, daemon=True).start()
+    return server, stats
+
+
+def relay_command(args):
+    """前台运行 relay，退出时打印计数"""
+    import signal
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    config = load_config()
+    if not config.get("relay", {}).get("tokens"):
+        print("❌ 未配置 relay.tokens（节点名到 token 的映射），relay 会拒绝所有请求")
+        return False
+    if not [c for c in resolve_channels(config) if c["type"] != "relay"]:
+        print(f"❌ {NO_CHANNEL_MESSAGE}")
+        return False
+    try:
+        server, stats = make_relay_server(args.host, args.port, args.certfile, args.keyfile)
+    except OSError as e:
+        print(f"❌ relay 启动失败: {e}")
+        return False
+    signal.signal(signal.SIGTERM, terminate)
+    scheme = "https" if args.certfile else "http"
+    print(f"📡 relay 已启动: {scheme}://{args.host}:{server.server_address[1]}/notify", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        server.server_close()
+        print("📊 " + "，".join(f"{key} {value}" for key, value in stats.items()), flush=True)
+    return True
+
+
+def mock_server_command(args):
+    """前台运行钉钉替身，退出时打印各类请求的计数"""
+    import signal
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    try:
+        server, stats = make_mock_server(args.host, args.port, args.secret or "", args.rate_limit,
+                                         args.latency, args.jitter, args.error_rate, args.verbose)
+    except OSError as e:
+        print(f"❌ 无法监听 {args.host}:{args.port}: {e}")
+        return False
+    signal.signal(signal.SIGTERM, terminate)
+    print(f"🧪 钉钉替身已启动: http://{args.host}:{server.server_address[1]}"
+          f"（把 dingtalk_base_url 设为该地址{'，签名密钥: ' + args.secret if args.secret else ''}）", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        server.server_close()
+        print("📊 " + "，".join(f"{key} {value}" for key, value in stats.items()), flush=True)
+    return True
+
+
+def spawn_mock_server(args):
+    """在空闲端口上启动 mock-server 子进程，返回 (进程, base_url)；无法启动时抛出 RuntimeError"""
+    import subprocess
+
+    script = script_path()
+    if script is None:
+        raise RuntimeError("无法定位 cc-hook 脚本")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    command = [sys.executable, script, "mock-server", "--port", str(port), "--rate-limit", str(args.rate_limit),
+               "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate)]
+    if args.secret:
+        command += ["--secret", args.secret]
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("mock-server 启动失败")
+
+
+def loadtest_command(args):
     """
-    Calculate duration from transcript file (only last interaction)
+    模拟 N 个会话并发向钉钉（或其替身）发送，每个会话依次发送 M 条消息。
+    走与真实发送相同的构造请求、签名、HTTP 与响应解析路径（post_channel_message），
+    报告吞吐、各类结果的数量和延迟分布。未指定 --url 时自动启动一个 mock-server 子进程。
     """
+    from concurrent.futures import ThreadPoolExecutor
+
+    process = None
+    url = args.url
+    if not url:
+        try:
+            process, url = spawn_mock_server(args)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            return False
+
+    channel = {"name": "loadtest", "type": "dingtalk", "access_token": args.token,
+               "secret": args.secret or "", "base_url": url}
+    pool = None if args.no_pool else HTTPSConnectionPool(max_idle=args.sessions)
+    title, content = format_message(DEFAULT_CONFIG, "loadtest", "[AI] " + "已完成修改，所有测试均已通过。" * 10, 12.3,
+                                    "/home/dev/project")
+
+    def session(index):
+        samples = []
+        for _ in range(args.messages):
+            stages = {}
+            start = time.perf_counter()
+            ok, _, kind = post_channel_message(channel, title, content, pool=pool, stages=stages, timeout=args.timeout)
+            samples.append(((time.perf_counter() - start) * 1000, kind or "ok", stages.get("sign", 0.0)))
+        return samples
+
+    print(f"🚀 {args.sessions} 个会话 × {args.messages} 条消息 → {url}"
+          f"（{'每条新建连接' if pool is None else 'keep-alive 连接池'}）")
+    started = time.perf_counter()
     try:
-        with open(transcript_path, 'r') as f:
-            lines = f.readlines()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            samples = [sample for result in executor.map(session, range(args.sessions)) for sample in result]
+    finally:
+        elapsed = time.perf_counter() - started
+        if pool is not None:
+            pool.close()
+        if process is not None:
+            process.terminate()
+            process.wait()
 
-        timestamps = []
-        for line in lines:
-            try:
-                msg = json.loads(line)
-                ts = msg.get('timestamp', '')
-                if ts:
-                    # 尝试解析 ISO 8601 格式的时间戳
-                    try:
-                        dt = datetime.fromisoformat(ts.replace('Z', '+00:00'))
-                        timestamps.append(dt.timestamp())
-                    except:
-                        # 如果不是 ISO 格式，尝试作为数字处理
-                        try:
-                            ts_float = float(ts)
-                            # 如果是毫秒级时间戳（大于 100 亿），转换为秒
-                            if ts_float > 10000000000:
-                                ts_float = ts_float / 1000.0
-                            timestamps.append(ts_float)
-                        except:
-                            pass
-            except:
-                pass
+    outcomes = {}
+    for _, kind, _ in samples:
+        outcomes[kind] = outcomes.get(kind, 0) + 1
+    latencies = sorted(ms for ms, _, _ in samples)
+    report = {
+        "url": url,
+        "sessions": args.sessions,
+        "messages": len(samples),
+        "seconds": elapsed,
+        "throughput": len(samples) / elapsed if elapsed > 0 else 0.0,
+        "outcomes": outcomes,
+        "latency_ms": {f"p{pct}": percentile(latencies, pct) for pct in (50, 95, 99)} if latencies else {},
+        "sign_ms": sum(sign for _, _, sign in samples) / len(samples) if samples else 0.0,
+    }
+    if latencies:
+        report["latency_ms"]["max"] = latencies[-1]
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return True
 
-        # 只计算最近一次交互的耗时（取最后几个时间戳）
-        # 找到最后一个用户消息和最后一个时间戳的差值
-        if len(timestamps) >= 2:
-            # 取最后 20 个时间戳，代表最近的一次交互
-            recent_timestamps = timestamps[-20:] if len(timestamps) > 20 else timestamps
-            first_time = recent_timestamps[0]
-            last_time = recent_timestamps[-1]
-            if first_time < last_time:
-                duration = (last_time - first_time)
-                # 如果计算出的时长超过 5 分钟，可能是整个会话时长，使用最后两个时间戳
-                if duration > 300:
-                    duration = timestamps[-1] - timestamps[-2] if len(timestamps) >= 2 else 5.0
-                print(f"{duration:.1f}")
-                return
+    print(f"📊 {len(samples)} 条，用时 {elapsed:.2f} 秒，吞吐 {report['throughput']:.1f} 条/秒")
+    print("   结果: " + "，".join(f"{kind} {count}" for kind, count in sorted(outcomes.items())))
+    if latencies:
+        print(f"{'':>2}{'':<16}{'次数':>5}{'p50':>11}{'p95':>11}{'p99':>11}{'max':>11}")
+        print_percentiles("latency_ms", latencies)
+    return True
 
-        print("5.0")
-        return "5.0"
-    except Exception as e:
-        print("5.0")
-        return "5.0"
 
+def build_zipapp(source, target):
+    """
+    把 cc-hook 打包为 zipapp：同时包含源码与预编译的 .pyc（不校验源码哈希），
+    启动时直接加载字节码；Python 版本不匹配时 zipimport 自动回退到源码。
+    """
+    import py_compile
+    import tempfile
+    import zipapp
 
-if __name__ == '__main__':
-    if len(sys.argv) >= 2:
-        transcript_path = sys.argv[1]
-        calc_duration(transcript_path)
-    else:
-        print("5.0")
-'''
+    with tempfile.TemporaryDirectory() as tmp:
+        module_source = Path(tmp) / "cc_hook.py"
+        module_source.write_bytes(Path(source).read_bytes())
+        py_compile.compile(
+            str(module_source),
+            cfile=str(Path(tmp) / "cc_hook.pyc"),
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+        (Path(tmp) / "__main__.py").write_text("import cc_hook\ncc_hook.main()\n", encoding='utf-8')
+        Path(target).parent.mkdir(parents=True, exist_ok=True)
+        tmp_target = Path(target).with_name(f".{Path(target).name}.{os.getpid()}.tmp")
+        zipapp.create_archive(tmp, tmp_target, interpreter="/usr/bin/env python3")
+        os.replace(tmp_target, target)
+    return Path(target)
 
-    # 创建辅助脚本文件
-    scripts = {
-        'extract_messages.py': extract_messages_script,
-        'calc_duration.py': calc_duration_script
-    }
 
-    for script_name, script_content in scripts.items():
-        dest_file = hooks_dir / script_name
-        with open(dest_file, 'w', encoding='utf-8') as f:
-            f.write(script_content)
-        dest_file.chmod(0o755)
-        print(f"✅ 已创建 {script_name} 到 {dest_file}")
-
-    # 创建 Stop hook 脚本
-    hook_script = hooks_dir / "stop"
-
-    # 创建 Stop hook 脚本
-    script_content = f'''#!/bin/bash
-# Claude Code Stop Hook - 在每次 Claude Code 完成响应后发送钉钉通知
-
-# 从标准输入读取 Stop hook 的 JSON 数据
-input_data=$(cat)
-
-# 提取 cwd 和 transcript_path
-cwd=$(echo "$input_data" | python3 -c "import json, sys; data = json.load(sys.stdin); print(data.get('cwd', ''))")
-transcript_path=$(echo "$input_data" | python3 -c "import json, sys; data = json.load(sys.stdin); print(data.get('transcript_path', ''))")
-
-# 等待 transcript 文件写入完成（最多等待 5 秒）
-if [ -n "$transcript_path" ]; then
-    for i in $(seq 1 25); do
-        if [ -f "$transcript_path" ]; then
-            # 检查文件是否稳定（大小在 100ms 内不变）
-            current_size=$(stat -f%z "$transcript_path" 2>/dev/null || stat -c%s "$transcript_path" 2>/dev/null || echo "0")
-            sleep 0.1
-            new_size=$(stat -f%z "$transcript_path" 2>/dev/null || stat -c%s "$transcript_path" 2>/dev/null || echo "0")
-            if [ "$current_size" = "$new_size" ] && [ "$current_size" -gt 0 ]; then
-                break
-            fi
-        fi
-        sleep 0.2
-    done
-fi
-
-# 提取用户 prompt 和 AI 响应摘要
-if [ -n "$transcript_path" ] && [ -f "$transcript_path" ]; then
-    # 使用单独的 Python 脚本提取信息
-    prompt_text=$(~/.claude/hooks/extract_messages.py "$transcript_path" | cut -d'|' -f1)
-    response_text=$(~/.claude/hooks/extract_messages.py "$transcript_path" | cut -d'|' -f2)
-else
-    prompt_text="Claude Code 响应完成"
-    response_text="AI 任务已完成"
-fi
-
-# 计算 duration
-if [ -n "$transcript_path" ] && [ -f "$transcript_path" ]; then
-    duration=$(~/.claude/hooks/calc_duration.py "$transcript_path")
-else
-    duration="5.0"
-fi
-
-# 导出环境变量并调用通知脚本
-export PROMPT="$prompt_text"
-export RESPONSE="$response_text"
-export WORKING_DIR="$cwd"
-export DURATION="$duration"
-
-exec python3 "$HOME/.local/bin/cc-hook" send --prompt "$PROMPT" --response "$RESPONSE" --working-dir "$WORKING_DIR" --duration "$DURATION"
-'''
-    
+def merge_hook_entries(entries, subcommand, command, timeout):
+    """
+    在 settings.json 某个事件的 hook 列表中换上 cc-hook 的条目：只移除命令为 `cc-hook … <subcommand>`
+    的旧条目（包括旧路径和 zipapp），用户的其他 hook 原样保留，最后追加新条目。
+    """
+    own = re.compile(r'cc-hook(?:\.pyz|\.py)?["\']?\s+' + re.escape(subcommand) + r'\s*$')
+    merged = []
+    for group in entries if isinstance(entries, list) else []:
+        if not isinstance(group, dict) or not isinstance(group.get("hooks"), list):
+            merged.append(group)
+            continue
+        hooks = [hook for hook in group["hooks"]
+                 if not (isinstance(hook, dict) and own.search(str(hook.get("command", ""))))]
+        if hooks:
+            merged.append(dict(group, hooks=hooks))
+    merged.append({"hooks": [{"type": "command", "command": command, "timeout": timeout}]})
+    return merged
+
+
+def setup_hook(hook_target=INSTALL_PATH):
+    hooks_dir = Path.home() / ".claude" / "hooks"
+    hooks_dir.mkdir(parents=True, exist_ok=True)
+
+    # 清理旧版本生成的 bash hook 与辅助脚本（现已合并到 cc-hook stop）
+    for legacy_name in LEGACY_HOOK_FILES:
+        legacy_file = hooks_dir / legacy_name
+        if legacy_file.exists():
+            try:
+                legacy_file.unlink()
+                print(f"🧹 已移除旧版 {legacy_name}")
+            except OSError:
+                pass
+
+    hook_command = f'python3 "{hook_target}" stop'
+    prompt_hook_command = f'python3 "{hook_target}" prompt'
+
     try:
-        with open(hook_script, 'w', encoding='utf-8') as f:
-            f.write(script_content)
-        
-        hook_script.chmod(0o755)
-        
         # 在 settings.json 中添加 hooks 配置
         settings_file = Path.home() / ".claude" / "settings.json"
         try:
@@ -531,17 +3929,11 @@ exec python3 "$HOME/.local/bin/cc-hook" send --prompt "$PROMPT" --response "$RES
             if 'hooks' not in settings:
                 settings['hooks'] = {}
 
-            settings['hooks']['Stop'] = [
-                {
-                    "hooks": [
-                        {
-                            "type": "command",
-                            "command": str(hook_script),
-                            "timeout": 10
-                        }
-                    ]
-                }
-            ]
+            hooks = settings['hooks']
+            hooks['Stop'] = merge_hook_entries(hooks.get('Stop'), 'stop', hook_command, HOOK_TIMEOUT)
+            # 提交 prompt 时记录原文与时间，Stop hook 据此得到准确的 prompt 和耗时
+            hooks['UserPromptSubmit'] = merge_hook_entries(
+                hooks.get('UserPromptSubmit'), 'prompt', prompt_hook_command, 5)
 
             # 保存 settings.json
             with open(settings_file, 'w', encoding='utf-8') as f:
@@ -551,7 +3943,8 @@ exec python3 "$HOME/.local/bin/cc-hook" send --prompt "$PROMPT" --response "$RES
             print(f"⚠️  配置 settings.json 失败: {e}")
             print("请手动在 ~/.claude/settings.json 中添加 hooks 配置")
 
-        print(f"✅ Hook 已安装到: {hook_script}")
+        print(f"✅ Hook 命令: {hook_command}")
+        print(f"✅ UserPromptSubmit 命令: {prompt_hook_command}")
         print("📝 已自动配置全局 hooks，请重启 Claude Code")
         return True
         
@@ -560,22 +3953,54 @@ exec python3 "$HOME/.local/bin/cc-hook" send --prompt "$PROMPT" --response "$RES
         return False
 
 
-def install_command():
+def install_module():
+    """把 cc-hook 复制为用户 site-packages 中的 cc_hook.py，使其他工具可以直接 import cc_hook"""
+    import site
+
+    source = os.path.abspath(__file__)
+    if not site.ENABLE_USER_SITE or not os.path.isfile(source):
+        return None
+    target = Path(site.getusersitepackages()) / "cc_hook.py"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(Path(source).read_bytes())
+    os.replace(tmp, target)
+    return target
+
+
+def install_command(use_zipapp=False):
     print("🚀 开始安装 Claude Code Hook 工具...")
     
-    try:
-        import json
-        import hmac
-        import hashlib
-        print("✅ Python 依赖检查通过")
-    except ImportError as e:
-        print(f"❌ Python 依赖检查失败: {e}")
+    # 只依赖标准库，检查版本即可（argparse.BooleanOptionalAction 需要 3.9+）
+    if sys.version_info < (3, 9):
+        print(f"❌ 需要 Python 3.9 或更高版本，当前为 {sys.version.split()[0]}")
         return False
+    print("✅ Python 版本检查通过")
     
     config = load_config()
     print(f"✅ 配置文件已创建: {CONFIG_PATH}")
+
+    hook_target = INSTALL_PATH
+    if use_zipapp:
+        import py_compile
+
+        source = os.path.abspath(__file__)
+        try:
+            if not os.path.isfile(source):
+                raise OSError("当前从 zipapp 运行，无法重新打包")
+            hook_target = build_zipapp(source, ZIPAPP_PATH)
+            print(f"✅ 已生成预编译 zipapp: {hook_target}")
+        except (OSError, py_compile.PyCompileError) as e:
+            print(f"⚠️  生成 zipapp 失败，继续使用脚本: {e}")
+
+    try:
+        module_path = install_module()
+        if module_path is not None:
+            print(f"✅ 已安装可导入模块: {module_path}（import cc_hook）")
+    except OSError as e:
+        print(f"⚠️  安装可导入模块失败: {e}")
     
-    if setup_hook():
+    if setup_hook(hook_target):
         print("\n🎉 安装完成！")
         print(f"📋 配置文件位置: {CONFIG_PATH}")
         print("🔧 您可以编辑配置文件来自定义通知内容")
@@ -585,6 +4010,47 @@ def install_command():
         return False
 
 
+def measure_startup(command, env=None):
+    import subprocess
+
+    start = time.perf_counter()
+    subprocess.run(command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - start
+
+
+def startup_bench_command(args):
+    """
+    测量 hook 进程的启动耗时（解释器启动 + 加载 cc-hook，不做任何实际工作）。
+    冷启动：使用空的 PYTHONPYCACHEPREFIX 并禁止写字节码，所有非冻结模块都要从源码编译；
+    热启动：正常运行 runs 次取中位数与最小值。
+    """
+    import statistics
+    import tempfile
+
+    targets = []
+    script = script_path()
+    if script:
+        targets.append(("脚本", script))
+    if ZIPAPP_PATH.exists() and str(ZIPAPP_PATH) != script:
+        targets.append(("zipapp", str(ZIPAPP_PATH)))
+    if not targets:
+        print("❌ 无法定位 cc-hook 脚本")
+        return
+
+    for label, target in targets:
+        command = [sys.executable, target, STARTUP_PROBE_ARG]
+        with tempfile.TemporaryDirectory() as prefix:
+            cold_env = dict(os.environ, PYTHONPYCACHEPREFIX=prefix, PYTHONDONTWRITEBYTECODE="1")
+            cold = measure_startup(command, cold_env)
+        measure_startup(command)
+        warm = [measure_startup(command) for _ in range(args.runs)]
+        print(f"🚀 {label} ({target})")
+        print(f"   冷启动: {cold * 1000:.1f} ms")
+        print(f"   热启动: 中位数 {statistics.median(warm) * 1000:.1f} ms，"
+              f"最快 {min(warm) * 1000:.1f} ms（{args.runs} 次）")
+
+
 def config_command(args):
     config = load_config()
     
@@ -600,23 +4066,43 @@ def config_command(args):
         config["secret"] = args.secret
         print("✅ 设置安全密钥")
     
+    if args.base_url:
+        config["dingtalk_base_url"] = args.base_url
+        print(f"✅ 设置钉钉 API 地址: {args.base_url}")
+    
     if args.enable is not None:
         config["enabled"] = args.enable
         print(f"✅ {'启用' if args.enable else '禁用'}通知")
     
     if args.test:
         title, content = format_message(config, "test-command", "这是测试响应", 1.5, "/test/dir")
-        success, message = send_dingtalk_message(config, title, content)
-        if success:
-            print("✅ 测试消息发送成功")
-        else:
+        success, message, results = send_notification(config, title, content)
+        if not results:
             print(f"❌ 测试消息发送失败: {message}")
+        for name, (ok, detail) in results.items():
+            if ok:
+                print(f"✅ [{name}] 测试消息发送成功")
+            else:
+                print(f"❌ [{name}] 测试消息发送失败: {detail}")
         return
     
     save_config(config)
 
 
 def main():
+    # 热路径：hook 调用不经过 argparse
+    argv = sys.argv[1:]
+    if argv == [STARTUP_PROBE_ARG]:
+        return
+    if argv == ['stop']:
+        stop_command()
+        return
+    if argv == ['prompt']:
+        prompt_command()
+        return
+
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="Claude Code Hook Tool - 全局钉钉通知工具",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -639,10 +4125,12 @@ def main():
     subparsers = parser.add_subparsers(dest='command', help='可用命令')
     
     install_parser = subparsers.add_parser('install', help='安装 Claude Code Stop hook')
+    install_parser.add_argument('--zipapp', action='store_true', help='生成预编译的 zipapp 并让 hook 使用它（启动更快）')
     
     config_parser = subparsers.add_parser('config', help='配置钉钉通知')
     config_parser.add_argument('--access-token', help='设置钉钉 access token')
     config_parser.add_argument('--secret', help='设置安全密钥')
+    config_parser.add_argument('--base-url', help=f'设置钉钉 API 地址（默认 {DINGTALK_BASE_URL}，可指向 mock-server）')
     config_parser.add_argument('--enable', action=argparse.BooleanOptionalAction, help='启用/禁用通知')
     config_parser.add_argument('--test', action='store_true', help='发送测试消息')
     config_parser.add_argument('--show', action='store_true', help='显示当前配置')
@@ -652,6 +4140,68 @@ def main():
     send_parser.add_argument('--response', help='Claude Code 的响应')
     send_parser.add_argument('--duration', type=float, default=0, help='响应时长（秒）')
     send_parser.add_argument('--working-dir', help='工作目录')
+    send_parser.add_argument('--status', choices=RULE_STATUSES, default='success', help='任务状态，用于规则匹配（默认 success）')
+
+    subparsers.add_parser('stop', help='Claude Code Stop hook 入口（从标准输入读取 hook JSON）')
+    subparsers.add_parser('prompt', help='Claude Code UserPromptSubmit hook 入口（记录 prompt 与提交时间）')
+    subparsers.add_parser('flush', help='发送 outbox 队列中的通知（通常由后台进程调用）')
+    subparsers.add_parser('daemon', help='前台运行本地投递 daemon（Unix socket + HTTPS 连接池）')
+
+    stats_parser = subparsers.add_parser('stats', help='按阶段和项目统计 hook 耗时（p50/p95/p99）')
+    stats_parser.add_argument('--hours', type=float, help='只统计最近若干小时的记录')
+    stats_parser.add_argument('--project', help='只统计指定项目的 Stop hook 记录')
+
+    history_parser = subparsers.add_parser('history', help='查询已完成轮次的历史记录（SQLite）')
+    history_parser.add_argument('--days', type=float, default=7, help='查询最近若干天（默认 7）')
+    history_parser.add_argument('--project', help='只查询指定项目')
+    history_parser.add_argument('--longest', action='store_true', help='按耗时从长到短列出轮次')
+    history_parser.add_argument('--projects', action='store_true', help='按项目统计轮次数、总耗时和 p50/p95/max')
+    history_parser.add_argument('--sort', choices=('total', 'max', 'p95', 'turns'), default='total',
+                                help='--projects 的排序字段（默认 total）')
+    history_parser.add_argument('--limit', type=int, default=20, help='最多输出的行数（默认 20）')
+    history_parser.add_argument('--json', action='store_true', help='以 JSON 输出')
+
+    report_parser = subparsers.add_parser('report', help='并行扫描 ~/.claude/projects 下的 transcript，按项目和按天汇总')
+    report_parser.add_argument('--days', type=float, default=7, help='汇总最近若干天（默认 7）')
+    report_parser.add_argument('--workers', type=int, help='扫描进程数（默认 CPU 核数）')
+    report_parser.add_argument('--root', help='transcript 根目录（默认 ~/.claude/projects）')
+    report_parser.add_argument('--rebuild', action='store_true', help='忽略已记录的偏移，全部重新扫描')
+    report_parser.add_argument('--send', action='store_true', help='把汇总作为一条 Markdown 消息发送')
+    report_parser.add_argument('--json', action='store_true', help='以 JSON 输出')
+
+    relay_parser = subparsers.add_parser('relay', help='运行团队 relay：接收各开发机的通知，统一签名、限流与汇总后发送')
+    relay_parser.add_argument('--host', default='0.0.0.0', help='监听地址（默认 0.0.0.0）')
+    relay_parser.add_argument('--port', type=int, default=RELAY_PORT, help=f'监听端口（默认 {RELAY_PORT}）')
+    relay_parser.add_argument('--certfile', help='TLS 证书（PEM），指定后以 HTTPS 提供服务')
+    relay_parser.add_argument('--keyfile', help='TLS 私钥（PEM）')
+
+    mock_parser = subparsers.add_parser('mock-server', help='运行本地钉钉机器人 API 替身（校验签名、模拟限流与延迟）')
+    mock_parser.add_argument('--host', default='127.0.0.1', help='监听地址（默认 127.0.0.1）')
+    mock_parser.add_argument('--port', type=int, default=MOCK_SERVER_PORT, help=f'监听端口（默认 {MOCK_SERVER_PORT}）')
+    mock_parser.add_argument('--secret', help='校验 timestamp/sign 使用的加签密钥（不指定则不校验）')
+    mock_parser.add_argument('--rate-limit', type=int, default=RATE_LIMIT_PER_MINUTE,
+                             help=f'每个 access_token 每分钟允许的消息数，0 表示不限（默认 {RATE_LIMIT_PER_MINUTE}）')
+    mock_parser.add_argument('--latency', type=float, default=0, help='每个请求注入的固定延迟（毫秒）')
+    mock_parser.add_argument('--jitter', type=float, default=0, help='在固定延迟之外再注入 0~N 毫秒的随机延迟')
+    mock_parser.add_argument('--error-rate', type=float, default=0, help='以该比例返回 HTTP 500（0~1）')
+    mock_parser.add_argument('--verbose', action='store_true', help='打印每个请求')
+
+    loadtest_parser = subparsers.add_parser('loadtest', help='并发向钉钉替身发送消息，报告吞吐与尾延迟')
+    loadtest_parser.add_argument('--url', help='钉钉 API 地址（默认自动启动一个 mock-server）')
+    loadtest_parser.add_argument('--sessions', type=int, default=20, help='并发会话数（默认 20）')
+    loadtest_parser.add_argument('--messages', type=int, default=10, help='每个会话发送的消息数（默认 10）')
+    loadtest_parser.add_argument('--token', default='loadtest', help='使用的 access_token（默认 loadtest）')
+    loadtest_parser.add_argument('--secret', default='SECloadtest', help='加签密钥，需与 mock-server 一致（默认 SECloadtest）')
+    loadtest_parser.add_argument('--no-pool', action='store_true', help='每条消息新建连接（模拟独立的 hook 进程）')
+    loadtest_parser.add_argument('--timeout', type=float, default=10, help='单个请求超时（秒）')
+    loadtest_parser.add_argument('--rate-limit', type=int, default=0, help='自动启动的 mock-server 的限流阈值（默认不限）')
+    loadtest_parser.add_argument('--latency', type=float, default=0, help='自动启动的 mock-server 注入的固定延迟（毫秒）')
+    loadtest_parser.add_argument('--jitter', type=float, default=0, help='自动启动的 mock-server 注入的随机延迟上限（毫秒）')
+    loadtest_parser.add_argument('--error-rate', type=float, default=0, help='自动启动的 mock-server 返回 HTTP 500 的比例')
+    loadtest_parser.add_argument('--json', action='store_true', help='以 JSON 输出')
+
+    bench_parser = subparsers.add_parser('startup-bench', help='测量 hook 进程的冷/热启动耗时')
+    bench_parser.add_argument('--runs', type=int, default=10, help='热启动测量次数')
     
     args = parser.parse_args()
     
@@ -660,23 +4210,60 @@ def main():
         return
     
     if args.command == 'install':
-        install_command()
+        install_command(args.zipapp)
     elif args.command == 'config':
         config_command(args)
+    elif args.command == 'stop':
+        stop_command()
+    elif args.command == 'prompt':
+        prompt_command()
     elif args.command == 'send':
         config = load_config()
-        title, content = format_message(
-            config, 
-            args.prompt or "", 
-            args.response or "", 
-            args.duration, 
-            args.working_dir or ""
-        )
-        success, message = send_dingtalk_message(config, title, content)
+        working_dir = args.working_dir or ""
+        action = evaluate_rules(config, {
+            "project": project_name_of(working_dir),
+            "path": working_dir,
+            "prompt": args.prompt or "",
+            "response": args.response or "",
+            "duration": args.duration,
+            "status": args.status,
+        })
+        if status_allowed(config, args.status):
+            success, message = notify(
+                config,
+                args.prompt or "",
+                args.response or "",
+                args.duration,
+                working_dir,
+                action
+            )
+        else:
+            success, message = True, f"已按 notifications.on_{args.status} 设置忽略"
         if success:
-            print("✅ 通知发送成功")
+            print(f"✅ {message}")
         else:
             print(f"❌ 通知发送失败: {message}")
+    elif args.command == 'flush':
+        sent, failed = flush_outbox()
+        print(f"📮 已发送 {sent} 条，失败 {failed} 条")
+    elif args.command == 'daemon':
+        run_daemon()
+    elif args.command == 'stats':
+        stats_command(args)
+    elif args.command == 'history':
+        history_command(args)
+    elif args.command == 'report':
+        report_command(args)
+    elif args.command == 'relay':
+        if not relay_command(args):
+            sys.exit(1)
+    elif args.command == 'mock-server':
+        if not mock_server_command(args):
+            sys.exit(1)
+    elif args.command == 'loadtest':
+        loadtest_command(args)
+    elif args.command == 'startup-bench':
+        startup_bench_command(args)
 
 
 if __name__ == "__main__":
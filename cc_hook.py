@@ -0,0 +1 @@
+cc-hook.py
\ No newline at end of file
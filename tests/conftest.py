@@ -0,0 +1,39 @@
+"""
+测试夹具：cc-hook 在导入时根据 HOME 计算配置与状态目录，因此先把 HOME 指向临时目录再导入，
+每个用例开始前清空该目录和进程内缓存，用例之间互不影响。
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+HOME = Path(tempfile.mkdtemp(prefix="cc-hook-test-"))
+os.environ["HOME"] = str(HOME)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cc_hook  # noqa: E402
+
+
+@pytest.fixture
+def cc():
+    for child in HOME.iterdir():
+        if child.is_dir() and not child.is_symlink():
+            shutil.rmtree(child)
+        else:
+            child.unlink()
+    cc_hook.CONFIG_CACHE.clear()
+    cc_hook.COMPILED_RULES_CACHE.clear()
+    return cc_hook
+
+
+@pytest.fixture
+def config(cc):
+    """带一个钉钉渠道、直接发送的配置"""
+    config = cc.load_config()
+    config["access_token"] = "test-token"
+    config["delivery"]["mode"] = "direct"
+    return config
@@ -0,0 +1,22 @@
+def test_default_config_is_not_shared(cc):
+    for _ in range(2):
+        cc.CONFIG_PATH.unlink(missing_ok=True)
+        cc.CONFIG_CACHE.clear()
+        config = cc.load_config()
+        assert config["digest"]["window_seconds"] == 0
+        assert config["rules"] == []
+        config["digest"]["window_seconds"] = 30
+        config["rules"].append({"action": "drop"})
+    assert cc.DEFAULT_CONFIG["digest"]["window_seconds"] == 0
+    assert cc.DEFAULT_CONFIG["rules"] == []
+
+
+def test_invalid_values_fall_back_to_defaults(cc):
+    config = cc.merge_config(cc.DEFAULT_CONFIG, {"enabled": "yes", "digest": {"window_seconds": "30"},
+                                                 "delivery": {"mode": "carrier-pigeon"}, "rules": ["x", {}]})
+    problems = cc.validate_config(config)
+    assert config["enabled"] is True
+    assert config["digest"]["window_seconds"] == 0
+    assert config["delivery"]["mode"] == "spool"
+    assert config["rules"] == [{}]
+    assert len(problems) == 4
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+
+def iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def write_transcript(path, session_id, cwd, turns):
+    """turns 为 [(用户输入时间, 回复时间, prompt), ...]"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        for start, end, prompt in turns:
+            f.write(json.dumps({"type": "user", "sessionId": session_id, "cwd": cwd, "timestamp": iso(start),
+                                "message": {"role": "user", "content": prompt}}) + "\n")
+            f.write(json.dumps({"type": "assistant", "sessionId": session_id, "timestamp": iso(end),
+                                "message": {"role": "assistant", "content": [{"type": "text", "text": "完成"}]}}) + "\n")
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+
+
+def report_args(root, **overrides):
+    args = dict(days=7, workers=1, root=str(root), rebuild=False, send=False, json=True)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def history_args(**overrides):
+    args = dict(days=7, project=None, longest=False, projects=False, sort="total", limit=20, json=True)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def run_json(capsys, func, args):
+    capsys.readouterr()
+    func(args)
+    return json.loads(capsys.readouterr().out)
+
+
+def test_report_backfill_is_visible_in_history(cc, tmp_path, capsys):
+    now = time.time() - 7200
+    write_transcript(tmp_path / "projects" / "-work-app" / "s1.jsonl", "s1", "/work/app",
+                     [(now, now + 30, "first"), (now + 100, now + 400, "second")])
+
+    report = run_json(capsys, cc.report_command, report_args(tmp_path / "projects"))
+    assert report["added"] == 2
+
+    projects = run_json(capsys, cc.history_command, history_args(projects=True))
+    assert [(p["project"], p["turns"]) for p in projects] == [("app", 2)]
+    assert round(projects[0]["total"]) == 330
+
+    # 重新扫描不会产生重复行
+    run_json(capsys, cc.report_command, report_args(tmp_path / "projects", rebuild=True))
+    turns = run_json(capsys, cc.history_command, history_args())
+    assert sorted(t["prompt"] for t in turns) == ["first", "second"]
+
+
+def test_stop_hook_row_and_backfill_share_one_row(cc, config, tmp_path, capsys):
+    now = time.time() - 7200
+    write_transcript(tmp_path / "projects" / "-work-app" / "s1.jsonl", "s1", "/work/app", [(now, now + 30, "first")])
+    cc.record_turn(config, {"turn_start": round(now, 3), "ts": round(now + 31, 3), "project": "app",
+                            "cwd": "/work/app", "session_id": "s1", "prompt": "first", "response": "完成",
+                            "duration": 30.0, "status": "success", "result": "ok"})
+    cc.ingest_history()
+
+    run_json(capsys, cc.report_command, report_args(tmp_path / "projects"))
+    turns = run_json(capsys, cc.history_command, history_args())
+    assert len(turns) == 1
+    assert turns[0]["status"] == "success"
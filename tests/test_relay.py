@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+import urllib.request
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def test_relay_digest_flushes_in_process(cc, monkeypatch):
+    mock, mock_stats = cc.make_mock_server("127.0.0.1", 0, rate_limit=0)
+    mock_port = serve(mock)
+    config = cc.load_config()
+    config.update(access_token="team", dingtalk_base_url=f"http://127.0.0.1:{mock_port}")
+    config["digest"]["window_seconds"] = 0.5
+    config["relay"] = {"tokens": {"alice": "secret"}}
+    cc.save_config(config)
+
+    def no_subprocess():
+        raise AssertionError("relay 不应为每条消息启动 flush 进程")
+
+    monkeypatch.setattr(cc, "spawn_flusher", no_subprocess)
+    relay, stats = cc.make_relay_server("127.0.0.1", 0)
+    relay_port = serve(relay)
+    try:
+        for i in range(5):
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{relay_port}/notify", method="POST",
+                data=json.dumps({"title": f"任务 {i}", "content": f"完成 {i}"}).encode("utf-8"),
+                headers={"Authorization": "Bearer secret", "Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=5) as response:
+                assert response.status == 202
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and (stats["digested"] < 5 or mock_stats["ok"] < 1 or cc.outbox_items()):
+            time.sleep(0.05)
+        assert stats["digested"] == 5
+        assert mock_stats["ok"] == 1
+        assert cc.outbox_items() == []
+    finally:
+        relay.shutdown()
+        mock.shutdown()
+
+
+def test_mock_server_reports_busy_port(cc, capsys):
+    import argparse
+    import socket
+
+    with socket.socket() as busy:
+        busy.bind(("127.0.0.1", 0))
+        busy.listen()
+        port = busy.getsockname()[1]
+        args = argparse.Namespace(host="127.0.0.1", port=port, secret="", rate_limit=0, latency=0.0, jitter=0.0,
+                                  error_rate=0.0, verbose=False)
+        assert cc.mock_server_command(args) is False
+    assert f"无法监听 127.0.0.1:{port}" in capsys.readouterr().out
@@ -0,0 +1,74 @@
+import pytest
+
+
+def test_rule_spec_expands_globs_and_thresholds(cc):
+    conditions, action = cc.rule_spec({
+        "name": "slow",
+        "match": {"project": ["*/web*", "*/api"], "min_duration": 30, "status": "failure"},
+        "action": "digest",
+        "window_seconds": 120,
+        "channels": ["ops"],
+    })
+    assert [(fact, op) for fact, op, _ in conditions] == [
+        ("project", "match"), ("duration", "ge"), ("status", "in")]
+    assert action == {"action": "digest", "channels": ["ops"], "window_seconds": 120, "rule": "slow"}
+
+
+@pytest.mark.parametrize("rule", [
+    "not a rule",
+    {"enabled": False},
+    {"action": "page"},
+    {"match": {"prompt": "("}},
+    {"match": {"min_duration": "soon"}},
+    {"action": "digest", "window_seconds": "30"},
+    {"action": "digest", "window_seconds": -1},
+    {"action": "digest", "window_seconds": True},
+    {"channels": "ops"},
+    {"channels": ["ops", 3]},
+])
+def test_malformed_rules_are_ignored(cc, rule):
+    assert cc.rule_spec(rule) is None
+
+
+def test_evaluate_rules_skips_malformed_rules(cc, config):
+    config["rules"] = [
+        {"name": "bad", "action": "digest", "window_seconds": "30"},
+        {"name": "quiet", "match": {"project": "*/sandbox"}, "action": "drop"},
+    ]
+    assert cc.evaluate_rules(config, {"project": "/work/sandbox"})["rule"] == "quiet"
+    assert cc.evaluate_rules(config, {"project": "/work/app"}) is cc.DEFAULT_RULE_ACTION
+
+
+def test_evaluate_rules_waits_for_unknown_facts(cc, config):
+    config["rules"] = [{"match": {"response": "deploy"}, "action": "drop"}]
+    assert cc.evaluate_rules(config, {"project": "/work/app"}) is None
+    assert cc.evaluate_rules(config, {"response": "deployed"})["action"] == "drop"
+
+
+def test_rules_from_snapshot_match_fresh_compile(cc):
+    config = cc.load_config()
+    config["rules"] = [{"match": {"project": "/tmp/*", "max_duration": 5}, "action": "drop"}]
+    cc.save_config(config)
+    fresh = cc.evaluate_rules(cc.load_config(), {"project": "/tmp/x", "duration": 1})
+
+    cc.CONFIG_CACHE.clear()
+    cc.COMPILED_RULES_CACHE.clear()
+    config = cc.load_config()
+    assert "specs" in cc.COMPILED_RULES_CACHE
+    assert cc.evaluate_rules(config, {"project": "/tmp/x", "duration": 1}) == fresh
+    assert fresh["action"] == "drop"
+
+
+def test_failed_send_does_not_leave_dedup_hash(cc, config, monkeypatch):
+    def broken(*args, **kwargs):
+        raise TypeError("boom")
+
+    monkeypatch.setattr(cc, "format_message", broken)
+    with pytest.raises(TypeError):
+        cc.notify(config, "prompt", "response", 1.0, "/work/app")
+
+    sent = []
+    monkeypatch.setattr(cc, "format_message", lambda *args: ("title", "content"))
+    monkeypatch.setattr(cc, "deliver_message", lambda *args: sent.append(args) or (True, "ok"))
+    assert cc.notify(config, "prompt", "response", 1.0, "/work/app") == (True, "ok")
+    assert len(sent) == 1
@@ -0,0 +1,67 @@
+import io
+import json
+import os
+
+
+def run_stop(cc, monkeypatch, transcript, on_round=None):
+    """以 transcript 运行一次 Stop hook，stop_round 换成只记录调用的替身，返回各轮的 stopped 时间"""
+    rounds = []
+
+    def fake_round(config, input_data, stopped, lap, deadline):
+        rounds.append(stopped)
+        size = os.path.getsize(transcript)
+        if on_round is not None:
+            on_round(len(rounds))
+        return {"result": "ok", "detail": "", "transcript_bytes": size, "bytes_parsed": 0,
+                "success": True, "message": f"第 {len(rounds)} 轮"}
+
+    monkeypatch.setattr(cc, "stop_round", fake_round)
+    monkeypatch.setattr("sys.stdin", io.StringIO(json.dumps({"transcript_path": str(transcript), "cwd": "/work"})))
+    cc.stop_command()
+    return rounds
+
+
+def lock_paths(cc, transcript):
+    lock_path = cc.LOCK_DIR / f"{cc.transcript_key(str(transcript))}.lock"
+    return lock_path, lock_path.with_suffix(".pending")
+
+
+def test_busy_transcript_is_coalesced(cc, monkeypatch, tmp_path, capsys):
+    transcript = tmp_path / "t.jsonl"
+    transcript.write_text('{"type": "user"}\n')
+    lock_path, pending_path = lock_paths(cc, transcript)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    holder = cc.try_lock(lock_path)
+    try:
+        assert run_stop(cc, monkeypatch, transcript) == []
+    finally:
+        holder.close()
+    assert pending_path.exists()
+    assert "已合并" in capsys.readouterr().out
+
+
+def test_pending_without_new_data_does_not_run_again(cc, monkeypatch, tmp_path):
+    transcript = tmp_path / "t.jsonl"
+    transcript.write_text('{"type": "user"}\n')
+    _, pending_path = lock_paths(cc, transcript)
+
+    rounds = run_stop(cc, monkeypatch, transcript, lambda n: pending_path.touch())
+    assert len(rounds) == 1
+    assert not pending_path.exists()
+
+
+def test_pending_with_new_data_runs_follow_up_round(cc, monkeypatch, tmp_path):
+    transcript = tmp_path / "t.jsonl"
+    transcript.write_text('{"type": "user"}\n')
+    _, pending_path = lock_paths(cc, transcript)
+
+    def late_stop(n):
+        if n == 1:
+            with open(transcript, "a") as f:
+                f.write('{"type": "assistant"}\n')
+            pending_path.touch()
+
+    rounds = run_stop(cc, monkeypatch, transcript, late_stop)
+    assert len(rounds) == 2
+    assert not pending_path.exists()
+    assert [r["round"] for r in cc.read_metrics() if r.get("kind") == "stop"] == [1, 2]
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+TS = "2026-01-01T00:00:00Z"
+
+
+def line(record):
+    return json.dumps(record, ensure_ascii=False).encode("utf-8")
+
+
+def user(text):
+    return {"type": "user", "message": {"role": "user", "content": text}, "timestamp": TS}
+
+
+@pytest.mark.parametrize("text", [
+    "tool_result",
+    'why is "tool_result',
+    'paste {"type": "tool_result", "tool_use_id": "x"}',
+    '{"toolUseResult": {"stdout": "ok"}} 这是什么',
+    'toolUseResult',
+])
+def test_prompt_mentioning_tool_result_is_still_a_prompt(cc, text):
+    buf = line(user(text))
+    assert cc.peek_record(buf, 0, len(buf)) is None
+    kind, ts, msg = cc.parse_line(buf)
+    assert kind == "u"
+    assert cc.user_prompt_text(msg) == text
+
+
+@pytest.mark.parametrize("record", [
+    {"type": "user", "toolUseResult": {"stdout": "ok"}, "timestamp": TS,
+     "message": {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "x", "content": "ok"}]}},
+    {"type": "user", "timestamp": TS,
+     "message": {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "x", "content": "ok"}]}},
+    {"type": "summary", "summary": "tool_result", "timestamp": TS},
+])
+def test_records_that_are_not_prompts_skip_decoding(cc, record):
+    buf = line(record)
+    assert cc.peek_record(buf, 0, len(buf)) == ("", cc.parse_timestamp(TS))
+    assert cc.parse_line(buf)[2] is None
+
+
+@pytest.mark.parametrize("record", [
+    {"type": "assistant", "message": {"content": [{"type": "text", "text": "done"}]}, "timestamp": TS},
+    {"type": "tool_result", "tool_name": "Bash", "tool_output": {"output": "ok"}, "timestamp": TS},
+    {"content": "no type", "timestamp": TS},
+])
+def test_records_that_may_matter_are_decoded(cc, record):
+    buf = line(record)
+    assert cc.peek_record(buf, 0, len(buf)) is None